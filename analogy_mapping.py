@@ -0,0 +1,105 @@
+'''
+Linear analogy maps for EmbeddingTaskEvaluator.analogy_tasks: learn d x d matrices W1, W2, W3 so that for an analogy
+a : b :: c : d the prediction -W1 a + W2 b + W3 c points at d. With W1 = W2 = W3 = I this is the usual vector offset.
+
+Two solvers, both over whole (n, d) batches so all the work is BLAS matmuls:
+    adam   the minibatch Adam training of the old TF graph (same loss, init, batch size and optimizer), in NumPy
+    ridge  closed-form least squares, regularized towards the vector offset map
+'''
+import numpy as np
+
+
+SOLVERS = ('adam', 'ridge')
+
+
+def predict(W1, W2, W3, x1s, x2s, x3s):
+    ''' Unnormalized predictions, one row per analogy: -W1 x1 + W2 x2 + W3 x3 '''
+    return -np.dot(x1s, W1.T) + np.dot(x2s, W2.T) + np.dot(x3s, W3.T)
+
+
+def _loss_and_grads(Ws, xs, y, reg_param):
+    '''
+    Loss of the TF graph on one batch and its gradients wrt (W1, W2, W3). As in the graph, the predictions of the
+    batch are divided by the Frobenius norm of the whole batch (not row by row) before comparing them with y.
+    '''
+    W1, W2, W3 = Ws
+    x1s, x2s, x3s = xs
+    n = len(y)
+    pred = predict(W1, W2, W3, x1s, x2s, x3s)
+    norm = np.sqrt(np.sum(pred * pred))
+    y_hat = pred / norm
+    diff = y_hat - y
+    prediction_loss = np.sum(diff * diff) / n
+    reg_loss = reg_param * .5 * np.sum(W3 * W3)
+    # back through the mean squared distance, then through the normalization
+    d_y_hat = (2.0 / n) * diff
+    d_pred = (d_y_hat - y_hat * np.sum(d_y_hat * y_hat)) / norm
+    grads = [
+        -np.dot(d_pred.T, x1s),
+        np.dot(d_pred.T, x2s),
+        np.dot(d_pred.T, x3s) + reg_param * W3,
+    ]
+    return prediction_loss, reg_loss, grads
+
+
+def train_adam(x1s, x2s, x3s, y, batch_size=25, n_iters=1, learning_rate=1e-3, reg_param=.001,
+               beta1=.9, beta2=.999, epsilon=1e-8, verbose=False):
+    '''
+    Same training as the old TF graph: W1, W2, W3 start at the identity, `n_iters` passes over the data in order in
+    batches of `batch_size`, and tf.train.AdamOptimizer's update rule. Everything is float64 like the graph.
+    '''
+    dim = x1s.shape[1]
+    xs_all = [np.asarray(x, dtype=np.float64) for x in (x1s, x2s, x3s)]
+    y = np.asarray(y, dtype=np.float64)
+    Ws = [np.identity(dim) for _ in range(3)]
+    ms = [np.zeros((dim, dim)) for _ in range(3)]
+    vs = [np.zeros((dim, dim)) for _ in range(3)]
+    step = 0
+    p_loss, r_loss = float('nan'), float('nan')
+    for _ in range(n_iters):
+        if verbose:
+            print('running batches...')
+        for start in range(0, len(y), batch_size):
+            xs = [x[start:start + batch_size] for x in xs_all]
+            p_loss, r_loss, grads = _loss_and_grads(Ws, xs, y[start:start + batch_size], reg_param)
+            step += 1
+            lr_t = learning_rate * np.sqrt(1 - beta2 ** step) / (1 - beta1 ** step)
+            for W, m, v, g in zip(Ws, ms, vs, grads):
+                m *= beta1
+                m += (1 - beta1) * g
+                v *= beta2
+                v += (1 - beta2) * g * g
+                W -= lr_t * m / (np.sqrt(v) + epsilon)
+            if verbose and step % 20 == 0:
+                print('loss at step {}: {}'.format(step, p_loss + r_loss))
+    print('Prediction loss: {:.2f}, Regularization loss: {:.2f} (at end of training)'.format(p_loss, r_loss))
+    return Ws
+
+
+def train_ridge(x1s, x2s, x3s, y, reg_param=1.0):
+    '''
+    Closed form: the [W1, W2, W3] minimizing
+        sum_i ||y_i - (-W1 x1_i + W2 x2_i + W3 x3_i)||^2 + reg_param * sum_k ||W_k - I||^2
+    i.e. ridge regression of y on [-x1, x2, x3] shrunk towards the vector offset map (reg_param -> inf gives it back).
+    One (3d, 3d) solve, however many analogies there are.
+    '''
+    dim = x1s.shape[1]
+    Z = np.hstack([-np.asarray(x1s, dtype=np.float64), np.asarray(x2s, dtype=np.float64), np.asarray(x3s, dtype=np.float64)])
+    y = np.asarray(y, dtype=np.float64)
+    prior = np.vstack([np.identity(dim)] * 3)  # (3d, d), the transposed W's stacked
+    gram = np.dot(Z.T, Z)
+    gram[np.diag_indices_from(gram)] += reg_param
+    B = np.linalg.solve(gram, np.dot(Z.T, y) + reg_param * prior)
+    residual = y - np.dot(Z, B)
+    print('Prediction loss: {:.2f}, Regularization loss: {:.2f}'.format(
+        np.sum(residual * residual) / len(y), reg_param * np.sum((B - prior) ** 2)))
+    return [B[k * dim:(k + 1) * dim].T for k in range(3)]
+
+
+def train(x1s, x2s, x3s, y, solver='adam', verbose=False, **kwargs):
+    ''' (W1, W2, W3) from the given solver (one of SOLVERS); kwargs go to train_<solver> '''
+    if solver == 'adam':
+        return train_adam(x1s, x2s, x3s, y, verbose=verbose, **kwargs)
+    if solver == 'ridge':
+        return train_ridge(x1s, x2s, x3s, y, **kwargs)
+    raise ValueError('Unknown analogy solver {}. Use one of {}'.format(solver, SOLVERS))
@@ -0,0 +1,225 @@
+'''
+Approximate nearest neighbor search over an embedding with an inverted file (IVF) index: the vectors are clustered
+with k-means into `num_lists` lists, and a query only scores the vectors of the `nprobe` lists whose centroids are
+closest to it, instead of the whole vocab. Higher nprobe means better recall and slower queries
+(nprobe = num_lists is exact search).
+
+Layout of an index directory:
+    centroids.npy  (num_lists, d) float32
+    vectors.npy    (|V|, d) float32, the indexed vectors grouped by list (normalized for the cosine metric)
+    ids.npy        (|V|,) int64, the original row of every vector in vectors.npy
+    list_ptr.npy   (num_lists + 1,) int64 -- list i is vectors[list_ptr[i]:list_ptr[i+1]]
+    labels.txt     one label (word) per original row, if the index has labels
+    meta.json      format version, metric, nprobe and sizes. Written last
+
+An index can stand in for the `indexer` of gensim's most_similar (it has the same most_similar(vector, num_neighbors)
+as gensim's AnnoyIndexer), and `search` takes the place of the brute-force scans of the nearest neighbor helpers.
+'''
+import json
+import numpy as np
+import os
+import shutil
+import time
+
+import retrieval
+
+
+INDEX_FORMAT_VERSION = 1
+METRICS = ('cosine', 'l2')
+
+
+def _nearest_centroids(vectors, centroids, k=1, block_size=10000):
+    ''' (len(vectors), k) ids of the centroids closest in L2 to every vector: argmax of x.c - |c|^2 / 2 '''
+    half_norms = .5 * np.sum(centroids * centroids, axis=1)
+    out = np.zeros((len(vectors), k), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        scores = np.dot(vectors[start:start + block_size], centroids.T) - half_norms
+        if k == 1:
+            out[start:start + block_size, 0] = np.argmax(scores, axis=1)
+        else:
+            out[start:start + block_size] = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    return out
+
+
+def kmeans(vectors, num_clusters, num_iters=10, sample_size=None, seed=0):
+    '''
+    Lloyd's k-means on (a random sample of `sample_size` rows of) `vectors`. Empty clusters are restarted at random
+    sample points. Returns the (num_clusters, d) float32 centroids.
+    '''
+    rng = np.random.RandomState(seed)
+    if sample_size is not None and sample_size < len(vectors):
+        vectors = vectors[np.sort(rng.choice(len(vectors), size=sample_size, replace=False))]
+    vectors = np.asarray(vectors, dtype=np.float32)
+    num_clusters = min(num_clusters, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), size=num_clusters, replace=False)].copy()
+    for _ in range(num_iters):
+        assignment = _nearest_centroids(vectors, centroids)[:, 0]
+        counts = np.bincount(assignment, minlength=num_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+        centroids[~nonempty] = vectors[rng.choice(len(vectors), size=int((~nonempty).sum()))]
+    return centroids
+
+
+class IVFIndex(object):
+    def __init__(self, centroids, vectors, ids, list_ptr, labels=None, metric='cosine', nprobe=8):
+        ''' Use IVFIndex.build or IVFIndex.load. The arguments are the arrays described at the top of the module '''
+        if metric not in METRICS:
+            raise ValueError('Unknown metric {}. Use one of {}'.format(metric, METRICS))
+        self.centroids = centroids
+        self.vectors = vectors
+        self.ids = ids
+        self.list_ptr = list_ptr
+        self.labels = labels
+        self.metric = metric
+        self.nprobe = nprobe
+        if metric == 'l2':
+            self.half_norms = .5 * np.sum(np.asarray(vectors, dtype=np.float32) ** 2, axis=1)
+
+    @staticmethod
+    def build(vectors, labels=None, metric='cosine', num_lists=None, nprobe=8, num_iters=10, sample_size=None, seed=0):
+        '''
+        Clusters the (|V|, d) `vectors` (e.g. WordVectors.matrix) into `num_lists` lists (default 4 * sqrt(|V|)).
+        k-means runs on `sample_size` rows (default 64 per list). `labels` are the words of the rows, for most_similar.
+        '''
+        t = time.time()
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if metric == 'cosine':
+            with np.errstate(divide='ignore', invalid='ignore'):
+                vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = np.nan_to_num(vectors)  # all-zero (or nan) rows can't be found, but mustn't break k-means
+        if num_lists is None:
+            num_lists = max(1, int(4 * np.sqrt(len(vectors))))
+        if sample_size is None:
+            sample_size = 64 * num_lists
+        centroids = kmeans(vectors, num_lists, num_iters=num_iters, sample_size=sample_size, seed=seed)
+        assignment = _nearest_centroids(vectors, centroids)[:, 0]
+        ids = np.argsort(assignment, kind='stable')
+        list_ptr = np.append(0, np.cumsum(np.bincount(assignment, minlength=len(centroids))))
+        print('Built IVF index of {} vectors in {} lists in {:.1f} secs'.format(len(vectors), len(centroids), time.time() - t))
+        return IVFIndex(centroids, vectors[ids], ids, list_ptr, labels=labels, metric=metric, nprobe=nprobe)
+
+    @staticmethod
+    def from_word_vectors(word_vectors, **kwargs):
+        ''' Index of an embedding_io.WordVectors (e.g. EmbeddingTaskEvaluator.embedding_dict) '''
+        return IVFIndex.build(word_vectors.matrix, labels=word_vectors.words, **kwargs)
+
+    @staticmethod
+    def from_gensim(model, **kwargs):
+        ''' Index of the normalized vectors of a gensim Word2Vec model, for model.most_similar(..., indexer=index) '''
+        model.init_sims()
+        return IVFIndex.build(model.syn0norm, labels=model.index2word, **kwargs)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def num_lists(self):
+        return len(self.centroids)
+
+    def save(self, dirname):
+        tmp_dirname = dirname + '.tmp'
+        if os.path.exists(tmp_dirname):
+            shutil.rmtree(tmp_dirname)
+        os.makedirs(tmp_dirname)
+        for name in ['centroids', 'vectors', 'ids', 'list_ptr']:
+            np.save(os.path.join(tmp_dirname, name + '.npy'), getattr(self, name))
+        if self.labels is not None:
+            with open(os.path.join(tmp_dirname, 'labels.txt'), 'w', encoding='utf8') as f:
+                f.write(''.join(label + '\n' for label in self.labels))
+        meta = {
+            'format_version': INDEX_FORMAT_VERSION,
+            'metric': self.metric,
+            'nprobe': self.nprobe,
+            'num_vectors': len(self),
+            'num_lists': self.num_lists,
+            'has_labels': self.labels is not None,
+        }
+        with open(os.path.join(tmp_dirname, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+        if os.path.exists(dirname):
+            shutil.rmtree(dirname)
+        os.rename(tmp_dirname, dirname)
+
+    @staticmethod
+    def exists(dirname):
+        return os.path.exists(os.path.join(dirname, 'meta.json'))
+
+    @staticmethod
+    def load(dirname, mmap_mode='r'):
+        ''' Opens an index written by save. The vectors (the only big array) are memory mapped by default '''
+        with open(os.path.join(dirname, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['format_version'] != INDEX_FORMAT_VERSION:
+            raise ValueError('Index in {} has format version {}, expected {}. Rebuild it'.format(
+                dirname, meta['format_version'], INDEX_FORMAT_VERSION))
+        labels = None
+        if meta['has_labels']:
+            with open(os.path.join(dirname, 'labels.txt'), 'r', encoding='utf8') as f:
+                labels = f.read().split('\n')[:-1]
+        arrays = {
+            name: np.load(os.path.join(dirname, name + '.npy'), mmap_mode=mmap_mode if name == 'vectors' else None)
+            for name in ['centroids', 'vectors', 'ids', 'list_ptr']
+        }
+        return IVFIndex(labels=labels, metric=meta['metric'], nprobe=meta['nprobe'], **arrays)
+
+    @staticmethod
+    def load_or_build(dirname, vectors, labels=None, **kwargs):
+        if IVFIndex.exists(dirname):
+            return IVFIndex.load(dirname)
+        index = IVFIndex.build(vectors, labels=labels, **kwargs)
+        index.save(dirname)
+        return index
+
+    def _query_vectors(self, queries):
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if self.metric == 'cosine':
+            with np.errstate(divide='ignore', invalid='ignore'):
+                queries = np.nan_to_num(queries / np.linalg.norm(queries, axis=1, keepdims=True))
+        return queries
+
+    def search(self, queries, k=10, nprobe=None, exclude=None):
+        '''
+        Approximate retrieval.top_k: (ids, scores), both (num_queries, k), of the rows closest to every query, best first.
+        Scores are cosine similarities for the cosine metric and negative squared L2 distances for l2. `exclude` holds
+        the row ids each query must not return, as in retrieval.top_k. Queries with fewer than k candidates in their
+        lists are padded with id -1 and score -inf.
+        '''
+        queries = self._query_vectors(queries)
+        nprobe = min(nprobe or self.nprobe, self.num_lists)
+        if exclude is not None:
+            exclude = np.asarray(exclude, dtype=np.int64).reshape(len(queries), -1)
+        probes = _nearest_centroids(queries, self.centroids, k=nprobe)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for i, (query, lists) in enumerate(zip(queries, probes)):
+            candidates = np.concatenate([np.arange(self.list_ptr[l], self.list_ptr[l + 1]) for l in lists])
+            if len(candidates) == 0:
+                continue
+            candidates.sort()  # contiguous reads of the (memory mapped) vectors
+            cand_scores = np.dot(np.asarray(self.vectors[candidates]), query)
+            if self.metric == 'l2':
+                # -|x - q|^2 = 2 (x.q - |x|^2 / 2) - |q|^2
+                cand_scores = 2 * (cand_scores - self.half_norms[candidates]) - np.dot(query, query)
+            if exclude is not None:
+                cand_scores[np.isin(self.ids[candidates], exclude[i])] = -np.inf
+            top, top_scores = retrieval.top_k_of_scores(cand_scores[None, :], min(k, len(candidates)))
+            valid = np.isfinite(top_scores[0])
+            found = int(valid.sum())
+            ids[i, :found] = self.ids[candidates[top[0][valid]]]
+            scores[i, :found] = top_scores[0][valid]
+        return ids, scores
+
+    def most_similar(self, vector, num_neighbors):
+        ''' [(label, score)] of the `num_neighbors` rows closest to `vector`, like gensim's AnnoyIndexer.most_similar '''
+        ids, scores = self.search(vector, k=num_neighbors)
+        return [(self.labels[i], float(score)) for (i, score) in zip(ids[0], scores[0]) if i >= 0]
+
+
+def recall_at_k(approx_ids, exact_ids):
+    ''' Fraction of the exact top k neighbors of every query that the approximate search found (averaged over queries) '''
+    k = exact_ids.shape[1]
+    hits = [len(np.intersect1d(a[a >= 0], e)) for (a, e) in zip(approx_ids[:, :k], exact_ids)]
+    return np.mean(hits) / k
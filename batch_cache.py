@@ -0,0 +1,160 @@
+'''
+On-disk cache of the sequence of sparse (indices, values) minibatches that the online CP trainers consume.
+Building the batches means parsing the wiki dump and computing PMI values; with a cache that only happens once and
+every later epoch (or later experiment with the same parameters) just streams the batches off a memory-mapped file.
+
+Layout of a cache directory:
+    indices.bin  indices of all batches, concatenated. Raw (num_entries, ndims) array of meta['index_dtype']
+    values.bin   values of all batches, concatenated. Raw float32
+    offsets.npy  (num_batches + 1,) int64 -- batch i is rows offsets[i]:offsets[i+1]
+    meta.json    ndims, index_dtype, num_batches, num_entries and the params the batches were made with
+'''
+import json
+import numpy as np
+import os
+import shutil
+import time
+
+
+def cache_dirname(root='pmi_batches', **params):
+    ''' Directory name determined by the params the batches are made with (e.g. num_articles, min_count, n, shift) '''
+    parts = []
+    for key in sorted(params):
+        val = params[key]
+        if isinstance(val, float):
+            val = '{:.4f}'.format(val)
+        parts.append('{}={}'.format(key, val))
+    return os.path.join(root, '_'.join(parts))
+
+
+class PMIBatchCacheWriter(object):
+    '''
+    Appends batches to a new cache. Everything is written to a temporary directory that's only moved to `dirname`
+    on close(), so an interrupted build leaves nothing behind.
+    '''
+    def __init__(self, dirname, ndims, index_dtype=np.int64):
+        self.dirname = dirname
+        self.ndims = ndims
+        self.index_dtype = np.dtype(index_dtype)
+        self.tmp_dirname = dirname + '.tmp'
+        if os.path.exists(self.tmp_dirname):
+            shutil.rmtree(self.tmp_dirname)
+        os.makedirs(self.tmp_dirname)
+        self.f_ix = open(os.path.join(self.tmp_dirname, 'indices.bin'), 'wb')
+        self.f_val = open(os.path.join(self.tmp_dirname, 'values.bin'), 'wb')
+        self.offsets = [0]
+
+    def add(self, indices, values):
+        # reshape: create_pmi_tensor squeezes a batch with a single entry down to 1 dimension
+        indices = np.ascontiguousarray(np.reshape(indices, (-1, self.ndims)), dtype=self.index_dtype)
+        values = np.ascontiguousarray(np.reshape(values, (-1,)), dtype=np.float32)
+        if len(indices) != len(values):
+            raise ValueError('Got {} indices but {} values in batch {}'.format(len(indices), len(values), len(self.offsets) - 1))
+        self.f_ix.write(indices.tobytes())
+        self.f_val.write(values.tobytes())
+        self.offsets.append(self.offsets[-1] + len(values))
+
+    def close(self, params=None):
+        ''' Finishes the cache and returns it opened as a PMIBatchCache '''
+        self.f_ix.close()
+        self.f_val.close()
+        np.save(os.path.join(self.tmp_dirname, 'offsets.npy'), np.array(self.offsets, dtype=np.int64))
+        meta = {
+            'ndims': int(self.ndims),
+            'index_dtype': self.index_dtype.name,
+            'num_batches': len(self.offsets) - 1,
+            'num_entries': int(self.offsets[-1]),
+            'params': params or {},
+        }
+        with open(os.path.join(self.tmp_dirname, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+        if os.path.exists(self.dirname):
+            shutil.rmtree(self.dirname)
+        os.rename(self.tmp_dirname, self.dirname)
+        return PMIBatchCache(self.dirname)
+
+
+class PMIBatchCache(object):
+    def __init__(self, dirname):
+        self.dirname = dirname
+        with open(os.path.join(dirname, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.ndims = self.meta['ndims']
+        self.offsets = np.load(os.path.join(dirname, 'offsets.npy'))
+        num_entries = self.meta['num_entries']
+        index_dtype = np.dtype(self.meta['index_dtype'])
+        if num_entries == 0:  # can't memmap an empty file
+            self.indices = np.zeros((0, self.ndims), dtype=index_dtype)
+            self.values = np.zeros((0,), dtype=np.float32)
+        else:
+            self.indices = np.memmap(os.path.join(dirname, 'indices.bin'), dtype=index_dtype, mode='r', shape=(num_entries, self.ndims))
+            self.values = np.memmap(os.path.join(dirname, 'values.bin'), dtype=np.float32, mode='r', shape=(num_entries,))
+
+    @staticmethod
+    def exists(dirname):
+        # meta.json is written last, so a build that died halfway doesn't count
+        return os.path.exists(os.path.join(dirname, 'meta.json'))
+
+    @staticmethod
+    def build(dirname, batches, ndims, index_dtype=np.int64, params=None):
+        ''' Writes every (indices, values) pair from the `batches` generator to the cache in `dirname` and returns the opened cache '''
+        print('Caching PMI batches to {}...'.format(dirname))
+        t = time.time()
+        writer = PMIBatchCacheWriter(dirname, ndims, index_dtype=index_dtype)
+        for indices, values in batches:
+            writer.add(indices, values)
+        cache = writer.close(params=params)
+        print('Cached {} batches ({} entries) in {} secs'.format(len(cache), cache.meta['num_entries'], int(time.time() - t)))
+        return cache
+
+    @staticmethod
+    def load_or_build(dirname, batches_fn, ndims, index_dtype=np.int64, params=None):
+        ''' Opens the cache in `dirname`, building it from the generator `batches_fn()` first if it doesn't exist yet '''
+        if PMIBatchCache.exists(dirname):
+            print('Loading cached PMI batches from {}'.format(dirname))
+            return PMIBatchCache(dirname)
+        return PMIBatchCache.build(dirname, batches_fn(), ndims, index_dtype=index_dtype, params=params)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return (self.indices[start:end], self.values[start:end])
+
+    def batch_order(self, shuffle=False, rng=None):
+        if not shuffle:
+            return np.arange(len(self))
+        if rng is None:
+            rng = np.random
+        return rng.permutation(len(self))
+
+    def iter_batches(self, order=None):
+        if order is None:
+            order = range(len(self))
+        for i in order:
+            yield self[i]
+
+    def epochs(self, num_epochs=1, shuffle=True, seed=0):
+        ''' Generator of the batches for `num_epochs` passes, in a fresh random order every epoch if shuffle '''
+        rng = np.random.RandomState(seed)
+        for epoch in range(num_epochs):
+            print('Starting epoch {} of {}'.format(epoch + 1, num_epochs))
+            for batch in self.iter_batches(self.batch_order(shuffle, rng)):
+                yield batch
+
+
+def joint_epochs(caches, num_epochs=1, shuffle=True, seed=0):
+    '''
+    Like PMIBatchCache.epochs, but for the joint decomposition: yields ([indices for each cache], [values for each cache]),
+    with the same batch order for every cache so the batches stay aligned.
+    '''
+    num_batches = len(caches[0])
+    if any(len(cache) != num_batches for cache in caches):
+        raise ValueError('All caches must have the same number of batches. Got {}'.format([len(cache) for cache in caches]))
+    rng = np.random.RandomState(seed)
+    for epoch in range(num_epochs):
+        print('Starting epoch {} of {}'.format(epoch + 1, num_epochs))
+        for i in caches[0].batch_order(shuffle, rng):
+            pairs = [cache[i] for cache in caches]
+            yield ([x[0] for x in pairs], [x[1] for x in pairs])
@@ -0,0 +1,203 @@
+'''
+Runs the EmbeddingTaskEvaluator tasks of several embeddings as independent (method, task, params, seed) jobs over a
+process pool, with an on-disk cache of the results, so re-running a comparison only computes the jobs it hasn't seen.
+
+Layout of the cache directory:
+    embeddings/<digest>_<flags>.npy/.vocab  every embedding after its nonneg clip / normalization, as float32 .npy
+                                            (embedding_io), memory mapped by all the workers so they share its pages
+    results/<job key>.json                  the result of one job
+
+A job key is a hash of the content of the vectors file, the normalize/nonneg flags, the task, its params and the seed,
+so a retrained embedding (new content at the same path) gets new results, and renaming a method doesn't lose any.
+'''
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+
+from embedding_io import WordVectors, vocab_fname, write_npy
+
+
+def _sentiment(evaluator, train_pct=1.0):
+    return {'score': evaluator.sentiment_analysis_tasks(train_pct=train_pct)}
+
+
+def _word_classification(evaluator, train_pct=1.0, classification_problem='PoS'):
+    return {'score': evaluator.word_classification_tasks(classification_problem=classification_problem, train_pct=train_pct)}
+
+
+def _analogy(evaluator, train_pct=1.0, solver='adam'):
+    sem_score, syn_score = evaluator.analogy_tasks(train_pct=train_pct, solver=solver)
+    return {'sem': sem_score, 'syn': syn_score}
+
+
+def _outlier_detection(evaluator, n=3):
+    opp, accuracy = evaluator.outlier_detection(verbose=False, n=n)
+    return {'opp': opp / 100.0, 'acc': accuracy / 100.0}
+
+
+# task name -> function(evaluator, **params) returning a dict of named scores
+TASKS = {
+    'sentiment': _sentiment,
+    'word_classification': _word_classification,
+    'analogy': _analogy,
+    'outlier_detection': _outlier_detection,
+}
+
+
+def file_digest(fname, block_size=2 ** 20):
+    ''' sha1 of the content of `fname` (and of its .vocab for .npy embeddings) '''
+    h = hashlib.sha1()
+    fnames = [fname, vocab_fname(fname)] if fname.endswith('.npy') else [fname]
+    for name in fnames:
+        with open(name, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                h.update(block)
+    return h.hexdigest()
+
+
+class Job(object):
+    def __init__(self, method, task, params=None, seed=0):
+        if task not in TASKS:
+            raise ValueError('Unknown task {}. Use one of {}'.format(task, sorted(TASKS)))
+        self.method = method
+        self.task = task
+        self.params = params or {}
+        self.seed = seed
+
+    def _id(self):
+        return (self.method, self.task, json.dumps(self.params, sort_keys=True), self.seed)
+
+    def __eq__(self, other):
+        return isinstance(other, Job) and self._id() == other._id()
+
+    def __hash__(self):
+        return hash(self._id())
+
+    def __repr__(self):
+        return 'Job({}, {}, {}, seed={})'.format(self.method, self.task, self.params, self.seed)
+
+
+_worker_state = {}
+
+
+def _init_benchmark_worker():
+    _worker_state['evaluators'] = {}
+
+
+def _run_job(args):
+    ''' Runs one job in a worker, reusing the worker's evaluator of the embedding (and the data it has cached) '''
+    key, method, fname, normalize, nonneg, task, params, seed = args
+    from embedding_evaluation import EmbeddingTaskEvaluator
+    evaluators = _worker_state.setdefault('evaluators', {})
+    if fname not in evaluators:
+        evaluators[fname] = EmbeddingTaskEvaluator(method=method, fname=fname, normalize_vects=normalize, nonneg=nonneg, preprocessed=True)
+    evaluator = evaluators[fname]
+    evaluator.method = method
+    evaluator.seed_bump = seed
+    t = time.time()
+    result = TASKS[task](evaluator, **params)
+    return key, {name: float(value) for (name, value) in result.items()}, time.time() - t
+
+
+class BenchmarkRunner(object):
+    def __init__(self, embeddings, cache_dir='benchmark_cache', processes=None, normalize=True, nonneg=False):
+        '''
+        `embeddings` is a list of (method, vectors file) pairs (any format embedding_io reads). `normalize` and `nonneg`
+        are applied like EmbeddingTaskEvaluator's normalize_vects and nonneg. `processes` defaults to the number of CPUs.
+        '''
+        self.embeddings = dict(embeddings)
+        self.cache_dir = cache_dir
+        self.processes = processes or multiprocessing.cpu_count()
+        self.normalize = normalize
+        self.nonneg = nonneg
+        self.digests = {}
+        os.makedirs(os.path.join(cache_dir, 'embeddings'), exist_ok=True)
+        os.makedirs(os.path.join(cache_dir, 'results'), exist_ok=True)
+
+    def digest(self, method):
+        if method not in self.digests:
+            self.digests[method] = file_digest(self.embeddings[method])
+        return self.digests[method]
+
+    def shared_fname(self, method):
+        '''
+        The preprocessed .npy copy of the embedding of `method` the workers memory map, written on first use.
+        It only depends on the file content and the flags, so embeddings that didn't change are never converted again.
+        '''
+        flags = '{}{}'.format('n' if self.normalize else '', 'p' if self.nonneg else '') or 'raw'
+        fname = os.path.join(self.cache_dir, 'embeddings', '{}_{}.npy'.format(self.digest(method), flags))
+        if not (os.path.exists(fname) and os.path.exists(vocab_fname(fname))):
+            vectors = WordVectors.load(self.embeddings[method], normalize=self.normalize, nonneg=self.nonneg)
+            tmp_fname = fname[:-len('.npy')] + '.tmp.npy'
+            write_npy(tmp_fname, vectors.words, vectors.matrix)
+            os.replace(vocab_fname(tmp_fname), vocab_fname(fname))
+            os.replace(tmp_fname, fname)  # the .npy last, it's what marks the copy as complete
+        return fname
+
+    def job_key(self, job):
+        key = {
+            'vectors': self.digest(job.method),
+            'normalize': self.normalize,
+            'nonneg': self.nonneg,
+            'task': job.task,
+            'params': job.params,
+            'seed': job.seed,
+        }
+        return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf8')).hexdigest()
+
+    def _result_fname(self, key):
+        return os.path.join(self.cache_dir, 'results', key + '.json')
+
+    def cached_result(self, job):
+        fname = self._result_fname(self.job_key(job))
+        if not os.path.exists(fname):
+            return None
+        with open(fname) as f:
+            return json.load(f)['result']
+
+    def _save_result(self, key, job, result, elapsed):
+        fname = self._result_fname(key)
+        with open(fname + '.tmp', 'w') as f:
+            json.dump({'job': {'method': job.method, 'task': job.task, 'params': job.params, 'seed': job.seed},
+                       'vectors': self.embeddings[job.method], 'result': result, 'secs': elapsed}, f, indent=2)
+        os.replace(fname + '.tmp', fname)
+
+    def run(self, jobs):
+        ''' {job: {score name: value}} for every Job in `jobs`, computing (in parallel) only those that aren't cached '''
+        results = {}
+        todo = {}
+        for job in jobs:
+            result = self.cached_result(job)
+            if result is None:
+                todo[self.job_key(job)] = job
+            else:
+                results[job] = result
+        print('{} of {} benchmark jobs cached, running {} on {} processes'.format(
+            len(results), len(results) + len(todo), len(todo), min(self.processes, len(todo))))
+        if not todo:
+            return results
+        # jobs of the same embedding next to each other, so a worker tends to reuse its evaluator
+        tasks = sorted(
+            ((key, job.method, self.shared_fname(job.method), self.normalize, self.nonneg, job.task, job.params, job.seed)
+             for (key, job) in todo.items()),
+            key=lambda task: (task[1], task[5], task[7]),
+        )
+        if self.processes == 1 or len(tasks) == 1:
+            _init_benchmark_worker()
+            outputs = map(_run_job, tasks)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(min(self.processes, len(tasks)), initializer=_init_benchmark_worker)
+            outputs = pool.imap_unordered(_run_job, tasks)
+        try:
+            for key, result, elapsed in outputs:
+                job = todo[key]
+                self._save_result(key, job, result, elapsed)
+                results[job] = result
+                print('{}: {} ({:.1f} secs)'.format(job, result, elapsed))
+        finally:
+            if pool is not None:
+                pool.terminate()
+        return results
@@ -0,0 +1,196 @@
+'''
+Speed benchmarks for the hot loops of the pipeline. Run with "python3 benchmarks.py <benchmark_name>"
+'''
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import types
+
+import numpy as np
+
+
+def synthetic_vocab_model(vocab_len, window=5):
+    ''' Just enough of a gensim Word2Vec model (vocab, index2word, window) for PMIGatherer '''
+    index2word = ['w{}'.format(i) for i in range(vocab_len)]
+    vocab = {w: types.SimpleNamespace(index=i) for i, w in enumerate(index2word)}
+    return types.SimpleNamespace(vocab=vocab, index2word=index2word, window=window)
+
+
+def synthetic_batch(num_chunks, vocab_len, chunk_len=11, seed=0):
+    ''' A batch like the ones from batch_generator2 (zipfian word indices, some short chunks at sentence ends) '''
+    rng = np.random.RandomState(seed)
+    batch = []
+    for _ in range(num_chunks):
+        length = chunk_len if rng.rand() < .8 else rng.randint(1, chunk_len)
+        words = (rng.zipf(1.3, size=length) - 1) % vocab_len
+        batch.append([int(x) for x in words])
+    return batch
+
+
+def benchmark_get_indices(num_batches=20, batch_size=1000, vocab_len=20000):
+    from tensor_embedding import PMIGatherer
+    model = synthetic_vocab_model(vocab_len)
+    batches = [synthetic_batch(batch_size, vocab_len, seed=i) for i in range(num_batches)]
+    for n in [2, 3, 4]:
+        gatherer = PMIGatherer(model, n=n)
+
+        t = time.time()
+        expected = [gatherer.get_indices(batch) for batch in batches]
+        loop_time = time.time() - t
+
+        t = time.time()
+        arrays = [gatherer.get_index_array(batch) for batch in batches]
+        vectorized_time = time.time() - t
+
+        identical = all(e == [tuple(x) for x in a.tolist()] for e, a in zip(expected, arrays))
+        num_indices = sum(len(a) for a in arrays)
+        print('n={}: {} indices. get_indices: {:.3f} secs, get_index_array: {:.3f} secs ({:.1f}x). identical: {}'.format(
+            n, num_indices, loop_time, vectorized_time, loop_time / vectorized_time, identical))
+
+
+def benchmark_parallel_counts(num_sents=200000, vocab_len=20000, n=3):
+    from tensor_embedding import PMIGatherer
+    model = synthetic_vocab_model(vocab_len)
+    rng = np.random.RandomState(0)
+    fname = os.path.join(tempfile.mkdtemp(), 'corpus.txt')
+    with open(fname, 'w') as f:
+        for _ in range(num_sents):
+            words = (rng.zipf(1.3, size=rng.randint(5, 40)) - 1) % (2 * vocab_len)  # half the words are OOV
+            f.write(' '.join('w{}'.format(x) for x in words) + '\n')
+    print('{} sentences, {:.1f} MB'.format(num_sents, os.path.getsize(fname) / 1e6))
+
+    reference = None
+    processes = 1
+    while processes <= multiprocessing.cpu_count():
+        gatherer = PMIGatherer(model, n=n)
+        t = time.time()
+        gatherer.populate_counts_from_file(fname, processes=processes, min_count=0)
+        elapsed = time.time() - t
+        result = (gatherer.n_counts.keys, gatherer.n_counts.counts, gatherer.uni_counts, gatherer.num_samples)
+        if reference is None:
+            reference = result
+        identical = all(np.array_equal(a, b) for a, b in zip(reference, result))
+        print('{} processes: {:.2f} secs ({:.0f} sents/sec). identical to 1 process: {}'.format(processes, elapsed, num_sents / elapsed, identical))
+        processes *= 2
+
+
+def benchmark_pmi(num_batches=50, batch_size=5000, vocab_len=20000, n=3, loop_sample=200000):
+    from tensor_embedding import PMIGatherer
+    model = synthetic_vocab_model(vocab_len)
+    gatherer = PMIGatherer(model, n=n)
+    gatherer.populate_counts((synthetic_batch(batch_size, vocab_len, seed=i) for i in range(num_batches)), huge_vocab=False, min_count=0)
+    indices = gatherer.n_counts.indices()
+    print('{} tensor entries ({} with count > 5)'.format(len(indices), len(gatherer.valid_indices)))
+
+    # the per-entry loop is too slow to run on everything, so time it on a sample and extrapolate
+    sample = indices[:loop_sample]
+    t = time.time()
+    expected = np.array([gatherer.PMI(*ix) for ix in sample])
+    loop_time = (time.time() - t) * len(indices) / len(sample)
+
+    t = time.time()
+    values = gatherer.PMI_array(indices, counts=gatherer.n_counts.counts)
+    vectorized_time = time.time() - t
+    print('PMI loop: {:.2f} secs (extrapolated), PMI_array: {:.3f} secs ({:.0f}x). max abs diff: {:.2e}'.format(
+        loop_time, vectorized_time, loop_time / vectorized_time, np.abs(values[:len(sample)] - expected).max()))
+
+
+def synthetic_sparse_tensor(nnz, shape, rank=10, seed=0):
+    ''' (indices, values) of `nnz` random entries of a low-rank CP tensor '''
+    rng = np.random.RandomState(seed)
+    factors = [rng.rand(size, rank) for size in shape]
+    indices = np.stack([rng.randint(0, size, size=nnz) for size in shape], axis=1)
+    values = np.ones(nnz)
+    for mode, A in enumerate(factors):
+        values = values * A[indices[:, mode]].T
+    return indices, values.sum(axis=0).astype(np.float32)
+
+
+def benchmark_cp_loss(nnz=100000, vocab_len=10000, rank=300, num_steps=20):
+    import tensorflow as tf
+    from tensor_decomp import CPDecomp
+    shape = (vocab_len,) * 3
+    indices, values = synthetic_sparse_tensor(nnz, shape)
+    for elementwise_loss in [True, False]:
+        tf.reset_default_graph()
+        sess = tf.Session(config=tf.ConfigProto(allow_soft_placement=True))
+        with sess.as_default():
+            decomp = CPDecomp(shape=shape, rank=rank, sess=sess, optimizer_type='adam', reg_param=0.0, elementwise_loss=elementwise_loss)
+            feed_dict = {decomp.indices: indices, decomp.values: values}
+            ops = {'loss': decomp.loss}
+            if not elementwise_loss:  # the map_fn loss has back_prop=False, so there's nothing to train with
+                decomp.global_step = tf.Variable(0.0, name='global_step', trainable=False)
+                decomp.optimizer = tf.train.AdamOptimizer(learning_rate=1e-3)
+                ops['adam step'] = decomp.get_train_ops()
+            sess.run(tf.global_variables_initializer())
+            for name, op in sorted(ops.items()):
+                sess.run(op, feed_dict=feed_dict)  # warm up
+                t = time.time()
+                for _ in range(num_steps):
+                    sess.run(op, feed_dict=feed_dict)
+                elapsed = time.time() - t
+                print('{} loss, {}: {:.2f} steps/sec ({} nonzeros, rank {})'.format(
+                    'map_fn' if elementwise_loss else 'batched', name, num_steps / elapsed, nnz, rank))
+        sess.close()
+
+
+def benchmark_csf_mttkrp(num_batches=4, batch_size=5000, vocab_len=10000, rank=300, num_threads=None):
+    from csf import coo_mttkrp, CSFTensor
+    from tensor_embedding import PMIGatherer
+    model = synthetic_vocab_model(vocab_len)
+    U = np.random.RandomState(0).rand(vocab_len, rank).astype(np.float32)
+    for n in [3, 4]:
+        gatherer = PMIGatherer(model, n=n)
+        gatherer.populate_counts((synthetic_batch(batch_size, vocab_len, seed=i) for i in range(num_batches)), huge_vocab=False, min_count=0)
+        indices, values = gatherer.create_pmi_tensor(positive=False, symmetric=True, log_info=False)
+        t = time.time()
+        tensor = CSFTensor(indices, values, shape=(vocab_len,) * n)
+        build_time = time.time() - t
+        print('n={}: {} nonzeros, CSF nodes per level: {} (built in {:.2f} secs)'.format(n, tensor.nnz, tensor.num_nodes(), build_time))
+        for mode in range(n):
+            t = time.time()
+            expected = coo_mttkrp(indices, values, [U] * n, mode)
+            coo_time = time.time() - t
+            t = time.time()
+            result = tensor.mttkrp([U] * n, mode, num_threads=num_threads)
+            csf_time = time.time() - t
+            print('  mode {} (level {}): COO {:.3f} secs, CSF {:.3f} secs ({:.1f}x). max rel diff: {:.1e}'.format(
+                mode, tensor.mode_order.index(mode), coo_time, csf_time, coo_time / csf_time,
+                np.abs(result - expected).max() / np.abs(expected).max()))
+
+
+def benchmark_ann(vocab_len=200000, dim=300, num_queries=500, k=10, num_topics=1000):
+    from ann_index import IVFIndex, recall_at_k
+    from retrieval import top_k
+    rng = np.random.RandomState(0)
+    # clustered like word vectors: every word is a noisy copy of one of num_topics topic vectors
+    vectors = (rng.randn(num_topics, dim)[rng.randint(num_topics, size=vocab_len)] + 2 * rng.randn(vocab_len, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    queries = vectors[rng.choice(vocab_len, size=num_queries, replace=False)]
+    t = time.time()
+    exact_ids = np.vstack([top_k(vectors, query[None, :], k=k)[0] for query in queries])
+    exact_time = (time.time() - t) / num_queries
+    print('exact: {:.2f} ms/query ({} vectors, dim {})'.format(1000 * exact_time, vocab_len, dim))
+    index = IVFIndex.build(vectors)
+    for nprobe in [1, 2, 4, 8, 16, 32, 64]:
+        t = time.time()
+        ids, _ = index.search(queries, k=k, nprobe=nprobe)
+        elapsed = (time.time() - t) / num_queries
+        print('IVF, {} lists, nprobe {}: recall@{} {:.3f}, {:.2f} ms/query ({:.1f}x faster than exact)'.format(
+            index.num_lists, nprobe, k, recall_at_k(ids, exact_ids), 1000 * elapsed, exact_time / elapsed))
+
+
+if __name__ == '__main__':
+    benchmarks = {
+        'ann': benchmark_ann,
+        'cp_loss': benchmark_cp_loss,
+        'csf_mttkrp': benchmark_csf_mttkrp,
+        'get_indices': benchmark_get_indices,
+        'parallel_counts': benchmark_parallel_counts,
+        'pmi': benchmark_pmi,
+    }
+    if len(sys.argv) == 1 or sys.argv[1] not in benchmarks:
+        raise ValueError('Please specify one of the benchmarks: {}'.format(', '.join(sorted(benchmarks))))
+    benchmarks[sys.argv[1]]()
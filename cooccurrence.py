@@ -0,0 +1,550 @@
+'''
+Vectorized n-gram co-occurrence extraction and packed-integer counting for PMIGatherer.
+
+A "batch" is what `gensim_utils.batch_generator2` yields: a list of sentence chunks, each a list of vocab indices.
+Everything in here works on a whole batch at once as a padded int32 array instead of looping over python tuples.
+'''
+from functools import lru_cache
+import itertools
+import multiprocessing
+import numpy as np
+import os
+import shutil
+import tempfile
+
+PAD = -1  # padding value for chunks shorter than the longest chunk in the batch
+
+
+def pad_batch(batch, pad=PAD):
+    '''
+    Turns a batch of chunks (lists of vocab indices) into a (len(batch), max_chunk_len) int32 array, filling the
+    tail of short chunks with `pad`. Arrays are passed through (they are assumed to already be padded).
+    '''
+    if isinstance(batch, np.ndarray):
+        return batch.astype(np.int32, copy=False)
+    lengths = np.fromiter((len(chunk) for chunk in batch), dtype=np.int64, count=len(batch))
+    width = int(lengths.max()) if len(batch) else 0
+    padded = np.full((len(batch), width), pad, dtype=np.int32)
+    if width > 0:
+        flat = np.fromiter(itertools.chain.from_iterable(batch), dtype=np.int32, count=int(lengths.sum()))
+        padded[np.arange(width) < lengths[:, None]] = flat  # boolean assignment fills row by row
+    return padded
+
+
+@lru_cache(maxsize=None)
+def combination_table(width, n):
+    '''
+    All sorted position tuples (p_1 < ... < p_n) into a row of length `width`, in lexicographic order.
+    e.g. combination_table(4, 2) = [[0,1], [0,2], [0,3], [1,2], [1,3], [2,3]]
+    '''
+    return np.array(list(itertools.combinations(range(width), n)), dtype=np.intp).reshape(-1, n)
+
+
+def unique_sorted_rows(padded, pad=PAD):
+    '''
+    Sorts every row of `padded` and dedups it, so that row b starts with its `num_unique[b]` distinct words in
+    ascending order (the equivalent of `sorted(set(chunk))`). The rest of the row is garbage.
+    '''
+    sentinel = np.iinfo(np.int32).max
+    rows = np.sort(padded, axis=1)
+    invalid = rows == pad
+    invalid[:, 1:] |= rows[:, 1:] == rows[:, :-1]  # repeated words
+    rows[invalid] = sentinel
+    rows.sort(axis=1)  # push the invalid entries to the end of each row
+    num_unique = rows.shape[1] - invalid.sum(axis=1)
+    return rows, num_unique
+
+
+def extract_cooccurrences(batch, n, pad=PAD):
+    '''
+    Returns `(indices, words)`:
+        `indices` is an (N, n) int32 array of every sorted n-combination of distinct words within each chunk, in the
+            same order as the nested loops of `PMIGatherer.get_indices` (chunk by chunk, lexicographic within a chunk).
+        `words` holds the distinct words of every chunk that contributed (i.e. has at least n distinct words),
+            which is exactly what `get_indices` adds to the unigram counts. len(words) is the increase in num_samples.
+    '''
+    padded = pad_batch(batch, pad=pad)
+    rows, num_unique = unique_sorted_rows(padded, pad=pad)
+    keep = num_unique >= n
+    rows = rows[keep]
+    num_unique = num_unique[keep]
+    width = rows.shape[1]
+    if width < n or len(rows) == 0:
+        return np.zeros((0, n), dtype=np.int32), np.zeros((0,), dtype=np.int32)
+    combos = combination_table(width, n)
+    # a combination is valid for a row iff its last (largest) position is within that row's distinct words
+    valid = combos[:, -1][None, :] < num_unique[:, None]  # (B, C)
+    indices = rows[:, combos][valid]  # (B, C, n) -> (N, n). boolean indexing keeps row-major order
+    words = rows[np.arange(width)[None, :] < num_unique[:, None]]
+    return indices, words
+
+
+COUNT_DTYPE = np.uint32
+
+
+def key_bits(vocab_len):
+    ''' Number of bits needed to store one vocab index '''
+    return max(1, int(vocab_len - 1).bit_length())
+
+
+def index_dtype(vocab_len):
+    ''' Smallest unsigned integer dtype that can hold every vocab index '''
+    for dtype in [np.uint16, np.uint32]:
+        if vocab_len - 1 <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+@lru_cache(maxsize=None)
+def permutation_table(n):
+    '''
+    (n!, n) array whose j-th row is the inverse of the j-th permutation from itertools.permutations(range(n)),
+    so tup[table[j]] puts tup[k] at position perm_j[k].
+    '''
+    perms = np.array(list(itertools.permutations(range(n))), dtype=np.intp)
+    return np.argsort(perms, axis=1)
+
+
+def expand_permutations(indices, values, dtype=None):
+    '''
+    Expands every (sorted) row of the (N, n) `indices` into its n! permutations, in itertools.permutations order,
+    with the row's value repeated for each. Returns ((N*n!, n) indices, (N*n!,) values).
+    '''
+    indices = np.asarray(indices)
+    table = permutation_table(indices.shape[1])
+    expanded = indices[:, table].reshape(-1, indices.shape[1])
+    if dtype is not None:
+        expanded = expanded.astype(dtype, copy=False)
+    return expanded, np.repeat(values, len(table))
+
+
+def iter_expand_permutations(indices, values, chunk_size, dtype=None):
+    '''
+    Same as expand_permutations, but yields the expanded (indices, values) in consecutive chunks of at most
+    `chunk_size` rows, so the n!-times-larger arrays never have to be in memory at once.
+    '''
+    n_fact = len(permutation_table(np.shape(indices)[1]))
+    rows_per_chunk = max(1, int(chunk_size) // n_fact)
+    for start in range(0, len(indices), rows_per_chunk):
+        yield expand_permutations(indices[start:start + rows_per_chunk], values[start:start + rows_per_chunk], dtype=dtype)
+
+
+def pack_keys(indices, bits):
+    '''
+    Packs each row of the (N, n) `indices` array into a single uint64, the first column ending up in the most
+    significant bits. So sorting the keys sorts the rows lexicographically.
+    '''
+    indices = np.asarray(indices)
+    if indices.ndim == 1:
+        indices = indices[None, :]
+    keys = np.zeros(len(indices), dtype=np.uint64)
+    shift = np.uint64(bits)
+    for col in range(indices.shape[1]):
+        keys <<= shift
+        keys |= indices[:, col].astype(np.uint64)
+    return keys
+
+
+def unpack_keys(keys, n, bits, dtype=np.int64):
+    ''' Inverse of `pack_keys`. Returns an (N, n) array '''
+    keys = np.asarray(keys, dtype=np.uint64)
+    indices = np.empty((len(keys), n), dtype=dtype)
+    mask = np.uint64((1 << bits) - 1)
+    shift = np.uint64(bits)
+    for col in range(n - 1, -1, -1):
+        indices[:, col] = keys & mask
+        keys = keys >> shift
+    return indices
+
+
+def reduce_counts(keys, counts=None):
+    '''
+    Sorts `keys` and sums the counts of repeated keys (every key counts once if `counts` is None).
+    Returns sorted, duplicate free (keys, counts).
+    '''
+    if counts is None:
+        keys, counts = np.unique(keys, return_counts=True)
+        return keys, counts.astype(COUNT_DTYPE)
+    if len(keys) == 0:
+        return keys.astype(np.uint64), counts.astype(COUNT_DTYPE)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    counts = counts[order]
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    return keys[starts], np.add.reduceat(counts, starts).astype(COUNT_DTYPE)
+
+
+def merge_counts(keys1, counts1, keys2, counts2):
+    ''' Merges two sorted, duplicate free (keys, counts) pairs in O(len1 + len2) '''
+    if len(keys1) == 0:
+        return keys2, counts2
+    if len(keys2) == 0:
+        return keys1, counts1
+    pos = np.searchsorted(keys1, keys2)
+    found = pos < len(keys1)
+    found[found] = keys1[pos[found]] == keys2[found]
+    counts1 = np.array(counts1, dtype=COUNT_DTYPE)  # copy (might be read only)
+    counts1[pos[found]] += counts2[found]
+    new = ~found
+    keys = np.insert(keys1, pos[new], keys2[new])
+    counts = np.insert(counts1, pos[new], counts2[new])
+    return keys, counts
+
+
+class PackedCounts(object):
+    '''
+    Count store for sorted n-tuples of vocab indices, replacing a tuple-keyed defaultdict(int).
+
+    Every tuple is packed into one uint64 key (`bits` bits per vocab index, see `pack_keys`), and the store is a
+    sorted key array next to a uint32 count array - 12 bytes per entry instead of the ~150 of a dict entry.
+    Added indices are buffered and merged into the sorted arrays in bulk once the buffer fills up.
+
+    Supports the dict-like operations PMIGatherer relies on: `counts[(i,j,k)]` (0 if missing),
+    `(i,j,k) in counts` and `len(counts)`, plus vectorized versions of them on arrays of indices.
+    '''
+    def __init__(self, n, vocab_len, keys=None, counts=None, buffer_size=int(1e7)):
+        self.n = n
+        self.vocab_len = vocab_len
+        self.bits = key_bits(vocab_len)
+        if self.bits * n > 64:
+            raise ValueError('Cannot pack {}-tuples of a {}-word vocab into 64 bits'.format(n, vocab_len))
+        self.keys = np.zeros(0, dtype=np.uint64) if keys is None else keys
+        self.counts = np.zeros(0, dtype=COUNT_DTYPE) if counts is None else counts
+        self.buffer_size = buffer_size
+        self._pending = []
+        self._num_pending = 0
+
+    def __getstate__(self):
+        self.flush()
+        return self.__dict__
+
+    def pack(self, indices):
+        return pack_keys(indices, self.bits)
+
+    def add(self, indices):
+        ''' Counts every row of the (N, n) `indices` array once '''
+        self.add_keys(self.pack(indices))
+
+    def add_keys(self, keys, counts=None):
+        self._pending.append((keys, counts))
+        self._num_pending += len(keys)
+        # merging is linear in the size of the store, so let the buffer grow with it
+        if self._num_pending >= max(self.buffer_size, len(self.keys) // 4):
+            self.flush()
+
+    def update(self, other):
+        ''' Adds all the counts of another PackedCounts '''
+        other.flush()
+        self.add_keys(other.keys, other.counts)
+
+    def flush(self):
+        if not self._pending:
+            return
+        if all(counts is None for _, counts in self._pending):
+            run_keys, run_counts = reduce_counts(np.concatenate([keys for keys, _ in self._pending]))
+        else:
+            keys = np.concatenate([keys for keys, _ in self._pending])
+            counts = np.concatenate([
+                np.ones(len(k), dtype=COUNT_DTYPE) if c is None else c.astype(COUNT_DTYPE)
+                for k, c in self._pending
+            ])
+            run_keys, run_counts = reduce_counts(keys, counts)
+        self._pending = []
+        self._num_pending = 0
+        self.keys, self.counts = merge_counts(self.keys, self.counts, run_keys, run_counts)
+
+    def positions(self, keys):
+        ''' Returns (pos, found) such that self.keys[pos[found]] == keys[found] '''
+        self.flush()
+        pos = np.searchsorted(self.keys, keys)
+        found = pos < len(self.keys)
+        found[found] = self.keys[pos[found]] == keys[found]
+        return pos, found
+
+    def lookup(self, indices):
+        ''' Vectorized `self[ix]` for every row of `indices` '''
+        pos, found = self.positions(self.pack(indices))
+        counts = np.zeros(len(pos), dtype=COUNT_DTYPE)
+        counts[found] = self.counts[pos[found]]
+        return counts
+
+    def contains(self, indices):
+        ''' Vectorized `ix in self` for every row of `indices` '''
+        return self.positions(self.pack(indices))[1]
+
+    def intersection(self, indices):
+        ''' The rows of `indices` that are in the store '''
+        return indices[self.contains(indices)]
+
+    def subset(self, mask):
+        ''' A new store with only the entries where `mask` (aligned with self.keys) is True '''
+        self.flush()
+        return PackedCounts(self.n, self.vocab_len, keys=self.keys[mask], counts=self.counts[mask], buffer_size=self.buffer_size)
+
+    def indices(self, dtype=np.int64):
+        ''' All stored tuples as an (N, n) array, in sorted order '''
+        self.flush()
+        return unpack_keys(self.keys, self.n, self.bits, dtype=dtype)
+
+    @property
+    def nbytes(self):
+        return self.keys.nbytes + self.counts.nbytes + 8 * self._num_pending
+
+    def save(self, dirname):
+        ''' Writes keys.npy and counts.npy to `dirname` '''
+        self.flush()
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        np.save(os.path.join(dirname, 'keys.npy'), self.keys)
+        np.save(os.path.join(dirname, 'counts.npy'), self.counts)
+
+    @staticmethod
+    def load(dirname, n, vocab_len, mmap_mode='r'):
+        ''' Opens a store written by `save` (or `ExternalCounts.finalize`), memory mapped by default '''
+        keys = np.load(os.path.join(dirname, 'keys.npy'), mmap_mode=mmap_mode)
+        counts = np.load(os.path.join(dirname, 'counts.npy'), mmap_mode=mmap_mode)
+        return PackedCounts(n, vocab_len, keys=keys, counts=counts)
+
+    def __getitem__(self, index):
+        return int(self.lookup(np.asarray(index, dtype=np.int64))[0])
+
+    def __contains__(self, index):
+        return bool(self.contains(np.asarray(index, dtype=np.int64))[0])
+
+    def __len__(self):
+        self.flush()
+        return len(self.keys)
+
+
+def merge_runs(run_dirs, out_dirname, min_count=0, block_size=int(1e7)):
+    '''
+    k-way merge of sorted (keys, counts) runs saved with `PackedCounts.save` into one sorted, duplicate free pair in
+    `out_dirname`, dropping everything with a summed count below `min_count`. Reads at most `block_size` entries
+    per run at a time. Returns the number of entries written.
+    '''
+    runs = [(np.load(os.path.join(d, 'keys.npy'), mmap_mode='r'), np.load(os.path.join(d, 'counts.npy'), mmap_mode='r')) for d in run_dirs]
+    positions = [0] * len(runs)
+    if not os.path.exists(out_dirname):
+        os.makedirs(out_dirname)
+    raw_keys_fname = os.path.join(out_dirname, 'keys.bin')
+    raw_counts_fname = os.path.join(out_dirname, 'counts.bin')
+    total = 0
+    with open(raw_keys_fname, 'wb') as keys_f, open(raw_counts_fname, 'wb') as counts_f:
+        while any(pos < len(keys) for pos, (keys, _) in zip(positions, runs)):
+            blocks = [keys[pos:pos + block_size] for pos, (keys, _) in zip(positions, runs)]
+            # everything up to the smallest "last loaded key" of the unfinished runs can be merged safely
+            bound = np.iinfo(np.uint64).max
+            for pos, block, (keys, _) in zip(positions, blocks, runs):
+                if pos + len(block) < len(keys):
+                    bound = min(bound, block[-1])
+            merged_keys = []
+            merged_counts = []
+            for i, (block, (_, counts)) in enumerate(zip(blocks, runs)):
+                take = np.searchsorted(block, np.uint64(bound), side='right')
+                merged_keys.append(np.asarray(block[:take]))
+                merged_counts.append(np.asarray(counts[positions[i]:positions[i] + take]))
+                positions[i] += take
+            merged_keys, merged_counts = reduce_counts(np.concatenate(merged_keys), np.concatenate(merged_counts))
+            keep = merged_counts >= min_count
+            merged_keys[keep].tofile(keys_f)
+            merged_counts[keep].tofile(counts_f)
+            total += int(keep.sum())
+
+    # wrap the raw output in .npy files so it can be np.load-ed (and memory mapped)
+    for raw_fname, name, dtype in [(raw_keys_fname, 'keys.npy', np.uint64), (raw_counts_fname, 'counts.npy', COUNT_DTYPE)]:
+        out = np.lib.format.open_memmap(os.path.join(out_dirname, name), mode='w+', dtype=dtype, shape=(total,))
+        if total > 0:
+            raw = np.memmap(raw_fname, dtype=dtype, mode='r', shape=(total,))
+            for start in range(0, total, block_size):
+                out[start:start + block_size] = raw[start:start + block_size]
+            del raw
+        out.flush()
+        del out
+        os.remove(raw_fname)
+    return total
+
+
+class ExternalCounts(object):
+    '''
+    Exact, deterministic out-of-core n-gram counting.
+
+    Counts accumulate in a PackedCounts until it takes more than its share of `memory_budget` bytes, at which point
+    the sorted (keys, counts) are spilled to disk as a run and the store starts over. `finalize` merges all runs
+    into a single sorted count file (see `merge_runs`) and opens it memory mapped.
+
+    Merging the in-memory buffer into the sorted arrays temporarily needs ~3x the store's size, so runs are spilled
+    once the store reaches a third of the budget.
+    '''
+    def __init__(self, n, vocab_len, memory_budget=int(4e9), dirname=None):
+        self.n = n
+        self.vocab_len = vocab_len
+        self.memory_budget = int(memory_budget)
+        self.dirname = tempfile.mkdtemp(prefix='ngram_counts_') if dirname is None else dirname
+        if not os.path.exists(self.dirname):
+            os.makedirs(self.dirname)
+        # buffered (unsorted) keys are 8 bytes each
+        self.counts = PackedCounts(n, vocab_len, buffer_size=max(1, self.memory_budget // (3 * 8 * 4)))
+        self.run_dirs = []
+
+    def add(self, indices):
+        self.counts.add(indices)
+        if self.counts.nbytes > self.memory_budget // 3:
+            self.spill()
+
+    def spill(self):
+        run_dir = os.path.join(self.dirname, 'run_{}'.format(len(self.run_dirs)))
+        self.counts.save(run_dir)
+        print('spilled {} n_counts to {}'.format(len(self.counts), run_dir))
+        self.run_dirs.append(run_dir)
+        self.counts = PackedCounts(self.n, self.vocab_len, buffer_size=self.counts.buffer_size)
+
+    def finalize(self, min_count=0):
+        '''
+        Merges everything counted so far into `self.dirname`/merged, removes the runs, and returns the merged
+        counts (only those >= `min_count`) as a memory mapped PackedCounts.
+        '''
+        if len(self.counts) > 0 or not self.run_dirs:
+            self.spill()
+        out_dirname = os.path.join(self.dirname, 'merged')
+        block_size = max(1, self.memory_budget // (12 * 4 * len(self.run_dirs)))
+        total = merge_runs(self.run_dirs, out_dirname, min_count=min_count, block_size=block_size)
+        print('merged {} runs into {} n_counts'.format(len(self.run_dirs), total))
+        for run_dir in self.run_dirs:
+            shutil.rmtree(run_dir)
+        self.run_dirs = []
+        return PackedCounts.load(out_dirname, self.n, self.vocab_len)
+
+
+def byte_ranges(fname, num_shards):
+    ''' Splits the file into `num_shards` (start, end) byte ranges of roughly equal size '''
+    size = os.path.getsize(fname)
+    bounds = np.linspace(0, size, num_shards + 1).astype(np.int64)
+    return [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def read_lines(fname, start, end):
+    '''
+    Yields the lines (as bytes) of `fname` that *start* within [start, end). Adjacent byte ranges therefore never
+    share or drop a line.
+    '''
+    with open(fname, 'rb') as f:
+        pos = start
+        if start > 0:
+            f.seek(start - 1)
+            pos = start - 1 + len(f.readline())  # skip the tail of the line that started in the previous range
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line
+
+
+def count_batch(batch, n, vocab_len):
+    '''
+    Counts one batch of chunks without touching any gatherer. Returns (n_counts, uni_counts, num_samples) where
+    n_counts is a PackedCounts and uni_counts a dense array, like in PMIGatherer.populate_counts.
+    '''
+    indices, words = extract_cooccurrences(batch, n)
+    counts = PackedCounts(n, vocab_len)
+    counts.add(indices)
+    counts.flush()
+    return counts, np.bincount(words, minlength=vocab_len), len(words)
+
+
+_worker_state = {}
+
+
+def _init_count_worker(word_index, n, vocab_len, chunk_len, batch_size):
+    # runs once per worker process, so the vocab is only sent over once (instead of once per task)
+    _worker_state.update(word_index=word_index, n=n, vocab_len=vocab_len, chunk_len=chunk_len, batch_size=batch_size)
+
+
+def _count_byte_range(args):
+    fname, start, end, out_dirname = args
+    word_index = _worker_state['word_index']
+    n = _worker_state['n']
+    vocab_len = _worker_state['vocab_len']
+    chunk_len = _worker_state['chunk_len']
+    batch_size = _worker_state['batch_size']
+
+    counts = PackedCounts(n, vocab_len)
+    uni_counts = np.zeros(vocab_len, dtype=np.int64)
+    num_samples = 0
+    batch = []
+    lines = read_lines(fname, start, end)
+    while True:
+        line = next(lines, None)
+        if line is not None:
+            # same chunking as gensim_utils.batch_generator2
+            words = [word_index[w] for w in line.decode('utf8', errors='ignore').split() if w in word_index]
+            batch.extend(words[i:i + chunk_len] for i in range(0, len(words), chunk_len))
+        if batch and (len(batch) >= batch_size or line is None):
+            indices, words = extract_cooccurrences(batch, n)
+            counts.add(indices)
+            uni_counts += np.bincount(words, minlength=vocab_len)
+            num_samples += len(words)
+            batch = []
+        if line is None:
+            break
+    counts.save(out_dirname)
+    return out_dirname, uni_counts, num_samples
+
+
+def _merge_count_dirs(args):
+    run_dirs, out_dirname, min_count = args
+    merge_runs(run_dirs, out_dirname, min_count=min_count)
+    for run_dir in run_dirs:
+        shutil.rmtree(run_dir)
+    return out_dirname
+
+
+def parallel_count(fname, word_index, n, vocab_len, chunk_len, processes=None, dirname=None, min_count=0, batch_size=1000, shards_per_process=4):
+    '''
+    Counts the n-grams of a tokenized corpus file (one sentence per line, words separated by spaces) with a pool of
+    `processes` workers. Each worker reads disjoint byte ranges of the file, maps words through `word_index`
+    (word -> vocab index, only sent to each worker once) and writes its partial counts to `dirname`.
+    The partial counts are then merged pairwise in parallel (a tree reduction with `merge_runs`), and everything
+    below `min_count` is dropped. The shard and intermediate merge directories are removed along the way, even if
+    counting fails, so only `dirname`/merged is left (a temp dir by default).
+
+    Returns (n_counts, uni_counts, num_samples), n_counts being a memory mapped PackedCounts in `dirname`/merged.
+    An empty file gives an empty (in memory) PackedCounts.
+    '''
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    # more shards than processes, so a slow shard doesn't leave the other workers idle
+    ranges = byte_ranges(fname, processes * shards_per_process)
+    if not ranges:
+        return PackedCounts(n, vocab_len), np.zeros(vocab_len, dtype=np.int64), 0
+    if dirname is None:
+        dirname = tempfile.mkdtemp(prefix='ngram_counts_')
+    tasks = [(fname, start, end, os.path.join(dirname, 'shard_{}'.format(i))) for i, (start, end) in enumerate(ranges)]
+    pool = multiprocessing.Pool(processes, initializer=_init_count_worker, initargs=(word_index, n, vocab_len, chunk_len, batch_size))
+    try:
+        uni_counts = np.zeros(vocab_len, dtype=np.int64)
+        num_samples = 0
+        run_dirs = []
+        for run_dir, shard_uni_counts, shard_num_samples in pool.imap_unordered(_count_byte_range, tasks):
+            run_dirs.append(run_dir)
+            uni_counts += shard_uni_counts
+            num_samples += shard_num_samples
+        run_dirs.sort()  # imap_unordered - keep the merge tree deterministic
+
+        level = 0
+        while len(run_dirs) > 1 or level == 0:
+            groups = [run_dirs[i:i + 2] for i in range(0, len(run_dirs), 2)]
+            is_last = len(groups) == 1
+            merge_tasks = [
+                (group, os.path.join(dirname, 'merged' if is_last else 'level_{}_{}'.format(level, i)), min_count if is_last else 0)
+                for i, group in enumerate(groups)
+            ]
+            run_dirs = pool.map(_merge_count_dirs, merge_tasks)
+            level += 1
+    finally:
+        pool.terminate()
+        # _merge_count_dirs removes its inputs, but not if counting or merging failed halfway
+        for name in os.listdir(dirname):
+            if name.startswith(('shard_', 'level_')):
+                shutil.rmtree(os.path.join(dirname, name))
+    return PackedCounts.load(run_dirs[0], n, vocab_len), uni_counts, num_samples
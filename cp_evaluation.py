@@ -0,0 +1,144 @@
+'''
+Reconstruction error of trained CP factors on sparse tensors, computed in fixed-size vectorized chunks over a thread pool.
+'''
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import os
+
+from cooccurrence import key_bits, pack_keys
+
+
+def predict_entries(factors, indices, weights=None):
+    '''
+    CP model predictions sum_r lambda_r * A1[i1, r] * A2[i2, r] * ... for every row of the (N, ndims) `indices`.
+    `factors` has one matrix per mode, `weights` (lambda) is an optional (R,) vector.
+    '''
+    prod = factors[0][indices[:, 0]]
+    if weights is not None:
+        prod = prod * weights
+    for m in range(1, indices.shape[1]):
+        prod = prod * factors[m][indices[:, m]]
+    return prod.sum(axis=1)
+
+
+def _error_stats(factors, indices, values, weights):
+    errs = predict_entries(factors, indices, weights=weights) - values
+    abs_errs = np.abs(errs)
+    return len(errs), float(np.dot(errs, errs)), float(abs_errs.sum()), float(abs_errs.max()) if len(errs) else 0.0
+
+
+def sample_heldout(indices, values, num_nonzeros, num_zeros, shape, symmetric=True, seed=0):
+    '''
+    A held-out evaluation set: `num_nonzeros` random entries of the sparse tensor (indices, values) plus `num_zeros`
+    random index tuples that aren't in it (value 0). Returns (indices, values, is_nonzero). If symmetric, the random
+    tuples are sorted like the indices of the symmetric PMI tensors.
+    '''
+    rng = np.random.RandomState(seed)
+    indices = np.asarray(indices).reshape(len(values), -1)
+    ndims = indices.shape[1]
+    chosen = rng.choice(len(values), size=min(num_nonzeros, len(values)), replace=False)
+    bits = key_bits(max(shape))
+    stored_keys = np.sort(pack_keys(indices, bits))
+    zeros = np.zeros((0, ndims), dtype=np.int64)
+    while len(zeros) < num_zeros:
+        candidates = np.stack([rng.randint(0, size, size=2 * (num_zeros - len(zeros))) for size in shape], axis=1)
+        if symmetric:
+            candidates = np.sort(candidates, axis=1)
+        keys = pack_keys(candidates, bits)
+        pos = np.minimum(np.searchsorted(stored_keys, keys), len(stored_keys) - 1)
+        is_stored = stored_keys[pos] == keys if len(stored_keys) else np.zeros(len(keys), dtype=bool)
+        zeros = np.vstack([zeros, candidates[~is_stored]])[:num_zeros]
+    heldout_indices = np.vstack([indices[chosen].astype(np.int64), zeros])
+    heldout_values = np.concatenate([np.asarray(values)[chosen], np.zeros(len(zeros))]).astype(np.float32)
+    is_nonzero = np.arange(len(heldout_values)) < len(chosen)
+    return heldout_indices, heldout_values, is_nonzero
+
+
+class ReconstructionEvaluator(object):
+    def __init__(self, factors, weights=None, chunk_size=int(1e5), num_threads=None):
+        '''
+        `factors` is either the single U of a symmetric decomposition (used for every mode) or a list [U, V, W, ...]
+        with one matrix per mode. `weights` is the optional lambda vector of the CP model.
+        '''
+        self.factors = factors
+        self.weights = weights
+        self.chunk_size = int(chunk_size)
+        self.num_threads = num_threads or os.cpu_count() or 1
+
+    def mode_factors(self, ndims):
+        if isinstance(self.factors, np.ndarray):
+            return [self.factors] * ndims
+        if len(self.factors) != ndims:
+            raise ValueError('Got {} factor matrices for a tensor with {} modes'.format(len(self.factors), ndims))
+        return self.factors
+
+    def evaluate(self, indices, values):
+        '''
+        Error of the model on the entries (indices, values): dict with rmse, mae, max_abs_err and num_entries.
+        '''
+        values = np.asarray(values).ravel()
+        indices = np.asarray(indices).reshape(len(values), -1)
+        factors = self.mode_factors(indices.shape[1])
+        chunks = [
+            (factors, indices[start:start + self.chunk_size], values[start:start + self.chunk_size], self.weights)
+            for start in range(0, len(values), self.chunk_size)
+        ]
+        if self.num_threads > 1 and len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=self.num_threads) as pool:
+                stats = list(pool.map(lambda args: _error_stats(*args), chunks))
+        else:
+            stats = [_error_stats(*args) for args in chunks]
+        num_entries = sum(s[0] for s in stats)
+        if num_entries == 0:
+            return {'rmse': 0.0, 'mae': 0.0, 'max_abs_err': 0.0, 'num_entries': 0}
+        return {
+            'rmse': np.sqrt(sum(s[1] for s in stats) / num_entries),
+            'mae': sum(s[2] for s in stats) / num_entries,
+            'max_abs_err': max(s[3] for s in stats),
+            'num_entries': num_entries,
+        }
+
+    def evaluate_orders(self, tensors):
+        '''
+        Per-order errors of a symmetric U on tensors of different orders (e.g. the 2- and 3-way tensors of the joint
+        decomposition). `tensors` is a list of (indices, values); returns {order: evaluate(indices, values)}.
+        '''
+        results = {}
+        for indices, values in tensors:
+            values = np.asarray(values).ravel()
+            order = np.asarray(indices).reshape(len(values), -1).shape[1]
+            results[order] = self.evaluate(indices, values)
+        return results
+
+    def evaluate_heldout(self, indices, values, is_nonzero):
+        ''' Errors on a held-out set from sample_heldout, separately for its nonzeros and its zeros, and overall '''
+        indices = np.asarray(indices)
+        values = np.asarray(values)
+        return {
+            'nonzeros': self.evaluate(indices[is_nonzero], values[is_nonzero]),
+            'zeros': self.evaluate(indices[~is_nonzero], values[~is_nonzero]),
+            'all': self.evaluate(indices, values),
+        }
+
+
+def format_errors(results):
+    ''' One line summary of the dict from ReconstructionEvaluator.evaluate '''
+    return 'RMSE: {:.3f}, MAE: {:.3f}, max abs err: {:.3f} ({} entries)'.format(
+        results['rmse'], results['mae'], results['max_abs_err'], results['num_entries'])
+
+
+def format_heldout(evaluator, heldout):
+    '''
+    Summary of the errors of `evaluator` on the nonzeros and the zeros of a held-out set from sample_heldout. For the
+    joint decompositions `heldout` is a list of such sets, one per tensor order, and every order gets its own errors
+    (see ReconstructionEvaluator.evaluate_orders).
+    '''
+    if isinstance(heldout, tuple):
+        errors = evaluator.evaluate_heldout(*heldout)
+        return 'nonzeros: {}; zeros: {}'.format(format_errors(errors['nonzeros']), format_errors(errors['zeros']))
+    nonzeros = evaluator.evaluate_orders([(indices[is_nonzero], values[is_nonzero]) for (indices, values, is_nonzero) in heldout])
+    zeros = evaluator.evaluate_orders([(indices[~is_nonzero], values[~is_nonzero]) for (indices, values, is_nonzero) in heldout])
+    return '; '.join(
+        'order {}: nonzeros: {}; zeros: {}'.format(order, format_errors(nonzeros[order]), format_errors(zeros[order]))
+        for order in sorted(nonzeros)
+    )
@@ -0,0 +1,335 @@
+'''
+NumPy backend for the online CP decompositions in tensor_decomp.py, for machines without a GPU (or without TensorFlow).
+
+NumpyCPDecomp, NumpySymmetricCPDecomp and NumpyJointSymmetricCPDecomp take the same constructor arguments as their
+TensorFlow counterparts, consume the same (indices, values) batches in `train`, minimize the same losses, and expose
+the factors (U, and V, W for the asymmetric decomposition) as plain numpy arrays.
+
+Every step computes the gradient of the batch loss with a sparse MTTKRP (gather the factor rows of every nonzero,
+multiply, and sum the contributions per row with a sparse matrix product), split over a thread pool. The update is
+Adam, applied lazily: only the rows that appear in the batch are updated (including their regularization gradient),
+which is what makes a step cost O(nnz * rank) instead of O(vocab * rank).
+'''
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import numpy as np
+import os
+import scipy.sparse
+import time
+
+from cp_evaluation import format_heldout, ReconstructionEvaluator
+from prefetch import Prefetcher
+
+
+def factor_value(factor, sess=None):
+    ''' The value of a factor matrix as a numpy array, whether it's a TF variable (evaluated in `sess`) or already an array '''
+    if isinstance(factor, np.ndarray):
+        return factor
+    return factor.eval(sess)
+
+
+def segment_sum(ids, data):
+    '''
+    Sums the rows of `data` that have the same id. Returns (unique ids, (len(unique ids), data.shape[1]) sums).
+    '''
+    unique_ids, inverse = np.unique(ids, return_inverse=True)
+    summer = scipy.sparse.csr_matrix(
+        (np.ones(len(ids), dtype=data.dtype), (inverse.ravel(), np.arange(len(ids)))),
+        shape=(len(unique_ids), len(ids)),
+    )
+    return unique_ids, summer.dot(data)
+
+
+def _chunk_predictions_and_grads(factors, indices, values, scale, relu=False):
+    '''
+    For one chunk of nonzeros: the summed squared error, and for every mode m the rows
+        scale * (pred - x) * prod_{m' != m} factors[m'][indices[:, m']]
+    i.e. the gradient of scale/2 * sum (pred - x)^2 wrt each gathered row of factors[m].
+    With `relu`, the model uses max(factors, 0), applied to the gathered rows only.
+    '''
+    ndims = indices.shape[1]
+    gathered = [factors[m][indices[:, m]] for m in range(ndims)]
+    if relu:
+        gathered = [np.maximum(rows, 0, out=rows) for rows in gathered]
+    # prefix[m] = product of the modes before m, suffix[m] = product of the modes after m
+    prefix = [None] * ndims
+    suffix = [None] * ndims
+    prod = np.ones_like(gathered[0])
+    for m in range(ndims):
+        prefix[m] = prod
+        prod = prod * gathered[m]
+    predictions = prod.sum(axis=1)
+    prod = np.ones_like(gathered[0])
+    for m in range(ndims - 1, -1, -1):
+        suffix[m] = prod
+        prod = prod * gathered[m]
+    errs = predictions - values
+    d_pred = (scale * errs)[:, None]
+    grads = [d_pred * prefix[m] * suffix[m] for m in range(ndims)]
+    return float(np.dot(errs, errs)), grads
+
+
+def sparse_cp_gradients(factors, indices, values, pool=None, num_chunks=1, relu=False):
+    '''
+    Mean squared error over the nonzeros (indices, values) of the CP model with the given (one per mode) factors,
+    and its gradient wrt the rows of each factor that appear in `indices`, as a list of (rows, grad_rows) per mode.
+    With `relu` the model's factors are max(factors, 0) and the gradient is wrt those (the caller applies the chain
+    rule), without ever computing the relu of the whole matrices.
+    With a thread `pool`, the nonzeros are split into `num_chunks` chunks that are processed in parallel.
+    '''
+    indices = np.asarray(indices, dtype=np.int64).reshape(-1, len(factors))
+    values = np.asarray(values, dtype=factors[0].dtype).ravel()
+    N = len(values)
+    if N == 0:
+        return 0.0, [(np.zeros(0, dtype=np.int64), np.zeros((0, A.shape[1]), dtype=A.dtype)) for A in factors]
+    scale = 2.0 / N  # d/dpred of mean((pred - x)^2)
+    bounds = np.linspace(0, N, min(num_chunks, N) + 1).astype(np.int64)
+    chunks = [(factors, indices[start:end], values[start:end], scale, relu) for start, end in zip(bounds[:-1], bounds[1:])]
+    if pool is not None and len(chunks) > 1:
+        results = list(pool.map(lambda args: _chunk_predictions_and_grads(*args), chunks))
+    else:
+        results = [_chunk_predictions_and_grads(*args) for args in chunks]
+    sq_err = sum(r[0] for r in results)
+    grads = []
+    for m in range(len(factors)):
+        grad_rows = np.concatenate([r[1][m] for r in results]) if len(results) > 1 else results[0][1][m]
+        grads.append(segment_sum(indices[:, m], grad_rows))
+    return sq_err / N, grads
+
+
+def combine_row_grads(row_grads):
+    ''' Sums a list of (rows, grad_rows) of the same matrix into one (unique rows, grad_rows) '''
+    rows = np.concatenate([r for r, _ in row_grads])
+    grads = np.concatenate([g for _, g in row_grads])
+    return segment_sum(rows, grads)
+
+
+class SparseAdam(object):
+    '''
+    Adam (same defaults as tf.train.AdamOptimizer) where a step only touches the given rows of the parameter matrix.
+    '''
+    def __init__(self, shape, learning_rate=1e-3, beta1=0.9, beta2=0.999, epsilon=1e-8, dtype=np.float32):
+        self.learning_rate = learning_rate
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.epsilon = epsilon
+        self.m = np.zeros(shape, dtype=dtype)
+        self.v = np.zeros(shape, dtype=dtype)
+        self.t = 0
+
+    def update(self, param, rows, grad):
+        self.t += 1
+        lr_t = self.learning_rate * np.sqrt(1 - self.beta2 ** self.t) / (1 - self.beta1 ** self.t)
+        m = self.beta1 * self.m[rows] + (1 - self.beta1) * grad
+        v = self.beta2 * self.v[rows] + (1 - self.beta2) * np.square(grad)
+        self.m[rows] = m
+        self.v[rows] = v
+        param[rows] -= lr_t * m / (np.sqrt(v) + self.epsilon)
+
+
+class _NumpyDecompBase(object):
+    '''
+    The training loop shared by the NumPy decompositions. Subclasses implement `batch_gradients` and `reg_loss`.
+    '''
+    def _setup_threads(self, num_threads):
+        self.num_threads = num_threads or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(max_workers=self.num_threads) if self.num_threads > 1 else None
+
+    def train_step(self, approx_tensor, print_every=10):
+        if not hasattr(self, 'prev_time'):
+            self.prev_time = time.time()
+        losses, param_grads = self.batch_gradients(approx_tensor)
+        for name, (rows, grad) in param_grads.items():
+            self.optimizers[name].update(getattr(self, name), rows, grad)
+        self.global_step += 1
+        step = self.global_step
+        if step % print_every == 0:
+            batch_time = (time.time() - self.prev_time) / print_every
+            errstring = '; '.join('{:.3f}'.format(x) for x in losses)
+            print("Err at step {}: {}; Reg loss: {:.3f} (lambda = {:.1E}) (Avg batch time: {:.3f})".format(
+                step, errstring, self.reg_loss(), self.reg_param, batch_time))
+            self.prev_time = time.time()
+        if self.checkpoint_every is not None and step % self.checkpoint_every == 0:
+            self.save(self.checkpoint_dir, step)
+        if self.heldout is not None and step % self.evaluate_every == 0:
+            evaluator = ReconstructionEvaluator(self.model_factors(), num_threads=self.num_threads)
+            print('Held-out error at step {}: {}'.format(step, format_heldout(evaluator, self.heldout)))
+
+    def save(self, dirname, step=None):
+        ''' Writes every factor to `dirname` as <name>.npy (<name>_<step>.npy if a step is given) '''
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        for name in self.factor_names:
+            suffix = '' if step is None else '_{}'.format(step)
+            np.save(os.path.join(dirname, '{}{}.npy'.format(name, suffix)), getattr(self, name))
+        print('Saved factors to {}'.format(dirname))
+
+    def train(self, expected_tensors, results_file=None, write_loss=True, checkpoint_every=None, prefetch_depth=4, print_every=10,
+              heldout=None, evaluate_every=1000):
+        '''
+        Assumes `expected_tensors` is a generator of sparse tensor values, just like the TF decompositions.
+        (`write_loss` is accepted for compatibility; there are no TF summaries to write.)
+        `heldout` is an (indices, values, is_nonzero) set from cp_evaluation.sample_heldout to report the error on
+        every `evaluate_every` steps. For the joint decomposition, it's a list of them, one per order in dimlist.
+        '''
+        self.heldout = heldout
+        self.evaluate_every = evaluate_every
+        self.checkpoint_every = checkpoint_every
+        if self.checkpoint_every is not None:
+            timestamp = str(datetime.datetime.now())
+            self.checkpoint_dir = os.path.abspath(os.path.join(os.path.curdir, 'numpy_logs', timestamp, 'checkpoints'))
+        if prefetch_depth > 0 and not isinstance(expected_tensors, Prefetcher):
+            expected_tensors = Prefetcher(expected_tensors, queue_depth=prefetch_depth)
+        self.batch_num = 0
+        t = time.time()
+        print('looping through batches ({} threads)...'.format(self.num_threads))
+        for expected_tensor in expected_tensors:
+            self.train_step(expected_tensor, print_every=print_every)
+            self.batch_num += 1
+        if results_file is not None and self.batch_num > 0:
+            print('avg batch time: {}'.format((time.time() - t) / self.batch_num), file=results_file)
+        if isinstance(expected_tensors, Prefetcher):
+            print(expected_tensors.report())
+        if self.checkpoint_every is not None:
+            self.save(self.checkpoint_dir)
+
+
+class NumpyCPDecomp(_NumpyDecompBase):
+    def __init__(self, shape, rank, sess=None, ndims=3, optimizer_type='adam', reg_param=1e-10, learning_rate=1e-3, num_threads=None, seed=None):
+        '''
+        Asymmetric CP decomposition X_ijk ~= sum_r U_ir V_jr W_kr, like tensor_decomp.CPDecomp with optimizer_type='adam'.
+        `sess` is ignored; it's only there so this is a drop-in replacement.
+        '''
+        if optimizer_type != 'adam':
+            raise ValueError('The numpy backend only implements adam. Got optimizer_type {}'.format(optimizer_type))
+        self.rank = rank
+        self.shape = shape
+        self.ndims = ndims
+        self.optimizer_type = optimizer_type
+        self.reg_param = reg_param
+        self.global_step = 0
+        self.checkpoint_every = None
+        self.heldout = None
+        rng = np.random.RandomState(seed)
+        self.factor_names = ['U', 'V', 'W'][:ndims]
+        for name, size in zip(self.factor_names, shape):
+            setattr(self, name, rng.uniform(-1.0, 1.0, size=(size, rank)).astype(np.float32))
+        self.optimizers = {name: SparseAdam(getattr(self, name).shape, learning_rate=learning_rate) for name in self.factor_names}
+        self._setup_threads(num_threads)
+
+    def factors(self):
+        return [getattr(self, name) for name in self.factor_names]
+
+    def model_factors(self):
+        return self.factors()
+
+    def batch_gradients(self, approx_tensor):
+        indices, values = approx_tensor
+        err, grads = sparse_cp_gradients(self.factors(), indices, values, pool=self.pool, num_chunks=self.num_threads)
+        param_grads = {}
+        for name, (rows, grad) in zip(self.factor_names, grads):
+            if self.reg_param > 0.0:
+                grad += .5 * self.reg_param * getattr(self, name)[rows]  # d/dA of (.5 * reg_param) * l2_loss(A)
+            param_grads[name] = (rows, grad)
+        return [err], param_grads
+
+    def reg_loss(self):
+        return .5 * self.reg_param * sum(.5 * np.sum(np.square(A)) for A in self.factors())
+
+
+class NumpySymmetricCPDecomp(_NumpyDecompBase):
+    def __init__(self, dim, rank, sess=None, ndims=3, optimizer_type='adam', reg_param=1e-10, nonneg=True, gpu=False, mean_value=None,
+                 learning_rate=1e-3, num_threads=None, seed=None):
+        '''
+        Symmetric CP decomposition X_ijk ~= sum_r U_ir U_jr U_kr, like tensor_decomp.SymmetricCPDecomp.
+        `sess` and `gpu` are ignored; they're only there so this is a drop-in replacement.
+        '''
+        self.rank = rank
+        self.shape = [dim] * ndims
+        self.ndims = ndims
+        self.optimizer_type = optimizer_type
+        self.nonneg = nonneg
+        self.reg_param = reg_param
+        self.mean_value = mean_value
+        self.global_step = 0
+        self.checkpoint_every = None
+        self.heldout = None
+        self.factor_names = ['U']
+        mu = 10.0 if self.mean_value is None else self.mean_value
+        mean = ((1. / self.rank) * mu) ** (1/self.ndims)
+        self.U = np.random.RandomState(seed).normal(mean, mean / 5, size=(dim, rank)).astype(np.float32)
+        self.optimizers = {'U': SparseAdam(self.U.shape, learning_rate=learning_rate)}
+        self._setup_threads(num_threads)
+
+    def effective_U(self):
+        return np.maximum(self.U, 0) if self.nonneg else self.U
+
+    def model_factors(self):
+        return self.effective_U()
+
+    def symmetric_gradients(self, indices, values, ndims):
+        '''
+        Error and (rows, gradient) wrt effective_U() for one batch of an order-`ndims` symmetric tensor (every mode
+        shares U). The relu is only applied to the rows in the batch, so a step stays O(nnz * rank)
+        '''
+        err, grads = sparse_cp_gradients([self.U] * ndims, indices, values, pool=self.pool, num_chunks=self.num_threads, relu=self.nonneg)
+        return err, combine_row_grads(grads)
+
+    def finish_gradient(self, rows, grad):
+        ''' Chain rule through the relu (if nonneg) plus the gradient of the regularizer, for the given rows '''
+        U_rows = self.U[rows]
+        if self.nonneg:
+            grad *= (U_rows > 0)
+        if self.reg_param > 0.0:
+            if self.nonneg:
+                grad += self.reg_param * (U_rows > 0)  # d/dU of reg_param * sum |relu(U)|
+            else:
+                grad += .5 * self.reg_param * U_rows  # d/dU of .5 * reg_param * l2_loss(U)
+        return rows, grad
+
+    def batch_gradients(self, approx_tensor):
+        indices, values = approx_tensor
+        err, (rows, grad) = self.symmetric_gradients(indices, values, self.ndims)
+        return [err], {'U': self.finish_gradient(rows, grad)}
+
+    def reg_loss(self):
+        if self.reg_param == 0.0:
+            return 0.0
+        U = self.effective_U()
+        if self.nonneg:
+            return self.reg_param * np.sum(np.abs(U))
+        return .5 * self.reg_param * .5 * np.sum(np.square(U))
+
+
+class NumpyJointSymmetricCPDecomp(NumpySymmetricCPDecomp):
+    def __init__(self, size, rank, sess=None, dimlist=[2,3], dimweights=[1., 1.], reg_param=1e-10, nonneg=True, gpu=False,
+                 learning_rate=1e-3, num_threads=None, seed=None):
+        '''
+        Jointly decomposes symmetric tensors of the orders in `dimlist` with one shared U, like
+        tensor_decomp.JointSymmetricCPDecomp. Batches are ([indices for each dim], [values for each dim]).
+        '''
+        assert len(dimlist) == len(dimweights)
+        self.dimlist = dimlist
+        self.dimweights = dimweights
+        self.rank = rank
+        self.nonneg = nonneg
+        self.reg_param = reg_param
+        self.global_step = 0
+        self.checkpoint_every = None
+        self.heldout = None
+        self.factor_names = ['U']
+        mu = 15.0
+        mean = ((1. / self.rank) * mu) ** (1/2)
+        self.U = np.random.RandomState(seed).normal(mean, mean / 5, size=(size, rank)).astype(np.float32)
+        self.optimizers = {'U': SparseAdam(self.U.shape, learning_rate=learning_rate)}
+        self._setup_threads(num_threads)
+
+    def batch_gradients(self, approx_tensor):
+        approx_indices, approx_values = approx_tensor
+        errs = []
+        row_grads = []
+        for dim, weight, indices, values in zip(self.dimlist, self.dimweights, approx_indices, approx_values):
+            err, (rows, grad) = self.symmetric_gradients(indices, values, dim)
+            errs.append(weight * err)
+            row_grads.append((rows, weight * grad))
+        return errs, {'U': self.finish_gradient(*combine_row_grads(row_grads))}
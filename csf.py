@@ -0,0 +1,187 @@
+'''
+Compressed sparse fiber (CSF) storage for the sparse PMI tensors, and an MTTKRP kernel over it.
+
+A CSF tensor is a tree: level 0 holds the distinct indices of the first mode (in `mode_order`), level 1 the distinct
+(first, second) prefixes under each of them, and so on down to the nonzeros at the last level. MTTKRP over the tree
+only multiplies in the factor row of a shared prefix once per fiber instead of once per nonzero, and the subtrees
+under different roots are independent, so they're processed in parallel.
+
+The gain is modest on PMI tensors, whose prefixes are shared by few nonzeros: `benchmarks.py csf_mttkrp` (10k word
+vocab, rank 300, 0.7M 3-way and 1.4M 4-way nonzeros, 1 CPU) measures 1.5-1.7x over coo_mttkrp for the modes of the
+upper levels, and only 1.1x for the mode of the leaf level, which has one node per nonzero.
+'''
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import os
+import scipy.sparse
+
+from cp_numpy import segment_sum
+
+
+def coo_mttkrp(indices, values, factors, mode):
+    '''
+    Reference MTTKRP straight from the COO (indices, values): row i of the result is
+        sum over nonzeros x with x's mode-`mode` index == i of  x * prod_{m != mode} factors[m][index_m]
+    '''
+    indices = np.asarray(indices)
+    prod = np.asarray(values, dtype=factors[0].dtype)[:, None]
+    for m, A in enumerate(factors):
+        if m != mode:
+            prod = prod * A[indices[:, m]]
+    out = np.zeros((len(factors[mode]), factors[0].shape[1]), dtype=factors[0].dtype)
+    rows, sums = segment_sum(indices[:, mode], prod)
+    out[rows] = sums
+    return out
+
+
+def sum_children(rows, ptr):
+    '''
+    Sums the consecutive runs rows[ptr[i]:ptr[i+1]] (e.g. the children of every node of a level).
+    Same as np.add.reduceat(rows, ptr[:-1], axis=0), but as a CSR product, which is much faster for wide rows.
+    '''
+    summer = scipy.sparse.csr_matrix(
+        (np.ones(ptr[-1], dtype=rows.dtype), np.arange(ptr[-1]), ptr),
+        shape=(len(ptr) - 1, len(rows)),
+    )
+    return summer.dot(rows)
+
+
+class CSFTensor(object):
+    def __init__(self, indices, values, shape=None, mode_order=None):
+        '''
+        Builds the tree from the (N, ndims) `indices` and (N,) `values`, e.g. the output of PMIGatherer.create_pmi_tensor.
+        Entries are assumed to be distinct. `mode_order` is the order of the modes from the root level down; by default
+        the modes with the fewest distinct indices come first, which compresses the most.
+        '''
+        indices = np.asarray(indices, dtype=np.int64)
+        values = np.atleast_1d(values)
+        if indices.ndim == 1:  # create_pmi_tensor squeezes a single entry down to 1 dimension
+            indices = indices.reshape(1, -1)
+        self.ndims = indices.shape[1]
+        if shape is None:
+            shape = tuple(int(indices[:, m].max()) + 1 if len(indices) else 0 for m in range(self.ndims))
+        self.shape = tuple(shape)
+        if mode_order is None:
+            mode_order = sorted(range(self.ndims), key=lambda m: len(np.unique(indices[:, m])))
+        self.mode_order = list(mode_order)
+
+        ordered = indices[:, self.mode_order]
+        perm = np.lexsort(ordered.T[::-1])  # lexsort sorts by the last key first
+        ordered = ordered[perm]
+        self.values = values[perm]
+
+        # starts[l] = positions (in the sorted nonzeros) where the length-(l+1) prefix changes, i.e. the nodes of level l
+        N = len(ordered)
+        changed = np.zeros(N, dtype=bool)
+        if N:
+            changed[0] = True
+        starts = []
+        for level in range(self.ndims):
+            if level < self.ndims - 1:
+                changed[1:] |= ordered[1:, level] != ordered[:-1, level]
+                starts.append(np.flatnonzero(changed))
+            else:
+                starts.append(np.arange(N))
+        # fids[l] = the index of every node of level l. fptr[l] = where the children of every node of level l start in
+        # level l+1 (with one extra entry at the end), so node i's children are fptr[l][i]:fptr[l][i+1]
+        self.fids = [ordered[starts[level], level] for level in range(self.ndims)]
+        self.fptr = [
+            np.append(np.searchsorted(starts[level + 1], starts[level]), len(starts[level + 1]))
+            for level in range(self.ndims - 1)
+        ]
+
+    @property
+    def nnz(self):
+        return len(self.values)
+
+    def num_nodes(self):
+        return [len(fids) for fids in self.fids]
+
+    def _slice_ranges(self, root_start, root_end):
+        ''' The (start, end) node range at every level of the subtrees under roots root_start:root_end '''
+        ranges = [(root_start, root_end)]
+        for level in range(self.ndims - 1):
+            start, end = ranges[-1]
+            ranges.append((self.fptr[level][start], self.fptr[level][end]))
+        return ranges
+
+    def _child_counts(self, level, ranges):
+        ''' Number of children of every node of `level` in the slice, and their offsets relative to the slice (plus the end) '''
+        start, end = ranges[level]
+        ptr = self.fptr[level][start:end + 1] - self.fptr[level][start]
+        return np.diff(ptr), ptr
+
+    def _mttkrp_slice(self, factors, out_level, ranges):
+        ''' (rows, contributions) of one slice of root subtrees to the MTTKRP of the mode at `out_level` '''
+        mode_order = self.mode_order
+        last = self.ndims - 1
+        # product of the factor rows of the levels above out_level, one row per node of level out_level - 1
+        prefix = None
+        for level in range(out_level):
+            start, end = ranges[level]
+            rows = factors[mode_order[level]][self.fids[level][start:end]]
+            if prefix is None:
+                prefix = rows
+            else:
+                prefix = np.repeat(prefix, self._child_counts(level - 1, ranges)[0], axis=0) * rows
+        # sum over the subtrees below out_level, one row per node of out_level
+        start, end = ranges[last]
+        below = self.values[start:end, None].astype(factors[0].dtype)
+        if out_level < last:
+            below = below * factors[mode_order[last]][self.fids[last][start:end]]
+        for level in range(last - 1, out_level - 1, -1):
+            below = sum_children(below, self._child_counts(level, ranges)[1])
+            if level > out_level:
+                start, end = ranges[level]
+                below *= factors[mode_order[level]][self.fids[level][start:end]]
+        if prefix is not None:
+            below = below * np.repeat(prefix, self._child_counts(out_level - 1, ranges)[0], axis=0)
+        start, end = ranges[out_level]
+        return self.fids[out_level][start:end], below
+
+    def root_slices(self, chunk_nnz):
+        ''' Splits the roots into contiguous slices of about `chunk_nnz` nonzeros each '''
+        num_roots = len(self.fids[0])
+        if num_roots == 0:
+            return []
+        # nonzeros under the first i roots
+        leaf_ptr = np.arange(num_roots + 1)
+        for level in range(self.ndims - 1):
+            leaf_ptr = self.fptr[level][leaf_ptr]
+        bounds = np.searchsorted(leaf_ptr, np.arange(0, self.nnz, max(1, int(chunk_nnz))), side='right') - 1
+        bounds = np.unique(np.append(bounds, num_roots))
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def mttkrp(self, factors, mode, num_threads=None, chunk_nnz=int(1e5)):
+        '''
+        Matricized tensor times Khatri-Rao product for `mode` (same result as coo_mttkrp), with one factor matrix per
+        mode in `factors` (factors[mode] itself is only used for its shape). The root slices, each with about
+        `chunk_nnz` nonzeros, are processed by `num_threads` threads.
+        '''
+        out_level = self.mode_order.index(mode)
+        rank = factors[0].shape[1]
+        out = np.zeros((self.shape[mode], rank), dtype=factors[0].dtype)
+        slices = self.root_slices(chunk_nnz)
+        work = lambda bounds: self._mttkrp_slice(factors, out_level, self._slice_ranges(*bounds))
+        num_threads = num_threads or os.cpu_count() or 1
+        if num_threads > 1 and len(slices) > 1:
+            with ThreadPoolExecutor(max_workers=num_threads) as pool:
+                results = list(pool.map(work, slices))
+        else:
+            results = [work(bounds) for bounds in slices]
+        if out_level == 0:
+            # every root is in exactly one slice
+            for rows, contributions in results:
+                out[rows] = contributions
+        elif results:
+            rows, sums = segment_sum(np.concatenate([r for r, _ in results]), np.concatenate([c for _, c in results]))
+            out[rows] = sums
+        return out
+
+    def symmetric_mttkrp(self, U, num_threads=None, chunk_nnz=int(1e5)):
+        '''
+        sum over modes of mttkrp([U] * ndims, mode): the gradient direction of a symmetric CP model that's fed only
+        the sorted indices of each entry, as in SymmetricCPDecomp.
+        '''
+        factors = [U] * self.ndims
+        return sum(self.mttkrp(factors, mode, num_threads=num_threads, chunk_nnz=chunk_nnz) for mode in range(self.ndims))
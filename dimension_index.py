@@ -0,0 +1,39 @@
+'''
+Column-wise sort of an embedding matrix, for interpretability queries about single dimensions ("which words are
+highest in dimension d", "is this word in the top 10% of any dimension") without rescanning the vocab every time.
+'''
+import numpy as np
+
+
+class DimensionIndex(object):
+    def __init__(self, matrix):
+        '''
+        Sorts every column of the (|V|, d) `matrix` once (O(d |V| log |V|)). Afterwards
+            order[dim]     the rows by decreasing value in `dim` (ties: lower row first, nan last)
+            ranks[row]     the position of `row` in order[dim] for every dim
+        so top/bottom k queries are O(k) slices and rank queries are O(1).
+        '''
+        matrix = np.asarray(matrix)
+        self.num_rows, self.dim = matrix.shape
+        index_dtype = np.int32 if self.num_rows < 2 ** 31 else np.int64
+        order = np.empty((self.dim, self.num_rows), dtype=index_dtype)
+        for dim in range(self.dim):  # column by column, so the temporaries stay O(|V|)
+            order[dim] = np.argsort(-matrix[:, dim], kind='stable')
+        self.order = order
+        self.ranks = np.empty((self.num_rows, self.dim), dtype=index_dtype)
+        self.ranks[order, np.arange(self.dim)[:, None]] = np.arange(self.num_rows, dtype=index_dtype)
+
+    def top(self, dim, k, exclude=()):
+        ''' The rows with the k highest values in `dim`, highest first, skipping the rows in `exclude` '''
+        rows = self.order[dim, :k + len(exclude)]
+        if len(exclude):
+            rows = rows[~np.isin(rows, list(exclude))]
+        return rows[:k]
+
+    def bottom(self, dim, k):
+        ''' The rows with the k lowest values in `dim`, lowest last '''
+        return self.order[dim, self.num_rows - k:]
+
+    def in_top(self, rows, k):
+        ''' (len(rows), d) bool: whether each row is among the k highest of each dimension '''
+        return self.ranks[rows] < k
@@ -37,7 +37,7 @@ parser.add_option("-f", "--file", dest="filename",
                   default=None)
 
 parser.add_option("-p", "--format", dest="format",
-                  help="Format of the embedding, possible values are: word2vec, word2vec_bin, dict and glove.",
+                  help="Format of the embedding, possible values are: word2vec, word2vec_bin, dict, glove and npy.",
                   default=None)
 
 parser.add_option("-o", "--output", dest="output",
@@ -70,8 +70,10 @@ if __name__ == "__main__":
                 format = "word2vec"
             elif ext == ".pkl":
                 format = "dict"
+            elif ext == ".npy":
+                format = "npy"
 
-        assert format in ['word2vec_bin', 'word2vec', 'glove', 'bin'], "Unrecognized format"
+        assert format in ['word2vec_bin', 'word2vec', 'glove', 'bin', 'npy'], "Unrecognized format"
 
         load_kwargs = {}
         if format == "glove":
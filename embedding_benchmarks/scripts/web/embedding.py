@@ -6,6 +6,7 @@ NOTE: This file was adapted from the polyglot package
 
 import logging
 import numpy as np
+from os import path
 
 from six import text_type
 from six import PY2
@@ -149,7 +150,7 @@ class Embedding(object):
         return Embedding(vectors=vectors.T, vocabulary=self.vocabulary)
 
 
-    def nearest_neighbors(self, word, k=1, exclude=[], metric="cosine"):
+    def nearest_neighbors(self, word, k=1, exclude=[], metric="cosine", indexer=None):
         """
         Find nearest neighbor of given word
 
@@ -167,6 +168,11 @@ class Embedding(object):
           exclude: list, default: []
             Words to omit in answer
 
+          indexer: object, default: None
+            Approximate nearest neighbor index over self.vectors (same row order), e.g. ann_index.IVFIndex.
+            If given, its search(queries, k, exclude=ids) is used instead of the exact scan, and `metric`
+            is the one the index was built with.
+
         Returns
         -------
           n: list
@@ -178,6 +184,13 @@ class Embedding(object):
         else:
             v = word
 
+        if indexer is not None:
+            excluded = [self.vocabulary.word_id[w] for w in exclude]
+            if isinstance(word, string_types):
+                excluded.append(self.vocabulary.word_id[word])
+            ids, _ = indexer.search(v.reshape(1, -1), k, exclude=np.array(excluded, dtype=np.int64).reshape(1, -1))
+            return [self.vocabulary.id_word[id] for id in ids[0] if id >= 0]
+
         D = pairwise_distances(self.vectors, v.reshape(1, -1), metric=metric)
 
         if isinstance(word, string_types):
@@ -186,7 +199,9 @@ class Embedding(object):
         for w in exclude:
             D[self.vocabulary.word_id[w]] = D.max()
 
-        return [self.vocabulary.id_word[id] for id in D.argsort(axis=0).flatten()[0:k]]
+        D = D.flatten()
+        top = np.argpartition(D, k - 1)[:k] if k < len(D) else np.arange(len(D))
+        return [self.vocabulary.id_word[id] for id in top[np.argsort(D[top])]]
 
     @staticmethod
     def from_gensim(model):
@@ -220,21 +235,22 @@ class Embedding(object):
             logger.info("Loading #{} words with {} dim".format(vocab_size, layer1_size))
             vectors = np.zeros((vocab_size, layer1_size), dtype=np.float32)
             binary_len = np.dtype("float32").itemsize * layer1_size
+            # read everything at once and slice it, instead of reading the words byte by byte
+            data = fin.read()
+            pos = 0
             for line_no in range(vocab_size):
-                # mixed text and binary: read text first, then binary
-                word = []
-                while True:
-                    ch = fin.read(1)
-                    if ch == b' ':
-                        break
-                    if ch != b'\n':  # ignore newlines in front of words (some binary files have newline, some don't)
-                        word.append(ch)
-
-                words.append(b''.join(word).decode("latin-1"))
-                vectors[line_no, :] = np.fromstring(fin.read(binary_len), dtype=np.float32)
+                # mixed text and binary: the word up to a space, then the vector
+                end = data.find(b' ', pos)
+                if end == -1 or end + 1 + binary_len > len(data):
+                    break
+                # ignore newlines in front of words (some binary files have newline, some don't)
+                words.append(data[pos:end].lstrip(b'\n').decode("latin-1"))
+                vectors[line_no, :] = np.frombuffer(data, dtype=np.float32, count=layer1_size, offset=end + 1)
+                pos = end + 1 + binary_len
 
             if len(words) < vocab_size:
                 logger.warning("Omitted {} words".format(vocab_size - len(words)))
+                vectors = vectors[0:len(words)]
             elif len(words) > vocab_size:
                 raise RuntimeError("Read too many words, incorrect file")
 
@@ -370,6 +386,22 @@ class Embedding(object):
 
         return e
 
+    @staticmethod
+    def from_npy(fname, fvocab=None, mmap_mode=None):
+        """
+        Load a float32 matrix saved with np.save, with the words (one per line, in row order) in `fvocab`,
+        by default `fname` with the extension replaced by .vocab. With `mmap_mode` the matrix isn't read into RAM.
+        """
+        if fvocab is None:
+            fvocab = path.splitext(fname)[0] + '.vocab'
+        with _open(fvocab, 'rb') as fin:
+            words = fin.read().decode('utf-8').split('\n')[:-1]
+        logger.info("loading projection weights from %s" % (fname))
+        vectors = np.load(fname, mmap_mode=mmap_mode)
+        if len(words) != len(set(words)):
+            raise RuntimeError("Vocabulary has duplicates")
+        return Embedding(vocabulary=OrderedVocabulary(words=words), vectors=vectors)
+
     @staticmethod
     def load(fname):
         """Load an embedding dump generated by `save`"""
@@ -1,13 +1,15 @@
 import dill
 from embedding_benchmarks.scripts.web.embeddings import load_embedding
 from embedding_benchmarks.scripts.web.evaluate import evaluate_on_all
-import heapq
 import numpy as np
 import pandas as pd
 import random
 import sys
 
+from ann_index import IVFIndex
+from benchmark_runner import BenchmarkRunner, Job
 from embedding_evaluation import EmbeddingTaskEvaluator, evaluate_vectors_from_path
+from retrieval import top_k_of_scores
 
 class EmbeddingComparison(object):
     def __init__(self, num_sents, min_count, methods, comparison_name, embedding_dim=None, embedding_dim_list=None, normalize=True):
@@ -16,7 +18,6 @@ class EmbeddingComparison(object):
         `num_sents`, `embedding_dim`, and `min_count` are passed in uniformly for a more fair comparison (we should be evaluating on the exact same test suite, the
             vocabulary of which is determined by those parameters)
         '''
-        self.evaluators = []
         num_sents = int(num_sents)
         min_count = int(min_count)
         if embedding_dim is not None:
@@ -26,14 +27,34 @@ class EmbeddingComparison(object):
         self.min_count = min_count
         self.embedding_dim_list = embedding_dim_list
         self.comparison_name = comparison_name
+        self.normalize = normalize
 
         diff_dims = len(set(embedding_dim_list)) != 1  # if we are comparing embeddings of multiple dimensions, add the dimension to the method (for keeping track)
+        self.methods = []
+        self.fnames = []
         for method, dim in zip(methods, embedding_dim_list):
-            fname = 'runs/{method}/{num_sents}_{min_count}_{dim}/vectors.txt'.format(**locals())
+            self.fnames.append('runs/{method}/{num_sents}_{min_count}_{dim}/vectors.txt'.format(**locals()))
             if diff_dims:
                 method += '_{}'.format(dim)
-            self.evaluators.append(EmbeddingTaskEvaluator(method=method, fname=fname, normalize_vects=normalize))
-        self.vocab_set = set(self.evaluators[0].embedding_dict.keys())
+            self.methods.append(method)
+        self._evaluators = None
+
+    @property
+    def evaluators(self):
+        '''
+        One EmbeddingTaskEvaluator per method, loaded on first use. compare_all doesn't need them (its BenchmarkRunner
+        workers load their own copies), so a fully cached comparison never parses the vectors files.
+        '''
+        if self._evaluators is None:
+            self._evaluators = [
+                EmbeddingTaskEvaluator(method=method, fname=fname, normalize_vects=self.normalize)
+                for (method, fname) in zip(self.methods, self.fnames)
+            ]
+        return self._evaluators
+
+    @property
+    def vocab_set(self):
+        return set(self.evaluators[0].embedding_dict.keys())
 
     def print_method(self, method):
         print()
@@ -47,41 +68,55 @@ class EmbeddingComparison(object):
         '''
         for evaluator in self.evaluators:
             self.print_method(evaluator.method)
+            dim_index = evaluator.get_dimension_index()
+            ordered_words = evaluator.embedding_dict.words
             for word in words:
                 vec = evaluator.embedding_dict[word]
                 k = 4
                 n = 4
                 top_n_dims = vec.argsort()[-n:][::-1]
                 print('Word: {}'.format(word))
+                row = evaluator.embedding_dict.word_index[word]
                 for i in range(n):
-                    print('top words in dimension {}: {}'.format(top_n_dims[i], ','.join([w for (w,v) in heapq.nlargest(k+1, evaluator.embedding_dict.items(), key=lambda x: x[1][top_n_dims[i]]) if w != word][:k])))
+                    top_words = [ordered_words[r] for r in dim_index.top(top_n_dims[i], k, exclude=[row])]
+                    print('top words in dimension {}: {}'.format(top_n_dims[i], ','.join(top_words)))
 
-    def compare_nearest_neighbors(self, words):
+    def build_indexes(self, **kwargs):
+        '''
+        One approximate nearest neighbor index (ann_index.IVFIndex, cosine) per evaluator, for compare_nearest_neighbors.
+        kwargs go to IVFIndex.build (num_lists, nprobe, ...)
+        '''
+        return [IVFIndex.from_word_vectors(evaluator.embedding_dict, **kwargs) for evaluator in self.evaluators]
+
+    def compare_nearest_neighbors(self, words, indexers=None):
         print("\n==================================")
         '''
         Qualitative evaluation. Prints the nearest vectors to each word in `words`
         `words` is a list of strings
+        `indexers` is an optional list of approximate nearest neighbor indexes, one per evaluator (see build_indexes).
+            Without them the exact cosine similarities to the whole vocab are computed
         '''
-        def closest_neighbors(evaluator, word, n=5):
+        def closest_neighbors(evaluator, word, norms, indexer, n=5):
             embedding_dict = evaluator.embedding_dict
-            cos_sims = []
             if word not in embedding_dict:
                 print('{} not in vocab'.format(word))
                 return []
-            vec = embedding_dict[word]
-            for word2, vec2 in embedding_dict.items():
-                if word == word2:
-                    continue
-                cos_sim = np.dot(vec, vec2) / (np.linalg.norm(vec) * np.linalg.norm(vec2))
-                cos_sims.append((cos_sim, word2))
-            nlargest = heapq.nlargest(n, cos_sims)
-            nlargest = [word for (sim, word) in nlargest]
-            return nlargest
+            row = embedding_dict.word_index[word]
+            vec = embedding_dict.matrix[row]
+            if indexer is not None:
+                ids, _ = indexer.search(vec, k=n, exclude=[[row]])
+            else:
+                cos_sims = np.dot(embedding_dict.matrix, vec) / (norms * np.linalg.norm(vec))
+                cos_sims[row] = -np.inf
+                ids, _ = top_k_of_scores(cos_sims[None, :], n)
+            return [embedding_dict.words[i] for i in ids[0] if i >= 0]
 
-        for evaluator in self.evaluators:
+        for i, evaluator in enumerate(self.evaluators):
             self.print_method(evaluator.method)
+            indexer = indexers[i] if indexers is not None else None
+            norms = np.linalg.norm(evaluator.embedding_matrix, axis=1) if indexer is None else None
             for word in words:
-                nlargest = closest_neighbors(evaluator, word)
+                nlargest = closest_neighbors(evaluator, word, norms, indexer)
                 if not nlargest:
                     continue
                 print('Closest words to {}: {}'.format(word, ', '.join(nlargest)))
@@ -124,14 +159,14 @@ class EmbeddingComparison(object):
             score_dict[method] = score
         return score_dict
 
-    def compare_analogy(self, train_pct):
+    def compare_analogy(self, train_pct, solver='adam'):
         print("\n==================================")
         # TODO: multithread this
         sem_dict = {}
         syn_dict = {}
         for evaluator in self.evaluators:
             self.print_method(evaluator.method)
-            (sem_score, syn_score) = evaluator.analogy_tasks(train_pct=train_pct)
+            (sem_score, syn_score) = evaluator.analogy_tasks(train_pct=train_pct, solver=solver)
             print("Analogy sem/syn scores: {}".format((sem_score, syn_score)))
             method = evaluator.method
             sem_dict[method] = sem_score
@@ -153,121 +188,93 @@ class EmbeddingComparison(object):
             acc_dict[method] = accuracy / 100.0
         return opp_dict, acc_dict
 
-    def compare_coherency(self, n):
+    def compare_coherency(self, n, all_dims=False):
+        '''
+        Prints the top `n` words of a random dimension of every embedding, plus an outlier for it (a word in the bottom
+        half of the dimension that is in the top 10% of another one). With `all_dims`, does it for every dimension.
+        '''
         def get_outlier(evaluator, dim): 
             ''' Returns a word in the bottom half of this dimension that is also in the top 10% of another dimension. '''
-            embedding_dict = evaluator.embedding_dict
-            num_words = len(embedding_dict)
-            dim_values = []
-            for word, vec in embedding_dict.items():
-                dim_values.append((vec[dim], word))
-            bottom_n = heapq.nlargest(num_words // 2, dim_values, key=lambda x: -x[0])  # bottom n words
-            while True:
-                rand_word = random.choice(bottom_n)[1]
-                for dim in range(evaluator.embedding_dim):
-                    dim_values = []
-                    for word, vec in embedding_dict.items():
-                        dim_values.append((vec[dim], word))
-                    top_10pct_for_dim = heapq.nlargest(num_words // 10, dim_values)
-                    if rand_word in [word for (val, word) in top_10pct_for_dim]:
-                        return rand_word
+            dim_index = evaluator.get_dimension_index()
+            num_words = len(evaluator.embedding_dict)
+            bottom_n = dim_index.bottom(dim, num_words // 2)  # bottom n words
+            candidates = bottom_n[dim_index.in_top(bottom_n, num_words // 10).any(axis=1)]
+            if len(candidates) == 0:
+                return None
+            return evaluator.embedding_dict.words[random.choice(candidates)]
             
         def top_n_words_for_dim(evaluator, dim, n=5):
-            embedding_dict = evaluator.embedding_dict
-            dim_values = []
-            for word, vec in embedding_dict.items():
-                dim_values.append((vec[dim], word))
-            topn = heapq.nlargest(n, dim_values)
-            return [word for (val, word) in topn]
+            ordered_words = evaluator.embedding_dict.words
+            return [ordered_words[r] for r in evaluator.get_dimension_index().top(dim, n)]
 
         for evaluator in self.evaluators:
-            rand_dim = np.random.randint(0, evaluator.embedding_dim)
             self.print_method(evaluator.method)
-            print("Highest words in dim {}: {}, with outlier '{}'".format(
-                rand_dim,
-                top_n_words_for_dim(evaluator, rand_dim, n=n),
-                get_outlier(evaluator, rand_dim),
-            ))
-
-    def compare_all(self, num_runs=1):
-        all_dfs = []  # allow for random resets
-        for run_index in range(num_runs):
-            for evaluator in self.evaluators:
-                evaluator.seed_bump = run_index
-
-            # qualitative
-            #self.compare_coherency(n=3)
-            #words = random.sample(list(self.vocab_set), 5)
-            #self.compare_nearest_neighbors(words)
-            #self.compare_word_dimensions(words)
-
-            # quantitative
-            # this should be fastest to slowest
-            sentiment_analysis_10_results = self.compare_sentiment_analysis(train_pct=.1)
-            sentiment_analysis_30_results = self.compare_sentiment_analysis(train_pct=.3)
-            sentiment_analysis_50_results = self.compare_sentiment_analysis(train_pct=.5)
-            sentiment_analysis_results = self.compare_sentiment_analysis()
-
-            '''
-            word_class_10_results = self.compare_word_classification(train_pct=.1)
-            word_class_30_results = self.compare_word_classification(train_pct=.3)
-            word_class_50_results = self.compare_word_classification(train_pct=.5)
-            word_class_results = self.compare_word_classification(train_pct=1.0)
-
-            outlier_det2_opps, outlier_det2_accs = self.compare_outlier_detection(n=2)
-            outlier_det3_opps, outlier_det3_accs = self.compare_outlier_detection(n=3)
-
-            analogy_sem_results_10, analogy_syn_results_10 = self.compare_analogy(.1)
-            analogy_sem_results_30, analogy_syn_results_30 = self.compare_analogy(.3)
-            analogy_sem_results_50, analogy_syn_results_50 = self.compare_analogy(.5)
-            analogy_sem_results, analogy_syn_results = self.compare_analogy(1.0)
-
-                (analogy_sem_results_10, 'Analogy 10% (sem)'),
-                (analogy_sem_results_30, 'Analogy 30% (sem)'),
-                (analogy_sem_results_50, 'Analogy 50% (sem)'),
-                (analogy_sem_results, 'Analogy 100% (sem)'),
-
-                (analogy_syn_results_10, 'Analogy 10% (syn)'),
-                (analogy_syn_results_30, 'Analogy 30% (syn)'),
-                (analogy_syn_results_50, 'Analogy 50% (syn)'),
-                (analogy_syn_results, 'Analogy 100% (syn)'),
-            '''
-
-            result_name_pairs = [
-                (sentiment_analysis_10_results, 'Sentiment analysis (10%)'), 
-                (sentiment_analysis_30_results, 'Sentiment analysis (30%)'), 
-                (sentiment_analysis_50_results, 'Sentiment analysis (50%)'), 
-                (sentiment_analysis_results, 'Sentiment analysis (100%)'), 
-            ]
-
-            '''
-                (word_class_10_results, 'PoS classification (10%)'), 
-                (word_class_30_results, 'PoS classification (30%)'), 
-                (word_class_50_results, 'PoS classification (50%)'), 
-                (word_class_results, 'PoS classification (100%)'), 
-
-                (outlier_det2_opps, 'OD2 OPP'), 
-                (outlier_det2_accs, 'OD2 acc'), 
-                (outlier_det3_opps, 'OD3 OPP'), 
-                (outlier_det3_accs, 'OD3 acc'), 
-            '''
-            df = pd.DataFrame([ d for (d, name) in result_name_pairs ])
-            df.index = [ name for (d, name) in result_name_pairs ]
-            df = df.transpose()
+            dims = range(evaluator.embedding_dim) if all_dims else [np.random.randint(0, evaluator.embedding_dim)]
+            for dim in dims:
+                print("Highest words in dim {}: {}, with outlier '{}'".format(
+                    dim,
+                    top_n_words_for_dim(evaluator, dim, n=n),
+                    get_outlier(evaluator, dim),
+                ))
+
+    def compare_all(self, num_runs=1, processes=None, cache_dir='benchmark_cache'):
+        '''
+        Runs every task of `columns` for every method with the seeds 0 .. num_runs-1 as jobs of a BenchmarkRunner (over
+        `processes` worker processes, reusing the results cached in `cache_dir` for vectors files that haven't changed),
+        and writes the scores averaged over the runs to an excel file.
+        '''
+        # qualitative
+        #self.compare_coherency(n=3)
+        #words = random.sample(list(self.vocab_set), 5)
+        #self.compare_nearest_neighbors(words)
+        #self.compare_word_dimensions(words)
+
+        # quantitative: (task, params, score, column name)
+        columns = [
+            ('sentiment', {'train_pct': .1}, 'score', 'Sentiment analysis (10%)'),
+            ('sentiment', {'train_pct': .3}, 'score', 'Sentiment analysis (30%)'),
+            ('sentiment', {'train_pct': .5}, 'score', 'Sentiment analysis (50%)'),
+            ('sentiment', {'train_pct': 1.0}, 'score', 'Sentiment analysis (100%)'),
+        ]
 
-            if False:
-                web_results = self.compare_web()
-                all_df = web_results.join(df)
-                all_df = all_df.transpose()  # excel likes it better this way
-            else:
-                all_df = df.transpose()
+        '''
+            ('word_classification', {'train_pct': .1}, 'score', 'PoS classification (10%)'),
+            ('word_classification', {'train_pct': .3}, 'score', 'PoS classification (30%)'),
+            ('word_classification', {'train_pct': .5}, 'score', 'PoS classification (50%)'),
+            ('word_classification', {'train_pct': 1.0}, 'score', 'PoS classification (100%)'),
+
+            ('outlier_detection', {'n': 2}, 'opp', 'OD2 OPP'),
+            ('outlier_detection', {'n': 2}, 'acc', 'OD2 acc'),
+            ('outlier_detection', {'n': 3}, 'opp', 'OD3 OPP'),
+            ('outlier_detection', {'n': 3}, 'acc', 'OD3 acc'),
+
+            ('analogy', {'train_pct': .1}, 'sem', 'Analogy 10% (sem)'),
+            ('analogy', {'train_pct': .3}, 'sem', 'Analogy 30% (sem)'),
+            ('analogy', {'train_pct': .5}, 'sem', 'Analogy 50% (sem)'),
+            ('analogy', {'train_pct': 1.0}, 'sem', 'Analogy 100% (sem)'),
+
+            ('analogy', {'train_pct': .1}, 'syn', 'Analogy 10% (syn)'),
+            ('analogy', {'train_pct': .3}, 'syn', 'Analogy 30% (syn)'),
+            ('analogy', {'train_pct': .5}, 'syn', 'Analogy 50% (syn)'),
+            ('analogy', {'train_pct': 1.0}, 'syn', 'Analogy 100% (syn)'),
+        '''
 
-            all_dfs.append(all_df)
+        methods = self.methods
+        runner = BenchmarkRunner(list(zip(self.methods, self.fnames)), cache_dir=cache_dir, processes=processes, normalize=self.normalize)
+        jobs = [Job(method, task, params, seed) for seed in range(num_runs) for (task, params, _, _) in columns for method in methods]
+        results = runner.run(jobs)
+        avg_df = pd.DataFrame(
+            [[np.mean([results[Job(method, task, params, seed)][score] for seed in range(num_runs)]) for method in methods]
+             for (task, params, score, _) in columns],
+            index=[name for (_, _, _, name) in columns],
+            columns=methods,
+        )
+
+        if False:
+            web_results = self.compare_web()
+            avg_df = web_results.join(avg_df.transpose())
+            avg_df = avg_df.transpose()  # excel likes it better this way
 
-        df_sum = all_dfs[0]
-        for df in all_dfs[1:]:
-            df_sum += df
-        avg_df = (1. / num_runs) * df_sum
         # write to excel file
         excel_fname = 'comparison_{}_{}_{}.xlsx'.format(self.num_sents, self.min_count, self.comparison_name)
         writer = pd.ExcelWriter(excel_fname)
@@ -279,7 +286,6 @@ class EmbeddingComparison(object):
 
         return avg_df
 
-
 if __name__ == '__main__':
     if len(sys.argv) == 1:
         raise ValueError('Please specify the name of the comparison')
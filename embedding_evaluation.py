@@ -1,41 +1,22 @@
+import analogy_mapping
 import numpy as np
 import random
 import os
+import retrieval
 import sklearn
 import sys
-import tensorflow as tf
 import time
 
+from dimension_index import DimensionIndex
+from embedding_io import WordVectors, embedding_format, write_model_embedding
 from functools import lru_cache
 from sklearn.linear_model import LogisticRegression
 from sklearn.neural_network import MLPClassifier
 
 
 def write_embedding_to_file(embedding, model, fname='vectors.txt'):
-    vectors = {}
-    for word in model.vocab:
-        word_vocab = model.vocab[word]
-        word_vect = embedding[word_vocab.index]
-        vect_list = ['{:.7f}'.format(x) for x in word_vect]
-        vectors[word] = ' '.join(vect_list)
-    count = 0
-    with open(fname, 'w') as f:
-        for word in vectors:
-            if not word:
-                continue
-            try:
-                f.write(word.encode('utf-8') + ' ' + vectors[word] + '\n')
-                count += 1
-            except TypeError:
-                f.write(word + ' ' + vectors[word] + '\n')
-                count += 1
-            except:
-                pass
-    with open(fname, 'r+') as f:
-        content = f.read()
-        f.seek(0, 0)
-        f.write('{} {}\n'.format(count, embedding.shape[1]))  # write the number of vects
-        f.write(content)
+    ''' Writes the embedding of every word in `model` to `fname`. The format is picked by the extension (see embedding_io) '''
+    write_model_embedding(embedding, model, fname)
 
 def evaluate(embedding, method, model):
     rel_path = 'vectors_{}.txt'.format(method)
@@ -58,31 +39,33 @@ def evaluate_vectors_from_path(vector_path, results_path):
     os.system('python3 embedding_benchmarks/scripts/evaluate_on_all.py -f /home/eric/code/gensim/{} -o /home/eric/code/gensim/results/{}'.format(vector_path, results_path))
 
 
+_analogy_question_cache = {}  # (vocab, seed) -> EmbeddingTaskEvaluator._analogy_questions
+
+
 class EmbeddingTaskEvaluator(object):
-    def __init__(self, method: str, fname: str=None, normalize_vects: bool=True, nonneg: bool=False, seed_bump=0):
+    def __init__(self, method: str, fname: str=None, normalize_vects: bool=True, nonneg: bool=False, seed_bump=0, preprocessed: bool=False):
         '''
-        `fname` is the name of an embedding vectors file 
+        `fname` is the name of an embedding vectors file (any format embedding_io reads)
+        `preprocessed` means the vectors in `fname` already had the nonneg clip and normalization applied (like the
+            copies of benchmark_runner), so a .npy file stays memory mapped instead of being copied to apply them again
         '''
-        self.embedding_dict = {}
         if fname is None:
             fname = 'vectors_{}.txt'.format(method)
         self.fname = fname
-        with open(fname, 'r') as f:
-            for i, line in enumerate(list(f)):
-                line = line.strip()
-                if i != 0:  # (skip header)
-                    [word, vectstring] = line.split(maxsplit=1)
-                    self.embedding_dict[word] = np.fromstring(vectstring, dtype=np.float32, sep=' ')
-                    if nonneg:
-                        self.embedding_dict[word] = self.embedding_dict[word].clip(min=0.0)
-                    if normalize_vects:
-                        self.embedding_dict[word] /= np.linalg.norm(self.embedding_dict[word])
-                    self.embedding_dim = len(self.embedding_dict[word])
+        # text, word2vec binary or .npy + .vocab (memory mapped), by extension
+        self.embedding_dict = WordVectors.load(fname, normalize=normalize_vects and not preprocessed, nonneg=nonneg and not preprocessed)
+        self.embedding_matrix = self.embedding_dict.matrix  # |V| x k, rows in the order of self.embedding_dict.words
+        self.embedding_dim = self.embedding_dict.dim
         self.normalize_vects = normalize_vects
         self.method = method
         self.seed_bump = seed_bump
         random.seed(42 + self.seed_bump)
 
+    @lru_cache()
+    def get_dimension_index(self):
+        ''' DimensionIndex of the embedding matrix, built on first use '''
+        return DimensionIndex(self.embedding_matrix)
+
     #@lru_cache()
     def get_word_classification_data_pos(self, split_type='train'):
         words_and_POSs = []
@@ -159,8 +142,16 @@ class EmbeddingTaskEvaluator(object):
             print('Word classification ({}, {}%) score: {}'.format(classification_problem, int(train_pct*100), score))
         return score
 
-    @lru_cache()
-    def get_analogy_data(self, split_type='train', seed=0):
+    def _analogy_questions(self, seed=0):
+        '''
+        The shuffled Google analogy questions whose words are all in the vocab (with the same dedup as before: a
+        question is dropped if its triple and its answer were both already kept, each in some question):
+        (query ids (n, 3), answer ids (n,), triples, answers, categories, size of the whole dataset). Cached per (vocab, seed), so the train and
+        test splits and every evaluator with the same vocab share one pass over the dataset.
+        '''
+        key = (len(self.embedding_dict), hash(tuple(self.embedding_dict.words)), seed)
+        if key in _analogy_question_cache:
+            return _analogy_question_cache[key]
         from embedding_benchmarks.scripts.web.datasets.analogy import fetch_google_analogy
         analogy = fetch_google_analogy()
         X = analogy['X']
@@ -169,124 +160,65 @@ class EmbeddingTaskEvaluator(object):
         parallel_lists = list(zip(X,y,categories))
         random.seed(42 + seed)
         random.shuffle(parallel_lists)
-        X = [x[0] for x in parallel_lists]
-        y = [x[1] for x in parallel_lists]
-        categories = [x[2] for x in parallel_lists]
-        valid_pairs = []
+        word_index = self.embedding_dict.word_index
+        query_ids = []
+        answer_ids = []
         query_words = []
         answer_words = []
         valid_categories = []
-        for triple, answer, cat in zip(X, y, categories):
-            if all([x in self.embedding_dict for x in triple]) and answer in self.embedding_dict:
-                triple_embedded = np.array([self.embedding_dict[x] for x in triple])
-                if self.normalize_vects:
-                    triple_embedded = sklearn.preprocessing.normalize(triple_embedded)
-                answer_embedded = np.array(self.embedding_dict[answer])
-                triple = [x for x in triple] 
-                if triple in query_words and answer in answer_words:
+        seen_triples = set()
+        seen_answers = set()
+        for triple, answer, cat in parallel_lists:
+            if all([x in word_index for x in triple]) and answer in word_index:
+                triple = [x for x in triple]
+                if tuple(triple) in seen_triples and answer in seen_answers:
                     continue
-                valid_pairs.append((triple_embedded, answer_embedded))
+                seen_triples.add(tuple(triple))
+                seen_answers.add(answer)
+                query_ids.append([word_index[x] for x in triple])
+                answer_ids.append(word_index[answer])
                 query_words.append(triple)
                 answer_words.append(answer)
                 valid_categories.append(cat)
+        questions = (
+            np.array(query_ids, dtype=np.int64).reshape(-1, 3), np.array(answer_ids, dtype=np.int64),
+            query_words, answer_words, valid_categories, len(X),
+        )
+        _analogy_question_cache[key] = questions
+        return questions
 
+    @lru_cache()
+    def get_analogy_data(self, split_type='train', seed=0):
+        query_ids, answer_ids, query_words, answer_words, valid_categories, num_questions = self._analogy_questions(seed=seed)
         if split_type == 'train':
-            print('{} valid analogy questions out of {} total ({}%)'.format(len(valid_pairs), len(X), 100.0*len(valid_pairs) / len(X)))
-        num_words = len(valid_pairs)
+            print('{} valid analogy questions out of {} total ({}%)'.format(len(answer_ids), num_questions, 100.0*len(answer_ids) / num_questions))
+        num_words = len(answer_ids)
         split_point = int(.85 * num_words)
         if split_type == 'train':
-            data = valid_pairs[:split_point]
-            query_data = query_words[:split_point]
-            answer_data = answer_words[:split_point]
-            category_data = valid_categories[:split_point]
+            split = slice(None, split_point)
         elif split_type == 'test':
-            data = valid_pairs[split_point:]
-            query_data = query_words[split_point:]
-            answer_data = answer_words[split_point:]
-            category_data = valid_categories[split_point:]
+            split = slice(split_point, None)
         else:
             raise ValueError('Unrecognized split type {}'.format(split_type))
-        x1s = np.array([x[0][0] for x in data])
-        x2s = np.array([x[0][1] for x in data])
-        x3s = np.array([x[0][2] for x in data])
-        y = np.array([x[1] for x in data])
-
-        x1s = sklearn.preprocessing.normalize(x1s)
-        x2s = sklearn.preprocessing.normalize(x2s)
-        x3s = sklearn.preprocessing.normalize(x3s)
-        y = sklearn.preprocessing.normalize(y)
+        query_data = query_words[split]
+        answer_data = answer_words[split]
+        category_data = valid_categories[split]
+        # the rows are normalized whether or not the embedding is
+        x1s, x2s, x3s = [sklearn.preprocessing.normalize(self.embedding_matrix[query_ids[split, i]]) for i in range(3)]
+        y = sklearn.preprocessing.normalize(self.embedding_matrix[answer_ids[split]])
         return x1s, x2s, x3s, y, query_data, answer_data, category_data
 
-    def _train_analogy_NN(self, x1s, x2s, x3s, y, verbose=False):
-        config = tf.ConfigProto(
-            allow_soft_placement=True,
-        )
-        sess = tf.Session(config=config)
-        v1, v2, v3, v4 = (None,) * 4
-        v4_hat = None
-        train_op = None
-        loss = None
-        with sess.as_default():
-            with tf.device('/cpu:0'):
-                W1 = tf.Variable(initial_value=np.identity(self.embedding_dim), name='W1', dtype=tf.float64)
-                W2 = tf.Variable(initial_value=np.identity(self.embedding_dim), name='W2', dtype=tf.float64)
-                W3 = tf.Variable(initial_value=np.identity(self.embedding_dim), name='W3', dtype=tf.float64)
-                b = tf.Variable(tf.zeros([self.embedding_dim], dtype=tf.float64), name='b')
-                v1 = tf.placeholder(tf.float64, shape=[None, self.embedding_dim], name='v1')
-                v2 = tf.placeholder(tf.float64, shape=[None, self.embedding_dim], name='v2')
-                v3 = tf.placeholder(tf.float64, shape=[None, self.embedding_dim], name='v3')
-                v4 = tf.placeholder(tf.float64, shape=[None, self.embedding_dim], name='v4')
-
-                v1_e = tf.expand_dims(v1, -1)  # [?, 300] -> [?, 300, 1]
-                v2_e = tf.expand_dims(v2, -1)
-                v3_e = tf.expand_dims(v3, -1)
-                matmul1s = tf.scan(lambda _, v: tf.matmul(W1, v), v1_e)
-                matmul2s = tf.scan(lambda _, v: tf.matmul(W2, v), v2_e)
-                matmul3s = tf.scan(lambda _, v: tf.matmul(W3, v), v3_e)
-                pred_value = -matmul1s + matmul2s + matmul3s
-                pred_value = tf.squeeze(pred_value)
-                v4_hat = pred_value
-                v4_hat /= tf.sqrt(tf.nn.l2_loss(pred_value) * 2)  # [?, 300]
-
-                losses = tf.reduce_sum(tf.squared_difference(v4, v4_hat), axis=1)
-                prediction_loss = tf.reduce_mean(losses)
-                loss = prediction_loss
-
-                # regularization
-                reg_param = .001
-                #reg_loss = (1/3) * reg_param * (tf.nn.l2_loss(W1) + tf.nn.l2_loss(W2) + tf.nn.l2_loss(W3)) 
-                reg_loss = reg_param * tf.nn.l2_loss(W3)
-                if True:
-                    loss += reg_loss
-
-                global_step = tf.Variable(0, name='global_step', trainable=False)
-                optimizer = tf.train.AdamOptimizer(learning_rate=1e-3)
-                train_op = optimizer.minimize(loss, global_step)
-
-                sess.run(tf.global_variables_initializer())
-
-                def chunker(seq, size):
-                    return (seq[pos:pos + size] for pos in range(0, len(seq), size))
-                n_iters = 1
-                for _ in range(n_iters):
-                    if verbose:
-                        print('running batches...')
-                    for x1s_batch, x2s_batch, x3s_batch, y_batch in zip(chunker(x1s, 25), chunker(x2s, 25), chunker(x3s, 25), chunker(y, 25)):
-                        _, loss_val, step, p_loss, r_loss = sess.run([train_op, loss, global_step, prediction_loss, reg_loss], feed_dict={
-                            v1: x1s_batch,
-                            v2: x2s_batch,
-                            v3: x3s_batch,
-                            v4: y_batch,
-                        })
-                        if verbose:
-                            if step % 20 == 0:
-                                print('loss at step {}: {}'.format(step, loss_val))
-                print('Prediction loss: {:.2f}, Regularization loss: {:.2f} (at end of training)'.format(p_loss, r_loss))
-        return sess, W1.eval(sess), W2.eval(sess), W3.eval(sess)
-
-    def analogy_tasks(self, train_pct=1.0, verbose=True):
+    def _train_analogy_NN(self, x1s, x2s, x3s, y, verbose=False, solver='adam'):
+        '''
+        Learns the linear analogy map (W1, W2, W3) with analogy_mapping (`solver` is 'adam', the same minibatch
+        training the TF graph did, or 'ridge', the closed form).
+        '''
+        return analogy_mapping.train(x1s, x2s, x3s, y, solver=solver, verbose=verbose)
+
+    def analogy_tasks(self, train_pct=1.0, verbose=True, solver='adam', memory_limit=retrieval.DEFAULT_MEMORY_LIMIT):
         '''
         Currently not working for any embedding. 
+        `solver` is passed to _train_analogy_NN. The answers are retrieved with at most `memory_limit` bytes of scores at a time.
         '''
         x1s, x2s, x3s, y, word_X_train, word_y_train, cats_train = self.get_analogy_data('train', seed=self.seed_bump)
         x1s_test, x2s_test, x3s_test, y_test, word_X_test, word_y_test, categories = self.get_analogy_data('test', seed=self.seed_bump)
@@ -294,47 +226,31 @@ class EmbeddingTaskEvaluator(object):
         if verbose:
             print("{} training words".format(len(x1s)))
             print("{} testing words".format(len(x1s_test)))
-        same_analogies = [(trip, ans) for (trip, ans) in zip(word_X_test, word_y_test) if trip in word_X_train and ans in word_y_train]
+        train_triples = set(tuple(trip) for trip in word_X_train)
+        train_answers = set(word_y_train)
+        same_analogies = [(trip, ans) for (trip, ans) in zip(word_X_test, word_y_test) if tuple(trip) in train_triples and ans in train_answers]
         assert len(same_analogies) == 0
         x1s = x1s[:int(train_pct * len(x1s))]
         x2s = x2s[:int(train_pct * len(x2s))]
         x3s = x3s[:int(train_pct * len(x3s))]
         y = y[:int(train_pct * len(y))]
-        sess, W1, W2, W3 = self._train_analogy_NN(x1s, x2s, x3s, y)
-        print('learned NN. evaluating...')
+        t = time.time()
+        W1, W2, W3 = self._train_analogy_NN(x1s, x2s, x3s, y, solver=solver)
+        print('learned NN in {:.1f} secs. evaluating...'.format(time.time() - t))
 
         correct_syn = 0
         total_syn = 0
         correct_sem = 0
         total_sem = 0
-        def get_closest_vocab_word(predicted, query):
-            best_word = None
-            best_vect = None
-            best_dist = float('-inf')
-            for word, vect in self.embedding_dict.items():
-                if word not in query:
-                    dist = np.dot(vect, predicted)  # cosine similarity
-                    dist /= (np.linalg.norm(vect) * np.linalg.norm(predicted))
-                    if dist > best_dist:
-                        best_word = word
-                        best_vect = vect
-                        best_dist = dist
-            return best_word, best_vect
-
-        ordered_embedding_words = []
-        embedding_mat = []
-        for word, vect in self.embedding_dict.items():
-            ordered_embedding_words.append(word)
-            embedding_mat.append(vect)
-        embedding_mat = np.array(embedding_mat)  # |V| x k
-        P1 = x1s_test
-        P2 = x2s_test
-        P3 = x3s_test
-        predictions = -np.dot(W1, P1.T) + np.dot(W2, P2.T) + np.dot(W3, P3.T)
-        predictions = sklearn.preprocessing.normalize(predictions)
-        dots = np.dot(embedding_mat, predictions)
-        argmaxes = np.argmax(dots, axis=0)
-        predicted_words = [ordered_embedding_words[i] for i in argmaxes]
+
+        ordered_embedding_words = self.embedding_dict.words
+        embedding_mat = self.embedding_matrix  # |V| x k
+        predictions = analogy_mapping.predict(W1, W2, W3, x1s_test, x2s_test, x3s_test)
+        predictions = sklearn.preprocessing.normalize(predictions)  # one unit vector per question
+        # closest vocab word to each prediction that isn't one of its three query words, in blocks of bounded memory
+        query_ids = self.embedding_dict.rows([word for triple in word_X_test for word in triple]).reshape(-1, 3)
+        best_ids, _ = retrieval.top_k(embedding_mat, predictions, k=1, exclude=query_ids, memory_limit=memory_limit)
+        predicted_words = [ordered_embedding_words[i] for i in best_ids[:, 0]]
         for predicted_word, correct_word, cat in zip(predicted_words, word_y_test, categories):
             if cat == 'syntactic':
                 if predicted_word == correct_word:
@@ -378,7 +294,7 @@ class EmbeddingTaskEvaluator(object):
         else:
             raise ValueError('Unrecognized split type {}'.format(split_type))
         tokenized_X = [x[0].split() for x in data]
-        X_data = [np.array([self.embedding_dict[w] for w in sent if w in self.embedding_dict]) for sent in tokenized_X]
+        X_data = [self.embedding_matrix[self.embedding_dict.rows([w for w in sent if w in self.embedding_dict])] for sent in tokenized_X]
         y_data = [x[1] for x in data]
         return X_data, y_data
 
@@ -424,7 +340,11 @@ class EmbeddingTaskEvaluator(object):
                 print("Number of filtered outlier entities: %d/%d (mean per %% cluster: %f%%)" % (evaluator.num_filtered_outliers, evaluator.num_total_outliers, evaluator.percent_filtered_outliers))
             return (evaluator.opp, evaluator.accuracy)
 
-        embedding = WrappedEmbedding.from_word2vec(self.fname, binary=False)
+        fmt = embedding_format(self.fname)  # same formats as WordVectors.load
+        if fmt == 'npy':
+            embedding = WrappedEmbedding.from_npy(self.fname, mmap_mode='r')
+        else:
+            embedding = WrappedEmbedding.from_word2vec(self.fname, binary=(fmt == 'word2vec_binary'))
         dataset = list(read_dataset_directory('wikisem500/dataset/en/'))
         if verbose:
             print("Scoring...")
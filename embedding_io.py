@@ -0,0 +1,246 @@
+'''
+Writing word embeddings to disk in a single pass, and reading them back. Formats:
+    text             word2vec text format: a "<num words> <dim>" header line, then "<word> <x_1> ... <x_dim>" per word
+    word2vec_binary  format of the C word2vec tool: the same header, then per word "<word> ", dim little-endian float32s and "\n"
+    npy              <name>.npy holding the (num words, dim) float32 matrix, plus <name>.vocab with one word per line (same order)
+The format is picked from the file extension by default: .bin is word2vec_binary, .npy is npy and anything else is text.
+'''
+from collections.abc import Mapping
+import numpy as np
+import os
+import time
+
+
+FORMATS = ('text', 'word2vec_binary', 'npy')
+
+
+def embedding_format(fname):
+    ext = os.path.splitext(fname)[1]
+    if ext == '.bin':
+        return 'word2vec_binary'
+    if ext == '.npy':
+        return 'npy'
+    return 'text'
+
+
+def vocab_fname(fname):
+    ''' The vocab file that goes with the .npy matrix `fname` '''
+    return os.path.splitext(fname)[0] + '.vocab'
+
+
+def model_words(model):
+    ''' (words, rows): the words of the gensim `model` in index order (skipping empty ones) and their rows in the embedding '''
+    index2word = [None] * len(model.vocab)
+    for word, vocab in model.vocab.items():
+        index2word[vocab.index] = word
+    rows = [i for (i, word) in enumerate(index2word) if word]
+    return [index2word[i] for i in rows], np.array(rows, dtype=np.int64)
+
+
+def format_rows(block, precision=7):
+    '''
+    Formats every row of the 2d `block` as b' <x_1> <x_2> ...' with `precision` decimals (like '{:.7f}'.format of the
+    float32 values), building the digits of all cells with array ops instead of one format call per float.
+    '''
+    x = np.asarray(block, dtype=np.float32)
+    if not np.isfinite(x).all():
+        raise ValueError('Cannot write an embedding with inf or nan values')
+    # float32 * 10**precision is exact in float64 (for precision <= 8), so rint rounds exactly like str.format
+    scale = 10 ** precision
+    q = np.rint(np.abs(x.astype(np.float64)) * scale).astype(np.int64)
+    int_part = q // scale
+    max_int_digits = len(str(int(int_part.max()))) if int_part.size else 1
+    num_int_digits = np.ones(x.shape, dtype=np.int64)
+    for k in range(1, max_int_digits):
+        num_int_digits += int_part >= 10 ** k
+    # cell layout: separator, sign, int digits (right aligned), '.', fraction digits. Unused slots stay 0 and are dropped
+    width = 2 + max_int_digits + (1 + precision if precision > 0 else 0)
+    chars = np.zeros(x.shape + (width,), dtype=np.uint8)
+    chars[..., 0] = ord(' ')
+    col = width - 1
+    rest = q
+    for _ in range(precision):
+        chars[..., col] = ord('0') + rest % 10
+        rest = rest // 10
+        col -= 1
+    if precision > 0:
+        chars[..., col] = ord('.')
+        col -= 1
+    for k in range(max_int_digits):
+        chars[..., col - k] = np.where(k < num_int_digits, ord('0') + rest % 10, 0)
+        rest = rest // 10
+    sign = np.where(np.signbit(x), ord('-'), 0).astype(np.uint8)
+    np.put_along_axis(chars, (col - num_int_digits)[..., None], sign[..., None], axis=-1)
+
+    chars = chars.reshape(len(x), x.shape[1] * width)
+    keep = chars != 0
+    data = chars[keep].tobytes()
+    ends = np.cumsum(keep.sum(axis=1)).tolist()
+    return [data[start:end] for (start, end) in zip([0] + ends[:-1], ends)]
+
+
+def _rows(vectors, rows, start, end):
+    if rows is None:
+        return vectors[start:end]
+    return vectors[rows[start:end]]
+
+
+def write_text(fname, words, vectors, rows=None, precision=7, block_size=10000):
+    '''
+    Writes the word2vec text format. Row i of the file is words[i] with vectors[rows[i]] (or vectors[i] if rows is None),
+    so the embedding matrix never has to be copied.
+    '''
+    with open(fname, 'wb') as f:
+        f.write('{} {}\n'.format(len(words), vectors.shape[1]).encode('utf8'))
+        for start in range(0, len(words), block_size):
+            formatted = format_rows(_rows(vectors, rows, start, start + block_size), precision=precision)
+            f.write(b''.join(
+                word.encode('utf8') + line + b'\n' for (word, line) in zip(words[start:start + block_size], formatted)
+            ))
+
+
+def write_word2vec_binary(fname, words, vectors, rows=None, block_size=10000):
+    ''' Writes the binary format of the C word2vec tool (rows as in write_text) '''
+    with open(fname, 'wb') as f:
+        f.write('{} {}\n'.format(len(words), vectors.shape[1]).encode('utf8'))
+        for start in range(0, len(words), block_size):
+            block = np.ascontiguousarray(_rows(vectors, rows, start, start + block_size), dtype='<f4')
+            f.write(b''.join(
+                word.encode('utf8') + b' ' + vect.tobytes() + b'\n' for (word, vect) in zip(words[start:start + block_size], block)
+            ))
+
+
+def write_npy(fname, words, vectors, rows=None):
+    ''' Writes the float32 matrix to `fname` (a .npy file) and the words to vocab_fname(fname) '''
+    matrix = vectors if rows is None else vectors[rows]
+    with open(fname, 'wb') as f:  # np.save(fname) would append .npy to any other extension, where read_npy won't look
+        np.save(f, np.asarray(matrix, dtype=np.float32))
+    with open(vocab_fname(fname), 'w', encoding='utf8') as f:
+        f.write(''.join(word + '\n' for word in words))
+
+
+def write_embedding(fname, words, vectors, rows=None, fmt=None, precision=7):
+    fmt = fmt or embedding_format(fname)
+    t = time.time()
+    if fmt == 'text':
+        write_text(fname, words, vectors, rows=rows, precision=precision)
+    elif fmt == 'word2vec_binary':
+        write_word2vec_binary(fname, words, vectors, rows=rows)
+    elif fmt == 'npy':
+        write_npy(fname, words, vectors, rows=rows)
+    else:
+        raise ValueError('Unknown embedding format {}. Use one of {}'.format(fmt, FORMATS))
+    print('Writing {} vectors to {} ({}) took {:.1f} secs'.format(len(words), fname, fmt, time.time() - t))
+
+
+def write_model_embedding(embedding, model, fname, fmt=None, precision=7):
+    ''' Writes the rows of `embedding` for the words of the gensim `model` '''
+    words, rows = model_words(model)
+    if len(rows) == len(embedding) and np.array_equal(rows, np.arange(len(embedding))):
+        rows = None
+    write_embedding(fname, words, embedding, rows=rows, fmt=fmt, precision=precision)
+
+
+def read_text(fname):
+    with open(fname, 'r', encoding='utf8') as f:
+        num_words, dim = [int(x) for x in f.readline().split()]
+        words = []
+        vectstrings = []
+        for line in f:
+            parts = line.split(maxsplit=1)
+            if len(parts) == 2:
+                words.append(parts[0])
+                vectstrings.append(parts[1])
+    vectors = np.array(' '.join(vectstrings).split(), dtype=np.float32).reshape(len(words), dim)
+    return words, vectors
+
+
+def read_word2vec_binary(fname):
+    with open(fname, 'rb') as f:
+        num_words, dim = [int(x) for x in f.readline().split()]
+        data = f.read()
+    words = []
+    vectors = np.zeros((num_words, dim), dtype=np.float32)
+    vect_len = 4 * dim
+    pos = 0
+    for i in range(num_words):
+        end = data.index(b' ', pos)
+        words.append(data[pos:end].lstrip(b'\n').decode('utf8', errors='replace'))  # some writers put a newline after each vector
+        vectors[i] = np.frombuffer(data, dtype='<f4', count=dim, offset=end + 1)
+        pos = end + 1 + vect_len
+    return words, vectors
+
+
+def read_npy(fname, mmap_mode=None):
+    with open(vocab_fname(fname), 'r', encoding='utf8') as f:
+        words = f.read().split('\n')[:-1]
+    return words, np.load(fname, mmap_mode=mmap_mode)
+
+
+def read_embedding(fname, fmt=None, mmap_mode=None):
+    ''' (words, vectors) from a file in any of FORMATS. `mmap_mode` only applies to npy '''
+    fmt = fmt or embedding_format(fname)
+    if fmt == 'text':
+        return read_text(fname)
+    if fmt == 'word2vec_binary':
+        return read_word2vec_binary(fname)
+    if fmt == 'npy':
+        return read_npy(fname, mmap_mode=mmap_mode)
+    raise ValueError('Unknown embedding format {}. Use one of {}'.format(fmt, FORMATS))
+
+
+class WordVectors(Mapping):
+    '''
+    Read-only word -> vector mapping backed by one (|V|, d) float32 matrix and a word -> row index, so code that
+    used a dict of per-word vectors keeps working while whole-vocab operations can use `matrix` directly.
+    Vectors returned by [] are views into the matrix.
+    '''
+    def __init__(self, words, matrix):
+        if len(words) != len(matrix):
+            raise ValueError('Got {} words but {} vectors'.format(len(words), len(matrix)))
+        self.words = list(words)
+        self.matrix = matrix
+        self.word_index = {word: i for (i, word) in enumerate(self.words)}  # the last row wins for duplicate words, like a dict
+        if len(self.word_index) != len(self.words):
+            # keep the rows in the order of first appearance (like dict insertion order), with the vector of the last one
+            unique_words = list(dict.fromkeys(self.words))
+            rows = np.array([self.word_index[word] for word in unique_words], dtype=np.int64)
+            self.words = unique_words
+            self.matrix = np.asarray(self.matrix)[rows]
+            self.word_index = {word: i for (i, word) in enumerate(self.words)}
+
+    @staticmethod
+    def load(fname, normalize=False, nonneg=False, fmt=None, mmap_mode='r'):
+        '''
+        Reads any of FORMATS (npy is memory mapped). The nonneg clip and then the normalization to unit length are
+        applied to the whole matrix at once; the matrix is only copied into RAM if either is asked for.
+        '''
+        words, matrix = read_embedding(fname, fmt=fmt, mmap_mode=mmap_mode)
+        if matrix.dtype != np.float32:
+            matrix = matrix.astype(np.float32)
+        if nonneg:
+            matrix = np.maximum(matrix, 0.0)
+        if normalize:
+            with np.errstate(divide='ignore', invalid='ignore'):  # all-zero rows become nan, like dividing them one by one
+                matrix = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+        return WordVectors(words, matrix)
+
+    @property
+    def dim(self):
+        return self.matrix.shape[1]
+
+    def rows(self, words):
+        ''' Row indices of `words` in the matrix (all of them have to be in the vocab) '''
+        return np.array([self.word_index[word] for word in words], dtype=np.int64)
+
+    def __getitem__(self, word):
+        return self.matrix[self.word_index[word]]
+
+    def __contains__(self, word):
+        return word in self.word_index
+
+    def __iter__(self):
+        return iter(self.words)
+
+    def __len__(self):
+        return len(self.words)
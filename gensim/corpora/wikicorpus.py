@@ -19,9 +19,12 @@ module.
 
 
 import bz2
+from collections import deque
 import logging
+import os
 import re
-from xml.etree.cElementTree import iterparse  # LXML isn't faster, so let's go with the built-in solution
+import time
+from xml.etree.cElementTree import fromstring, iterparse  # LXML isn't faster, so let's go with the built-in solution
 import multiprocessing
 
 from gensim import utils
@@ -247,6 +250,210 @@ def process_article(args):
     return result, title, pageid
 
 
+# bzip2 compressed blocks start with this 48-bit magic number, and a stream ends with the other one. Both are
+# aligned to bits, not bytes
+BZ2_BLOCK_MAGIC = 0x314159265359
+BZ2_EOS_MAGIC = 0x177245385090
+BZ2_MAGIC_BITS = 48
+
+
+def _magic_patterns(magic):
+    """
+    For each of the 8 bit offsets at which `magic` can start within a byte, the 5 bytes that are then fully
+    covered by it (starting at the byte after the one it starts in). These can be searched for with bytes.find.
+    """
+    patterns = []
+    for shift in range(8):
+        window = (magic << (8 - shift)).to_bytes(7, 'big')  # magic starting `shift` bits into a 7-byte window
+        patterns.append((shift, window[1:6]))
+    return patterns
+
+
+def _find_magic(data, magic, base_bit=0):
+    """Bit positions (plus `base_bit`) of every occurrence of the 48-bit `magic` in the bytes `data`."""
+    positions = []
+    mask = (1 << BZ2_MAGIC_BITS) - 1
+    for shift, pattern in _magic_patterns(magic):
+        j = data.find(pattern, 1)
+        while j != -1:
+            start = j - 1  # the byte the magic starts in
+            window = data[start:start + 7]
+            if len(window) == 7 and (int.from_bytes(window, 'big') >> (8 - shift)) & mask == magic:
+                positions.append(base_bit + 8 * start + shift)
+            j = data.find(pattern, j + 1)
+    return positions
+
+
+def _scan_bz2_range(args):
+    """Block and end-of-stream magics that start in the byte range [start, end) of `fname`."""
+    fname, start, end, read_size = args
+    blocks, ends = [], []
+    with open(fname, 'rb') as f:
+        pos = start
+        while pos < end:
+            # read 6 bytes more, so a magic that starts in this piece is always complete
+            f.seek(max(0, pos - 1))
+            prefix = 1 if pos > 0 else 0
+            data = f.read(prefix + min(read_size, end - pos) + 6)
+            base_bit = 8 * (pos - prefix)
+            limit = 8 * min(pos + read_size, end)
+            for found, magic in ((blocks, BZ2_BLOCK_MAGIC), (ends, BZ2_EOS_MAGIC)):
+                found.extend(p for p in _find_magic(data, magic, base_bit) if 8 * pos <= p < limit)
+            pos += read_size
+    return blocks, ends
+
+
+def find_bz2_blocks(fname, processes=None, read_size=64 * 1024 * 1024):
+    """
+    Locate the compressed blocks of the bzip2 file `fname`, by scanning it (in parallel) for the block magic numbers.
+
+    Return a list of (start_bit, end_bit) for every block: a block runs from its magic up to the next block or
+    end-of-stream magic. Concatenated streams (e.g. from pbzip2) are fine. A block magic can in principle also
+    appear by chance inside compressed data (about once per 30TB); such a block fails to decompress.
+
+    """
+    if processes is None:
+        processes = max(1, multiprocessing.cpu_count() - 1)
+    size = os.path.getsize(fname)
+    piece = max(1, -(-size // processes))
+    ranges = [(fname, start, min(size, start + piece), read_size) for start in range(0, size, piece)]
+    if processes > 1 and len(ranges) > 1:
+        pool = multiprocessing.Pool(processes)
+        results = pool.map(_scan_bz2_range, ranges)
+        pool.terminate()
+    else:
+        results = [_scan_bz2_range(r) for r in ranges]
+    markers = sorted(
+        [(p, True) for blocks, _ in results for p in blocks] + [(p, False) for _, ends in results for p in ends]
+    )
+    return [
+        (p, markers[i + 1][0]) for i, (p, is_block) in enumerate(markers[:-1]) if is_block
+    ]
+
+
+def read_multistream_index(index_fname, fname):
+    """
+    Byte ranges [(start, end)] of the bz2 streams of a multistream dump `fname`, from its index file of
+    `offset:pageid:title` lines. The first stream (the <siteinfo> header) is included.
+    """
+    offsets = set([0])
+    with bz2.BZ2File(index_fname) as f:
+        for line in f:
+            offsets.add(int(line.split(b':', 1)[0]))
+    offsets = sorted(offsets) + [os.path.getsize(fname)]
+    return [(start, end) for start, end in zip(offsets[:-1], offsets[1:]) if end > start]
+
+
+def multistream_index_fname(fname):
+    """The index file that goes with a multistream dump `fname`, or None if there is none."""
+    if fname.endswith('.xml.bz2'):
+        index_fname = fname[:-len('.xml.bz2')] + '-index.txt.bz2'
+        if os.path.exists(index_fname):
+            return index_fname
+    return None
+
+
+def _read_bits(f, start, end):
+    """The bits [start, end) of file `f`, as an int."""
+    f.seek(start // 8)
+    data = f.read((end + 7) // 8 - start // 8)
+    value = int.from_bytes(data, 'big') >> (8 * len(data) - (end - 8 * (start // 8)))
+    return value & ((1 << (end - start)) - 1)
+
+
+def decompress_bz2_blocks(f, blocks):
+    """
+    Decompress the consecutive bzip2 blocks [(start_bit, end_bit)] of file `f`, by wrapping them into a new
+    bzip2 stream: a header, the blocks (bit-shifted to follow it) and an end-of-stream marker with their combined CRC.
+    """
+    value, num_bits, combined_crc = 0, 0, 0
+    for start, end in blocks:
+        bits = _read_bits(f, start, end)
+        block_crc = (bits >> (end - start - BZ2_MAGIC_BITS - 32)) & 0xffffffff  # stored right after the magic
+        combined_crc = (((combined_crc << 1) | (combined_crc >> 31)) & 0xffffffff) ^ block_crc
+        value = (value << (end - start)) | bits
+        num_bits += end - start
+    value = (((value << BZ2_MAGIC_BITS) | BZ2_EOS_MAGIC) << 32) | combined_crc
+    num_bits += BZ2_MAGIC_BITS + 32
+    padding = -num_bits % 8
+    # the max block size from the header ('9' = 900k) only has to be big enough for every block
+    return bz2.decompress(b'BZh9' + (value << padding).to_bytes((num_bits + padding) // 8, 'big'))
+
+
+def extract_pages_from_bytes(data, owned_end=None, filter_namespaces=False):
+    """
+    Extract the pages from a piece `data` of a (decompressed) MediaWiki dump, as (title, content, pageid) triplets
+    like `extract_pages`. Only the pages whose <page> tag starts before `owned_end` are returned. Those must be
+    complete in `data`; a page that starts before `data` (i.e. without its <page> tag) is ignored.
+    """
+    if owned_end is None:
+        owned_end = len(data)
+    pages = []
+    start = data.find(b'<page>')
+    while start != -1 and start < owned_end:
+        end = data.find(b'</page>', start)
+        if end == -1:
+            raise ValueError('page at byte %i is incomplete' % start)
+        end += len(b'</page>')
+        # within a <page> element there is no namespace declaration, so the tags are plain
+        elem = fromstring(data[start:end])
+        text = elem.find('./revision/text').text
+        if filter_namespaces and elem.find('./ns').text not in filter_namespaces:
+            text = None
+        pages.append((elem.find('./title').text, text or "", elem.find('./id').text))
+        start = data.find(b'<page>', end)
+    return pages
+
+
+_worker_state = {}
+
+
+def _init_wiki_worker(fname, units, use_blocks, lemmatize, filter_namespaces):
+    # runs once per worker process, so the table of blocks/streams is only sent over once
+    _worker_state.update(
+        fname=fname, units=units, use_blocks=use_blocks, lemmatize=lemmatize, filter_namespaces=filter_namespaces)
+
+
+def _decompress_units(f, units, use_blocks):
+    if use_blocks:
+        return decompress_bz2_blocks(f, units)
+    f.seek(units[0][0])
+    return bz2.decompress(f.read(units[-1][1] - units[0][0]))  # handles the concatenated streams
+
+
+def _process_unit_range(args):
+    """
+    Decompress and tokenize the pages that start in units (bz2 blocks or streams) [first, last). Decompression
+    continues into the following units for as long as the last of those pages isn't complete.
+    """
+    first, last = args
+    units = _worker_state['units']
+    use_blocks = _worker_state['use_blocks']
+    with open(_worker_state['fname'], 'rb') as f:
+        data = _decompress_units(f, units[first:last], use_blocks)
+        owned_end = len(data)
+        # a page can only be cut off by the end of the range if the range doesn't end on a </page>. Decompress one
+        # unit more anyway, in case the <page> tag itself is split between two units
+        more = last
+        while more < len(units) and (more == last or data.rfind(b'<page>', 0, owned_end + len(b'<page>') - 1) > data.rfind(b'</page>')):
+            data += _decompress_units(f, units[more:more + 1], use_blocks)
+            more += 1
+    pages = extract_pages_from_bytes(data, owned_end, _worker_state['filter_namespaces'])
+    return [process_article((text, _worker_state['lemmatize'], title, pageid)) for title, text, pageid in pages]
+
+
+def unit_ranges(units, chunk_bytes, bits=False):
+    """Split the units [(start, end)] into consecutive ranges [(first, last)] of about `chunk_bytes` compressed bytes."""
+    scale = 8 if bits else 1
+    ranges = []
+    first = 0
+    for i, (start, end) in enumerate(units):
+        if (end - units[first][0]) >= chunk_bytes * scale or i == len(units) - 1:
+            ranges.append((first, i + 1))
+            first = i + 1
+    return ranges
+
+
 class WikiCorpus(TextCorpus):
     """
     Treat a wikipedia articles dump (\*articles.xml.bz2) as a (read-only) corpus.
@@ -258,7 +465,8 @@ class WikiCorpus(TextCorpus):
     >>> MmCorpus.serialize('wiki_en_vocab200k.mm', wiki) # another 8h, creates a file in MatrixMarket format plus file with id->word
 
     """
-    def __init__(self, fname, processes=None, lemmatize=utils.has_pattern(), dictionary=None, filter_namespaces=('0',)):
+    def __init__(self, fname, processes=None, lemmatize=utils.has_pattern(), dictionary=None, filter_namespaces=('0',),
+                 parallel_read=False, ordered=True, chunk_bytes=4 * 1024 * 1024, index_fname=None):
         """
         Initialize the corpus. Unless a dictionary is provided, this scans the
         corpus once, to determine its vocabulary.
@@ -267,6 +475,12 @@ class WikiCorpus(TextCorpus):
         token lemmas. Otherwise, use simple regexp tokenization. You can override
         this automatic logic by forcing the `lemmatize` parameter explicitly.
 
+        With `parallel_read`, the dump isn't decompressed in this process: it's split into ranges of about
+        `chunk_bytes` compressed bytes, which the worker processes decompress, parse and tokenize independently.
+        The ranges are the bz2 streams of a multistream dump if its index file is found (or given as
+        `index_fname`), and otherwise the bz2 blocks, which are located by scanning the file. If `ordered` is
+        False, articles are yielded in whatever order the ranges finish.
+
         """
         self.fname = fname
         self.filter_namespaces = filter_namespaces
@@ -275,6 +489,10 @@ class WikiCorpus(TextCorpus):
             processes = max(1, multiprocessing.cpu_count() - 1)
         self.processes = processes
         self.lemmatize = lemmatize
+        self.parallel_read = parallel_read
+        self.ordered = ordered
+        self.chunk_bytes = chunk_bytes
+        self.index_fname = index_fname
         if dictionary is None:
             self.dictionary = Dictionary(self.get_texts())
         else:
@@ -296,28 +514,79 @@ class WikiCorpus(TextCorpus):
         """
         articles, articles_all = 0, 0
         positions, positions_all = 0, 0
+        if self.parallel_read:
+            processed = self.parallel_processed_articles()
+        else:
+            processed = self.processed_articles()
+        for tokens, title, pageid in processed:
+            articles_all += 1
+            positions_all += len(tokens)
+            # article redirects and short stubs are pruned here
+            if len(tokens) < ARTICLE_MIN_WORDS or any(title.startswith(ignore + ':') for ignore in IGNORED_NAMESPACES):
+                continue
+            articles += 1
+            positions += len(tokens)
+            if self.metadata:
+                yield (tokens, (pageid, title))
+            else:
+                yield tokens
+
+        logger.info(
+            "finished iterating over Wikipedia corpus of %i documents with %i positions"
+            " (total %i articles, %i positions before pruning articles shorter than %i words)",
+            articles, positions, articles_all, positions_all, ARTICLE_MIN_WORDS)
+        self.length = articles  # cache corpus length
+
+    def processed_articles(self):
+        """(tokens, title, pageid) of every page, decompressed and parsed in this process and tokenized by the pool."""
         texts = ((text, self.lemmatize, title, pageid) for title, text, pageid in extract_pages(bz2.BZ2File(self.fname), self.filter_namespaces))
         pool = multiprocessing.Pool(self.processes)
         # process the corpus in smaller chunks of docs, because multiprocessing.Pool
         # is dumb and would load the entire input into RAM at once...
         for group in utils.chunkize(texts, chunksize=10 * self.processes, maxsize=1):
-            for tokens, title, pageid in pool.imap(process_article, group):  # chunksize=10):
-                articles_all += 1
-                positions_all += len(tokens)
-                # article redirects and short stubs are pruned here
-                if len(tokens) < ARTICLE_MIN_WORDS or any(title.startswith(ignore + ':') for ignore in IGNORED_NAMESPACES):
-                    continue
-                articles += 1
-                positions += len(tokens)
-                if self.metadata:
-                    yield (tokens, (pageid, title))
-                else:
-                    yield tokens
+            for result in pool.imap(process_article, group):  # chunksize=10):
+                yield result
         pool.terminate()
 
-        logger.info(
-            "finished iterating over Wikipedia corpus of %i documents with %i positions"
-            " (total %i articles, %i positions before pruning articles shorter than %i words)",
-            articles, positions, articles_all, positions_all, ARTICLE_MIN_WORDS)
-        self.length = articles  # cache corpus length
+    def parallel_processed_articles(self):
+        """(tokens, title, pageid) of every page, with each range of the dump decompressed and parsed by a worker."""
+        t = time.time()
+        index_fname = self.index_fname or multistream_index_fname(self.fname)
+        if index_fname is not None:
+            units = read_multistream_index(index_fname, self.fname)
+            ranges = unit_ranges(units, self.chunk_bytes)
+            logger.info("reading %i bz2 streams of %s in %i ranges", len(units), self.fname, len(ranges))
+        else:
+            units = find_bz2_blocks(self.fname, self.processes)
+            ranges = unit_ranges(units, self.chunk_bytes, bits=True)
+            logger.info("found %i bz2 blocks in %s in %.1fs, reading them in %i ranges",
+                        len(units), self.fname, time.time() - t, len(ranges))
+        pool = multiprocessing.Pool(
+            self.processes, initializer=_init_wiki_worker,
+            initargs=(self.fname, units, index_fname is None, self.lemmatize, self.filter_namespaces))
+        # keep only a few ranges in flight, so finished ranges don't pile up in RAM when the consumer is slow
+        pending = deque()
+        ranges = iter(ranges)
+        try:
+            while True:
+                while len(pending) < 2 * self.processes:
+                    r = next(ranges, None)
+                    if r is None:
+                        break
+                    pending.append(pool.apply_async(_process_unit_range, (r,)))
+                if not pending:
+                    break
+                if self.ordered:
+                    result = pending.popleft()
+                else:
+                    result = None
+                    while result is None:
+                        result = next((x for x in pending if x.ready()), None)
+                        if result is None:
+                            time.sleep(0.01)
+                    pending.remove(result)
+                for article in result.get():
+                    yield article
+        finally:
+            pool.terminate()
 # endclass WikiCorpus
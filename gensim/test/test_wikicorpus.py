@@ -9,13 +9,16 @@ Automated tests for checking the WikiCorpus
 """
 
 
+import bz2
 import os
+import shutil
 import sys
+import tempfile
 import types
 import logging
 import unittest
 
-from gensim.corpora.wikicorpus import WikiCorpus
+from gensim.corpora.wikicorpus import WikiCorpus, decompress_bz2_blocks, find_bz2_blocks
 
 
 module_path = os.path.dirname(__file__) # needed because sample data files are located in the same folder
@@ -54,6 +57,48 @@ class TestWikiCorpus(unittest.TestCase):
         self.assertTrue(b"anarchism" in next(l))
         self.assertTrue(b"autism" in next(l))
 
+    def test_bz2_blocks(self):
+        """the located blocks decompress to the whole dump"""
+        fname = datapath(FILENAME)
+        blocks = find_bz2_blocks(fname, processes=2)
+        self.assertTrue(len(blocks) > 1)
+        with open(fname, 'rb') as f:
+            pieces = [decompress_bz2_blocks(f, [block]) for block in blocks]
+        with bz2.BZ2File(fname) as f:
+            self.assertEqual(b''.join(pieces), f.read())
+
+    def test_parallel_read(self):
+        """reading the blocks in parallel gives the same articles as the serial reader, in the same order"""
+        texts = list(WikiCorpus(datapath(FILENAME), processes=2, dictionary={}).get_texts())
+        wc = WikiCorpus(datapath(FILENAME), processes=2, dictionary={}, parallel_read=True, chunk_bytes=1)
+        self.assertEqual(list(wc.get_texts()), texts)
+        wc = WikiCorpus(datapath(FILENAME), processes=2, dictionary={}, parallel_read=True, chunk_bytes=1, ordered=False)
+        self.assertEqual(sorted(wc.get_texts()), sorted(texts))
+
+    def test_parallel_read_multistream(self):
+        """a multistream dump is split along the streams from its index"""
+        with bz2.BZ2File(datapath(FILENAME)) as f:
+            dump = f.read()
+        # one stream for the header, then one per page, like the real multistream dumps (which have 100 pages each)
+        first = dump.find(b'<page>')
+        pieces = [dump[:first]] + [b'<page>' + page for page in dump[first:].split(b'<page>')[1:]]
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpdir, 'enwiki-pages-articles-multistream.xml.bz2')
+            offsets = []
+            with open(fname, 'wb') as f:
+                for piece in pieces:
+                    offsets.append(f.tell())
+                    f.write(bz2.compress(piece))
+            with bz2.BZ2File(os.path.join(tmpdir, 'enwiki-pages-articles-multistream-index.txt.bz2'), 'wb') as f:
+                for i, offset in enumerate(offsets[1:]):
+                    f.write(('%i:%i:page %i\n' % (offset, i, i)).encode('utf8'))
+            texts = list(WikiCorpus(datapath(FILENAME), processes=2, dictionary={}).get_texts())
+            wc = WikiCorpus(fname, processes=2, dictionary={}, parallel_read=True, chunk_bytes=1)
+            self.assertEqual(list(wc.get_texts()), texts)
+        finally:
+            shutil.rmtree(tmpdir)
+
 
 if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.DEBUG)
@@ -0,0 +1,109 @@
+'''
+Background prefetching of training batches, so the next batch gets built while the current one is in sess.run.
+'''
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import queue
+import threading
+import time
+
+
+_DONE = object()  # put on the queue by the producer once the source is exhausted
+
+
+class _ProducerError(object):
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class Prefetcher(object):
+    '''
+    Iterates over `source` in a background thread, keeping up to `queue_depth` items ready ahead of the consumer.
+
+    If `fn` is given, items are `fn(x)` for every x from `source`, computed by `num_workers` worker threads
+    (or processes if use_processes, in which case fn and the items have to be picklable). The output order is
+    always the order of `source`.
+
+    stall_time is the total time the consumer spent waiting for an item that wasn't ready yet.
+    '''
+    def __init__(self, source, fn=None, queue_depth=4, num_workers=1, use_processes=False):
+        if queue_depth < 1:
+            raise ValueError('queue_depth must be at least 1. Got {}'.format(queue_depth))
+        if num_workers > 1 and fn is None:
+            raise ValueError('Multiple workers need a `fn` to parallelize; a generator can only be advanced by one thread')
+        self.source = source
+        self.fn = fn
+        self.queue_depth = queue_depth
+        self.num_workers = num_workers
+        self.use_processes = use_processes
+
+        self.stall_time = 0.0
+        self.num_items = 0
+        self.num_stalls = 0
+        self._queue = queue.Queue(maxsize=queue_depth)
+        self._finished = False  # set once _DONE or an error has been consumed; nothing will be put on the queue again
+        self._stop = threading.Event()
+        self._executor = None
+        if fn is not None and num_workers > 1:
+            executor_type = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+            self._executor = executor_type(max_workers=num_workers)
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        # don't block forever on a full queue once the consumer has gone away
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self):
+        try:
+            for x in self.source:
+                if self._executor is not None:
+                    item = self._executor.submit(self.fn, x)  # the queue holds futures, so it bounds the work in flight
+                elif self.fn is not None:
+                    item = self.fn(x)
+                else:
+                    item = x
+                if not self._put(item):
+                    return
+            self._put(_DONE)
+        except Exception as e:
+            self._put(_ProducerError(e))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._finished:
+            raise StopIteration
+        t = time.time()
+        stalled = self._queue.empty()
+        item = self._queue.get()
+        if self._executor is not None and item is not _DONE and not isinstance(item, _ProducerError):
+            stalled = stalled or not item.done()
+            item = item.result()
+        if stalled:
+            self.num_stalls += 1
+            self.stall_time += time.time() - t
+        if item is _DONE or isinstance(item, _ProducerError):
+            self._finished = True
+            self.close()
+        if item is _DONE:
+            raise StopIteration
+        if isinstance(item, _ProducerError):
+            raise item.exception
+        self.num_items += 1
+        return item
+
+    def close(self):
+        self._stop.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def report(self):
+        return 'Prefetcher: {} batches, stalled waiting for data {} times for {:.2f} secs total ({:.3f} secs/batch)'.format(
+            self.num_items, self.num_stalls, self.stall_time, self.stall_time / max(1, self.num_items))
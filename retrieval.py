@@ -0,0 +1,83 @@
+'''
+Exact top-k retrieval by dot product against an embedding matrix, in blocks so the score matrix never has more than
+`memory_limit` bytes, whatever the vocab size and number of queries. Rows can be excluded per query (e.g. the query
+words of an analogy).
+'''
+import numpy as np
+
+
+DEFAULT_MEMORY_LIMIT = 2 ** 28  # bytes per block of scores
+
+
+def block_sizes(num_rows, num_queries, itemsize, memory_limit=DEFAULT_MEMORY_LIMIT):
+    ''' (query block, row block) sizes with query block * row block * itemsize <= memory_limit (at least 1 x 1) '''
+    max_cells = max(1, int(memory_limit) // itemsize)
+    row_block = max(1, min(num_rows, max_cells))
+    query_block = max(1, min(num_queries, max_cells // row_block))
+    return query_block, row_block
+
+
+def _mask_excluded(scores, exclude, row_start, row_end):
+    ''' Sets scores[i, j] to -inf for every row id j + row_start in exclude[i] (ids of -1 are padding) '''
+    in_block = (exclude >= row_start) & (exclude < row_end)
+    query_pos, ex_pos = np.nonzero(in_block)
+    scores[query_pos, exclude[query_pos, ex_pos] - row_start] = -np.inf
+
+
+def top_k_of_scores(scores, k):
+    ''' (ids, scores) of the k best columns of every row of `scores`, best first and lowest id first among ties '''
+    if k == 1:
+        ids = np.argmax(scores, axis=1)[:, None]
+    elif k < scores.shape[1]:
+        ids = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        # argpartition picks arbitrary ones among ties with the k-th score, so redo rows with such ties on their
+        # candidates (ascending ids) to keep the lowest ids
+        kth = np.take_along_axis(scores, ids, axis=1).min(axis=1, keepdims=True)
+        for i in np.nonzero((scores >= kth).sum(axis=1) > k)[0]:
+            candidates = np.nonzero(scores[i] >= kth[i])[0]
+            ids[i] = candidates[np.lexsort((candidates, -scores[i, candidates]))[:k]]
+    else:
+        ids = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    top = np.take_along_axis(scores, ids, axis=1)
+    order = np.lexsort((ids, -top), axis=1)
+    return np.take_along_axis(ids, order, axis=1), np.take_along_axis(top, order, axis=1)
+
+
+def top_k(matrix, queries, k=1, exclude=None, memory_limit=DEFAULT_MEMORY_LIMIT):
+    '''
+    The k rows of `matrix` with the largest dot product with each row of `queries`: (ids, scores), both (num_queries, k),
+    best first. `exclude` is an optional (num_queries, m) int array of row ids each query must not return (pad with -1);
+    if fewer than k rows are left for a query, the rest of its ids are excluded ones with a score of -inf.
+    Queries are processed in blocks, and for a matrix too big for one block the rows are too, merging the per-block
+    top k. With k=1 and nothing excluded, ids[:, 0] is exactly argmax(queries @ matrix.T, axis=1).
+    '''
+    queries = np.atleast_2d(queries)
+    num_rows, num_queries = len(matrix), len(queries)
+    k = min(int(k), num_rows)
+    dtype = np.result_type(matrix.dtype, queries.dtype)
+    if exclude is not None:
+        exclude = np.asarray(exclude, dtype=np.int64).reshape(num_queries, -1)
+    ids = np.zeros((num_queries, k), dtype=np.int64)
+    scores = np.zeros((num_queries, k), dtype=dtype)
+    query_block, row_block = block_sizes(num_rows, num_queries, dtype.itemsize, memory_limit)
+    for q_start in range(0, num_queries, query_block):
+        q_end = min(q_start + query_block, num_queries)
+        best_ids, best_scores = None, None
+        for r_start in range(0, num_rows, row_block):
+            r_end = min(r_start + row_block, num_rows)
+            block_scores = np.dot(queries[q_start:q_end], np.asarray(matrix[r_start:r_end]).T)
+            if exclude is not None:
+                _mask_excluded(block_scores, exclude[q_start:q_end], r_start, r_end)
+            block_ids, block_top = top_k_of_scores(block_scores, min(k, r_end - r_start))
+            block_ids += r_start
+            if best_ids is None:
+                best_ids, best_scores = block_ids, block_top
+            else:
+                merged_ids = np.hstack([best_ids, block_ids])
+                merged_scores = np.hstack([best_scores, block_top])
+                order = np.lexsort((merged_ids, -merged_scores), axis=1)[:, :k]
+                best_ids = np.take_along_axis(merged_ids, order, axis=1)
+                best_scores = np.take_along_axis(merged_scores, order, axis=1)
+        ids[q_start:q_end] = best_ids
+        scores[q_start:q_end] = best_scores
+    return ids, scores
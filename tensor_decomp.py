@@ -4,11 +4,15 @@ import os
 import tensorflow as tf
 import time
 
+from cp_evaluation import format_heldout, ReconstructionEvaluator
+from prefetch import Prefetcher
+
 class CPDecomp(object):
-    def __init__(self, shape, rank, sess, ndims=3, optimizer_type='2sgd', reg_param=1e-10):
+    def __init__(self, shape, rank, sess, ndims=3, optimizer_type='2sgd', reg_param=1e-10, elementwise_loss=False):
         '''
         `rank` is R, the number of 1D tensors to hold to get an approximation to `X`
         `optimizer_type` must be in ('adam', 'sgd', 'sals', '2sgd')
+        `elementwise_loss` computes the loss with the old per-entry map_fn instead of the batched gathers (only kept for benchmarking)
         
         Approximates a tensor whose approximations are repeatedly fed in batch format to `self.train`
         '''
@@ -17,6 +21,7 @@ class CPDecomp(object):
         self.shape = shape
         self.ndims = ndims
         self.sess = sess
+        self.elementwise_loss = elementwise_loss
 
         with tf.device('/gpu:0'):
             # t-th batch tensor
@@ -117,28 +122,36 @@ class CPDecomp(object):
         L(X; U,V,W) = .5 sum_{i,j,k where X_ijk =/= 0} (X_ijk - sum_{r=1}^{R} U_ir V_jr W_kr)^2
         L_{rho} = L(X; U,V,W) + rho * (||U||^2 + ||V||^2 + ||W||^2) where ||.|| represents some norm (L2, L1, Frobenius)
         """
-        def L(X, U,V,W):
+        def L(X, factors):
             """
-            X is a sparse tensor. U,V,W are dense. 
+            X is a sparse tensor. `factors` are the dense U,V,W (one per mode).
             """
-            predict_val_fn = lambda x: tf.reduce_sum(tf.gather(self.U, x[0]) * tf.gather(self.V, x[1]) * tf.gather(self.W, x[2]))
-            predicted_vals = tf.map_fn(predict_val_fn, X.indices, dtype=tf.float32, parallel_iterations=200, infer_shape=False, back_prop=False)  # elementwise ops are slow as heck. and yet storing all the vects in memory is infeasible. Could try fitting the whole thing in memory just on GPU 1 or something, but it might just not fit. 3*N*R = too much? at what point is it too much?
+            if self.elementwise_loss:
+                predict_val_fn = lambda x: tf.reduce_sum(tf.gather(self.U, x[0]) * tf.gather(self.V, x[1]) * tf.gather(self.W, x[2]))
+                predicted_vals = tf.map_fn(predict_val_fn, X.indices, dtype=tf.float32, parallel_iterations=200, infer_shape=False, back_prop=False)  # elementwise ops are slow as heck.
+            else:
+                # Same as SymmetricCPDecomp: gather the rows of every mode's factor for the whole batch at once,
+                # then a single hadamard product and reduce_sum gives all N predictions.
+                indices = tf.transpose(X.indices)  # of shape (ndims, N)
+                prod_vects = tf.gather(factors[0], tf.gather(indices, 0, name='0_indices'), name='0_vects')
+                for i in range(1, self.ndims):
+                    prod_vects *= tf.gather(factors[i], tf.gather(indices, i, name='{}_indices'.format(i)), name='{}_vects'.format(i))
+                predicted_vals = tf.reduce_sum(prod_vects, axis=1)  # of shape (N,)
             errs = tf.squared_difference(predicted_vals, X.values)
             return tf.reduce_mean(errs)
 
-        def reg(U,V,W):
+        def reg(factors):
             # NOTE: l2_loss already squares the norms. So we don't need to square them.
-            summed_norms = (
-                tf.nn.l2_loss(U, name="U_norm") +
-                tf.nn.l2_loss(V, name="V_norm") +
-                tf.nn.l2_loss(W, name="W_norm")
-            )
+            summed_norms = tf.add_n([tf.nn.l2_loss(A, name="{}_norm".format(name)) for A, name in zip(factors, 'UVW')])
             return (.5 * reg_param) * summed_norms
 
+        factors = [self.U, self.V, self.W] if self.ndims > 2 else [self.U, self.V]
+        self.L = L(self.X_t, factors)
         if reg_param > 0.0:
-            self.loss = L(self.X_t, self.U,self.V,self.W) + reg(self.U, self.V, self.W)
+            self.reg = reg(factors)
         else:
-            self.loss = L(self.X_t, self.U,self.V,self.W)
+            self.reg = tf.constant(0.0)
+        self.loss = self.L + self.reg
         
     def get_train_ops(self):
         if self.optimizer_type == '2sgd':
@@ -168,42 +181,20 @@ class CPDecomp(object):
         batch_size = 1.
         eta_t = batch_size / (1. + t**alpha)
 
-        X_VW = tf.Variable(tf.constant(0.0, shape=[self.shape[0], self.rank]))
-        XU_W = tf.Variable(tf.constant(0.0, shape=[self.shape[1], self.rank]))
-        XUV_ = tf.Variable(tf.constant(0.0, shape=[self.shape[2], self.rank]))
-
-        def assign_zeroes():
-            a1 = tf.assign(X_VW, tf.constant(0.0, shape=[self.shape[0], self.rank]))
-            a2 = tf.assign(XU_W, tf.constant(0.0, shape=[self.shape[1], self.rank]))
-            a3 = tf.assign(XUV_, tf.constant(0.0, shape=[self.shape[2], self.rank]))
-            return tf.group(a1, a2, a3)
-
-        def body(ix, X_VW2,XU_W2,XUV_2,):
-            ijk = tf.gather(X.indices, ix)
-            val = tf.gather(X.values, ix)
-            Ui = tf.gather(self.U, ijk[0])  # R-dimensional
-            Vj = tf.gather(self.V, ijk[1])
-            Wk = tf.gather(self.W, ijk[2])
-
-            Xijk_Vj_Wk = val * tf.multiply(Vj, Wk) 
-            Xijk_Ui_Wk = val * tf.multiply(Ui, Wk) 
-            Xijk_Ui_Vj = val * tf.multiply(Ui, Vj) 
-
-            r1 = tf.scatter_add(X_VW, ijk[0], Xijk_Vj_Wk)  # add Xijk(Vj*Wk) to X_VW(i,:) (as vectors in \mathbb{R}^R)
-            r2 = tf.scatter_add(XU_W, ijk[1], Xijk_Ui_Wk)
-            r3 = tf.scatter_add(XUV_, ijk[2], Xijk_Ui_Vj)
-            new_ix = tf.add(ix, tf.constant(1))
-            return new_ix, r1, r2, r3
-
-        N = tf.shape(X.values)[0]
-        def cond(ix, *args):
-            ass = tf.cond(tf.equal(ix, tf.constant(0)), lambda: assign_zeroes(), lambda: tf.no_op())
-            with tf.control_dependencies([ass]):
-                return tf.less(ix, N)
-
-        printer = tf.Print(XUV_, [X_VW, XU_W, XUV_])
-        ix = tf.Variable(tf.constant(0, dtype=tf.int32))  # which index/value we're looking at
-        _, X_VW, XU_W, XUV_ = tf.while_loop(cond, body, [ix, X_VW, XU_W, XUV_])
+        # X_(1)(W . V), X_(2)(W . U), X_(3)(V . U) over the minibatch's nonzeros: gather the factor rows of every nonzero
+        # at once, and sum the products that land in the same row of each accumulator with one segment sum per mode.
+        indices = tf.transpose(X.indices)  # of shape (3, N)
+        i_ix = tf.gather(indices, 0)
+        j_ix = tf.gather(indices, 1)
+        k_ix = tf.gather(indices, 2)
+        Ui = tf.gather(self.U, i_ix)  # of shape (N, R)
+        Vj = tf.gather(self.V, j_ix)
+        Wk = tf.gather(self.W, k_ix)
+        vals = tf.expand_dims(X.values, 1)  # of shape (N, 1), broadcast over R
+
+        X_VW = tf.unsorted_segment_sum(vals * Vj * Wk, i_ix, self.shape[0])  # row i: sum_{j,k} X_ijk (V_j * W_k)
+        XU_W = tf.unsorted_segment_sum(vals * Ui * Wk, j_ix, self.shape[1])
+        XUV_ = tf.unsorted_segment_sum(vals * Ui * Vj, k_ix, self.shape[2])
 
         U = self.U
         V = self.V
@@ -251,9 +242,11 @@ class CPDecomp(object):
     def get_train_op_sgd(self):
         return self.optimizer.minimize(self.loss)
 
-    def train(self, expected_tensors, true_X=None, evaluate_every=100, results_file=None, write_loss=True, checkpoint_every=None):
+    def train(self, expected_tensors, true_X=None, evaluate_every=100, results_file=None, write_loss=True, checkpoint_every=None, prefetch_depth=4):
         '''
         Assumes `expected_tensors` is a generator of sparse tensor values. 
+        Unless it's already a Prefetcher, it gets wrapped in one that builds up to `prefetch_depth` batches in the
+        background while sess.run is busy (prefetch_depth=0 turns that off).
         '''
         self.batch_num = 0
         self.results_file = results_file
@@ -287,6 +280,9 @@ class CPDecomp(object):
                 os.makedirs(checkpoint_dir)
             self.saver = tf.train.Saver(tf.global_variables(), write_version=tf.train.SaverDef.V2)
 
+        if prefetch_depth > 0 and not isinstance(expected_tensors, Prefetcher):
+            expected_tensors = Prefetcher(expected_tensors, queue_depth=prefetch_depth)
+
         print('initializing variables...')
         self.sess.run(tf.global_variables_initializer())
         print("U: {}".format(self.U.eval(self.sess)))
@@ -305,6 +301,8 @@ class CPDecomp(object):
                 self.batch_num += 1
             if hasattr(self, 'avg_time') and results_file is not None:
                 print('avg batch time: {}'.format(self.avg_time), file=results_file)
+            if isinstance(expected_tensors, Prefetcher):
+                print(expected_tensors.report())
         if self.write_loss:
             self.train_summary_writer.close()
         if self.checkpoint_every is not None:
@@ -516,9 +514,13 @@ class SymmetricCPDecomp(object):
     def get_train_op_adam(self):
         return self.optimizer.minimize(self.loss)
 
-    def train(self, expected_tensors, results_file=None, write_loss=True, checkpoint_every=None):
+    def train(self, expected_tensors, results_file=None, write_loss=True, checkpoint_every=None, prefetch_depth=4, heldout=None, evaluate_every=1000):
         '''
         Assumes `expected_tensors` is a generator of sparse tensor values. 
+        Unless it's already a Prefetcher, it gets wrapped in one that builds up to `prefetch_depth` batches in the
+        background while sess.run is busy (prefetch_depth=0 turns that off).
+        `heldout` is an (indices, values, is_nonzero) set from cp_evaluation.sample_heldout to report the error on
+        every `evaluate_every` steps. For JointSymmetricCPDecomp, it's a list of them, one per order in dimlist.
         '''
         self.batch_num = 0
         self.results_file = results_file
@@ -549,6 +551,9 @@ class SymmetricCPDecomp(object):
                 os.makedirs(checkpoint_dir)
             self.saver = tf.train.Saver(tf.global_variables(), write_version=tf.train.SaverDef.V2)
 
+        if prefetch_depth > 0 and not isinstance(expected_tensors, Prefetcher):
+            expected_tensors = Prefetcher(expected_tensors, queue_depth=prefetch_depth)
+
         print('initializing variables...')
         self.sess.run(tf.global_variables_initializer())
         with self.sess.as_default():
@@ -562,6 +567,11 @@ class SymmetricCPDecomp(object):
                     print("INVALID ARG EXCEPTION: {}. Accidentally noninvertible matrix? There have been {} of these.".format(e, num_invalid_arg_exceptions))
                     import pdb; pdb.set_trace()
                 self.batch_num += 1
+                if heldout is not None and self.batch_num % evaluate_every == 0:
+                    evaluator = ReconstructionEvaluator((self.sparse_U if self.nonneg else self.U).eval(self.sess))
+                    print('Held-out error at step {}: {}'.format(self.batch_num, format_heldout(evaluator, heldout)))
+            if isinstance(expected_tensors, Prefetcher):
+                print(expected_tensors.report())
             if self.checkpoint_every is not None:
                 try:
                     path = self.saver.save(self.sess, checkpoint_dir, global_step=tf.train.global_step(self.sess, self.global_step))
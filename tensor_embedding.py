@@ -1,25 +1,38 @@
-from collections import defaultdict
 import itertools
+import json
+import math
 import numpy as np
 import os
-import random
-import tensorflow as tf
-from tensor_decomp import CPDecomp
+import shutil
 import time
 import scipy
+import scipy.linalg
+import scipy.sparse
+import scipy.sparse.linalg
 
+from cooccurrence import count_batch, expand_permutations, extract_cooccurrences, ExternalCounts, index_dtype, iter_expand_permutations, PackedCounts, parallel_count
+from cp_numpy import factor_value
+from embedding_io import write_model_embedding
 from joblib import Parallel, delayed
 
 
-def update_counts(self, batch):
-    ''' for parallel processing, of speed is an issue '''
-    batch_counts = defaultdict(int)
-    self.uni_counts = batch_counts
-    # create own count here, return it, union them together
-    for cooccurrence in self.get_indices(batch, update_uni_counts=True):
-        batch_counts[cooccurrence] += 1
-    num_samples = len(batch)
-    return batch_counts, num_samples
+GATHERER_FORMAT_VERSION = 1  # bump whenever the layout written by PMIGatherer.save changes
+
+
+def pmi_values(ngram_counts, word_counts, num_samples, shift=0.0, positive=False):
+    '''
+    Vectorized (shifted, positive) PMI. ngram_counts[i] is #(x_1,...,x_n) and word_counts[i] is the row
+    (#(x_1), ..., #(x_n)) of unigram counts of the same n-gram, e.g. uni_counts[indices] for a dense unigram count vector.
+        PMI = log(#(x_1,...,x_n)) + (n-1)*log(|D|) - log(#(x_1)) - ... - log(#(x_n)) + shift
+    If positive, negative values are clipped to 0 (PPMI).
+    '''
+    word_counts = np.asarray(word_counts)
+    n = word_counts.shape[1]
+    values = np.log2(ngram_counts) + (n - 1) * np.log2(num_samples) - np.log2(word_counts).sum(axis=1)
+    values += shift
+    if positive:
+        np.maximum(values, 0.0, out=values)
+    return values
 
 
 class TensorEmbedding(object):
@@ -35,32 +48,7 @@ class TensorEmbedding(object):
         self.vocab_len = len(self.model.vocab)
 
     def write_embedding_to_file(self, fname='vectors.txt'):
-        vectors = {}
-        model = self.model
-        embedding = self.get_embedding_matrix()
-        count = 0 # number of vects written
-        for word in model.vocab:
-            word_vocab = model.vocab[word]
-            word_vect = embedding[word_vocab.index]
-            vect_list = ['{:.3f}'.format(x) for x in word_vect]
-            vectors[word] = ' '.join(vect_list)
-        with open(fname, 'w') as f:
-            for word in vectors:
-                if not word:
-                    continue
-                try:
-                    f.write(word.encode('utf-8') + ' ' + vectors[word] + '\n')
-                    count += 1
-                except TypeError:
-                    f.write(word + ' ' + vectors[word] + '\n')
-                    count += 1
-                except:
-                    pass
-        with open(fname, 'r+') as f:
-            content = f.read()
-            f.seek(0, 0)
-            f.write('{} {}\n'.format(count, self.embedding_dim))  # write the number of vects
-            f.write(content)
+        write_model_embedding(self.get_embedding_matrix(), self.model, fname, precision=3)
 
     def evaluate(self, rel_path='vectors.txt'):
         self.write_embedding_to_file(fname=rel_path)
@@ -71,7 +59,7 @@ class TensorEmbedding(object):
         print('done evaluating.')
 
     def get_embedding_matrix(self):
-        embedding = self.decomp_method.U.eval(self.sess)
+        embedding = factor_value(self.decomp_method.U, self.sess)
         return embedding
 
     def update_counts_with_sent_info(self, sent, counts):
@@ -99,6 +87,7 @@ class TensorEmbedding(object):
             return counts
 
     def convert_batches_to_sp_tensor(self, batches):
+        import tensorflow as tf
         for batch in batches:
             counts = {}
             for sent in batch:
@@ -131,7 +120,14 @@ class PpmiSvdEmbedding(TensorEmbedding):
         super(PpmiSvdEmbedding, self).__init__(vocab_model, embedding_dim)
         self.optimizer_type = 'svd'
 
-    def learn_embedding(self, ppmi_tensor):
+    def learn_embedding(self, ppmi_tensor, svd_method='lanczos'):
+        '''
+        If `ppmi_tensor` is a scipy sparse matrix, only its top embedding_dim singular vectors are computed, with
+        `svd_method` 'lanczos' (ARPACK, scipy.sparse.linalg.svds) or 'randomized' (sklearn's randomized_svd).
+        A dense array gets a full SVD.
+        '''
+        if scipy.sparse.issparse(ppmi_tensor):
+            return self.learn_embedding_sparse(ppmi_tensor, svd_method=svd_method)
         print('getting svd of ppmi_tensor (shape: {})'.format(ppmi_tensor.shape))
         U,S,V = np.linalg.svd(ppmi_tensor)
 
@@ -144,6 +140,38 @@ class PpmiSvdEmbedding(TensorEmbedding):
         predicted = np.dot(self.embedding, self.C_embedding.T)
         print("RMSE: {}".format(np.sqrt(((ppmi_tensor - predicted) ** 2).mean())))
 
+    def learn_embedding_sparse(self, ppmi_matrix, svd_method='lanczos', seed=0):
+        print('getting rank-{} {} svd of sparse ppmi matrix (shape: {}, {} nonzeros)'.format(self.embedding_dim, svd_method, ppmi_matrix.shape, ppmi_matrix.nnz))
+        ppmi_matrix = scipy.sparse.csr_matrix(ppmi_matrix, dtype=np.float64)
+        if svd_method == 'lanczos':
+            # a seeded starting vector rather than random_state, which svds only takes from SciPy 1.9 on
+            v0 = np.random.RandomState(seed).uniform(-1, 1, min(ppmi_matrix.shape))
+            U, S, V = scipy.sparse.linalg.svds(ppmi_matrix, k=self.embedding_dim, v0=v0)
+            order = np.argsort(S)[::-1]  # svds doesn't return them largest first
+            U, S, V = U[:, order], S[order], V[order]
+        elif svd_method == 'randomized':
+            from sklearn.utils.extmath import randomized_svd
+            U, S, V = randomized_svd(ppmi_matrix, n_components=self.embedding_dim, random_state=seed)
+        else:
+            raise ValueError('svd_method must be lanczos or randomized. Got {}'.format(svd_method))
+        sqrt_S = np.sqrt(S)  # sqrtm of the diagonal S_d
+        self.embedding = U * sqrt_S
+        self.C_embedding = V.T * sqrt_S
+        print("RMSE (observed entries): {}".format(self.observed_rmse(ppmi_matrix)))
+
+    def observed_rmse(self, sparse_matrix, chunk_size=int(1e6)):
+        ''' RMSE of embedding . C_embedding^T over the stored entries of `sparse_matrix` only '''
+        coo = sparse_matrix.tocoo()
+        if coo.nnz == 0:
+            return 0.0
+        sq_err = 0.0
+        for start in range(0, coo.nnz, chunk_size):
+            rows = coo.row[start:start + chunk_size]
+            cols = coo.col[start:start + chunk_size]
+            predicted = np.einsum('ij,ij->i', self.embedding[rows], self.C_embedding[cols])
+            sq_err += np.sum(np.square(coo.data[start:start + chunk_size] - predicted))
+        return np.sqrt(sq_err / coo.nnz)
+
     def get_embedding_matrix(self):
         return self.embedding
 
@@ -173,7 +201,7 @@ class PMIGatherer(object):
                            = log(#(x,y,z)) + 2*log(|D|) - log(#(x)) - log(#(y)) - log(#(z))
         """
         if args not in self.valid_indices:
-            # check in the set so we don't have to store a new tuple for each thing not in the defaultdict
+            # check in valid_indices first so entries with tiny counts get 0 PMI
             return 0.0
         log_num = np.log2(self.n_counts[args]) + (self.n - 1)*np.log2(self.num_samples)
         log_denom = 0.0
@@ -182,65 +210,171 @@ class PMIGatherer(object):
         pmi = log_num - log_denom
         return pmi
 
+    def PMI_array(self, indices, counts=None):
+        '''
+        PMI of every row of the (N, n) array of indices at once. Same values as PMI(*indices[i]) for every i,
+        including 0 for entries that aren't in valid_indices.
+        counts can be passed in if they're already known (e.g. self.n_counts.counts for self.n_counts.indices()).
+        '''
+        indices = np.asarray(indices)
+        if counts is None:
+            counts = self.n_counts.lookup(indices)
+        valid = self.valid_indices.contains(indices)
+        values = np.zeros(len(indices), dtype=np.float64)
+        values[valid] = pmi_values(counts[valid], self.uni_counts[indices[valid]], self.num_samples)
+        return values
+
     def kill_ncounts(self, p=0.5, m=1):
         '''
         kills `p` percent of the things with count <= m
         '''
         print(len(self.n_counts))
         print('killing {} of the count-{} n_counts...'.format(p, m))
-        keys = [x for x in self.n_counts]
-        for ix in keys:
-            if self.n_counts[ix] <= m:
-                if random.random() < p:
-                    del self.n_counts[ix]
+        self.n_counts.flush()
+        kill = self.n_counts.counts <= m
+        if p < 1.0:
+            kill &= np.random.rand(len(kill)) < p
+        self.n_counts = self.n_counts.subset(~kill)
         print(len(self.n_counts))
 
-    def populate_counts(self, batches, huge_vocab=True, min_count=1):
+    def populate_counts(self, batches, huge_vocab=True, min_count=1, memory_budget=int(4e9), count_dir=None):
         '''
         `batches` is a generator of (context, word) tuples,
             where `context` is like [98345, 2348975, 38239, 138492, 3829, 329] (indices into the vocab) 
             and `word` is like 3829 (index into the vocab)
 
+        n-gram counts are kept exactly in a PackedCounts (sorted uint64 keys + uint32 counts), unigram counts in a
+        dense array indexed by vocab index.
+        If `huge_vocab`, counting happens out of core (see cooccurrence.ExternalCounts): at most `memory_budget` bytes
+        of counts are kept in RAM, the rest is spilled to `count_dir` (a temp dir by default) and merged at the end
+        into a memory mapped count file there.
         '''
         print('Gathering counts...')
         self.num_samples = 0
-        self.uni_counts = defaultdict(int)
-        self.n_counts = defaultdict(int)
+        self.uni_counts = np.zeros(self.vocab_len, dtype=np.int64)
+        self.n_counts = PackedCounts(self.n, self.vocab_len)
 
         print('getting counts...')
         t = time.time()
         if huge_vocab:  # memory is more important than time
+            external_counts = ExternalCounts(self.n, self.vocab_len, memory_budget=memory_budget, dirname=count_dir)
             for i, batch in enumerate(batches):
-                for ix in self.get_indices(batch, update_uni_counts=True):
-                    self.n_counts[ix] += 1
-                if len(self.n_counts) > 1e8:
-                    self.kill_ncounts(0.5, 1)
-                    remaining = len(self.n_counts)
-                    if remaining > 9e7:
-                        self.kill_ncounts(0.6, 2)
-                        remaining = len(self.n_counts)
-                        if remaining > 8e7:
-                            self.kill_ncounts(0.7, 3)
+                external_counts.add(self.get_index_array(batch, update_uni_counts=True))
+            print('Merging n_counts (keeping n > {})...'.format(min_count))
+            self.n_counts = external_counts.finalize(min_count=min_count + 1)
         else:  # time is more impt than memory
             print('Populating count dicts (in parallel)...')
-            batch_counts, n_samples_per_batch = zip(*Parallel(n_jobs=50)(delayed(update_counts)(self, b) for b in batches))
+            # count_batch is handed just the batch (not the gatherer), so there's nothing big to pickle per job
+            batch_counts, batch_uni_counts, n_samples_per_batch = zip(*Parallel(n_jobs=50)(delayed(count_batch)(b, self.n, self.vocab_len) for b in batches))
             print('joining count dicts...')
-            for d in batch_counts:
-                for k in d.keys():
-                    if isinstance(k, tuple):
-                        self.n_counts[k] += d[k]
-                    else:
-                        self.uni_counts[k] += d[k]
+            for counts in batch_counts:
+                self.n_counts.update(counts)
+            self.uni_counts = sum(batch_uni_counts)
             self.num_samples = sum(n_samples_per_batch)
-        print('Killing all n_counts with n < {}'.format(min_count))
-        self.kill_ncounts(p=1.0, m=min_count)  # kill everything with a count of `min_count` - it's gonna have low PPMI anyway (since everything has a huge mincount). 
-        self.valid_indices = {k for k in self.n_counts if self.n_counts[k] > 5}
+            self.n_counts.flush()
+            print('{} n_counts taking {:.1f} MB'.format(len(self.n_counts), self.n_counts.nbytes / 1e6))
+            print('Killing all n_counts with n < {}'.format(min_count))
+            self.kill_ncounts(p=1.0, m=min_count)  # kill everything with a count of `min_count` - it's gonna have low PPMI anyway (since everything has a huge mincount). 
+        self.valid_indices = self.n_counts.subset(self.n_counts.counts > 5)
         print('Gathering counts took {} secs'.format(time.time() - t))
 
+    def populate_counts_from_file(self, fname, processes=None, min_count=1, count_dir=None, batch_size=1000):
+        '''
+        Multiprocess version of `populate_counts` for a tokenized corpus file (one sentence per line, like
+        GensimSandbox.sentences_generator_tokenized reads). Workers count disjoint byte ranges of the file and their
+        counts get merged in parallel (see cooccurrence.parallel_count). Sentences are chunked like batch_generator2.
+        '''
+        print('Gathering counts from {} with {} processes...'.format(fname, processes or 'all'))
+        t = time.time()
+        word_index = {word: vocab.index for word, vocab in self.model.vocab.items()}
+        self.n_counts, self.uni_counts, self.num_samples = parallel_count(
+            fname,
+            word_index,
+            n=self.n,
+            vocab_len=self.vocab_len,
+            chunk_len=1 + 2*self.model.window,
+            processes=processes,
+            dirname=count_dir,
+            min_count=min_count + 1,  # kill everything with a count of `min_count`, like populate_counts
+            batch_size=batch_size,
+        )
+        self.valid_indices = self.n_counts.subset(self.n_counts.counts > 5)
+        print('Gathering {} n_counts took {} secs'.format(len(self.n_counts), time.time() - t))
+
+    def save(self, dirname):
+        '''
+        Writes the counts as plain arrays, so `load` can memory map them instead of unpickling:
+            meta.json                           format_version, n, vocab_len, num_samples
+            uni_counts.npy                      dense unigram counts
+            n_counts/{keys,counts}.npy          sorted packed n-gram keys and their counts (see cooccurrence.PackedCounts)
+            valid_indices/{keys,counts}.npy     the same for the n-grams that get a nonzero PMI
+        The vocab model isn't saved; it's passed to `load` instead.
+        '''
+        t = time.time()
+        tmp_dirname = dirname + '.tmp'
+        if os.path.exists(tmp_dirname):
+            shutil.rmtree(tmp_dirname)
+        os.makedirs(tmp_dirname)
+        np.save(os.path.join(tmp_dirname, 'uni_counts.npy'), np.asarray(self.uni_counts))
+        self.n_counts.save(os.path.join(tmp_dirname, 'n_counts'))
+        self.valid_indices.save(os.path.join(tmp_dirname, 'valid_indices'))
+        meta = {
+            'format_version': GATHERER_FORMAT_VERSION,
+            'n': self.n,
+            'vocab_len': self.vocab_len,
+            'num_samples': int(self.num_samples),
+        }
+        # meta.json goes last, and the directory is only moved into place once it's complete
+        with open(os.path.join(tmp_dirname, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+        if os.path.exists(dirname):
+            shutil.rmtree(dirname)
+        os.rename(tmp_dirname, dirname)
+        print('Saving gatherer to {} took {} secs'.format(dirname, time.time() - t))
+
+    @staticmethod
+    def exists(dirname):
+        return os.path.exists(os.path.join(dirname, 'meta.json'))
+
+    @staticmethod
+    def load(dirname, vocab_model, mmap_mode='r'):
+        ''' Opens a gatherer written by `save`. All the count arrays are memory mapped (unless mmap_mode is None) '''
+        t = time.time()
+        with open(os.path.join(dirname, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta.get('format_version') != GATHERER_FORMAT_VERSION:
+            raise ValueError('{} has gatherer format version {}, but this code reads version {}'.format(
+                dirname, meta.get('format_version'), GATHERER_FORMAT_VERSION))
+        gatherer = PMIGatherer(vocab_model, n=meta['n'])
+        if gatherer.vocab_len != meta['vocab_len']:
+            raise ValueError('The vocab model has {} words, but the gatherer in {} was made with {}'.format(
+                gatherer.vocab_len, dirname, meta['vocab_len']))
+        gatherer.num_samples = meta['num_samples']
+        gatherer.uni_counts = np.load(os.path.join(dirname, 'uni_counts.npy'), mmap_mode=mmap_mode)
+        gatherer.n_counts = PackedCounts.load(os.path.join(dirname, 'n_counts'), gatherer.n, gatherer.vocab_len, mmap_mode=mmap_mode)
+        gatherer.valid_indices = PackedCounts.load(os.path.join(dirname, 'valid_indices'), gatherer.n, gatherer.vocab_len, mmap_mode=mmap_mode)
+        print('Loading gatherer ({} n_counts) took {:.3f} secs'.format(len(gatherer.n_counts), time.time() - t))
+        return gatherer
+
+
+    def get_index_array(self, batch, update_uni_counts=False, return_set=False):
+        '''
+        Vectorized version of `get_indices`. Same indices in the same order, but as an (N, n) int32 array.
+        `batch` can be a list of chunks or an already padded array (see cooccurrence.pad_batch).
+        If `return_set`, the duplicate rows are dropped (and the rest sorted) instead of building a python set.
+        '''
+        indices, words = extract_cooccurrences(batch, self.n)
+        if update_uni_counts:
+            self.uni_counts += np.bincount(words, minlength=len(self.uni_counts))
+            self.num_samples += len(words)
+        if return_set:
+            indices = np.unique(indices, axis=0)
+        return indices
 
     def get_indices(self, batch, update_uni_counts=False, return_set=False):
         '''
         We are assuming each sent chunk in each batch we want to keep the co-occurrence count of.
+        Reference (pure python) implementation of `get_index_array`. Kept around for benchmarks.py.
         '''
         # set of indices, which are all ordered in ascending order, then we just permute everything at lookup time
         #       i.e. if indices = {(1,2,3)}, the indices gets expanded to [(1,2,3), (2,1,3), (3,2,1), ..., (1,3,2)] and the corresponding PMI vals get added
@@ -287,6 +421,45 @@ class PMIGatherer(object):
             pass
         return indices
 
+    def create_pmi_matrix(self, positive=True, shift=0.0):
+        '''
+        The (P)PMI matrix of a bigram (n=2) gatherer as a |V|x|V| scipy CSR matrix. Same entries as
+        create_pmi_tensor(numpy_dense_tensor=True, ...) without ever making the dense matrix.
+        '''
+        if self.n != 2:
+            raise ValueError('create_pmi_matrix needs a gatherer with n=2. This one has n={}'.format(self.n))
+        indices, values = self.create_pmi_tensor(positive=positive, symmetric=False, shift=shift)
+        indices = np.reshape(indices, (-1, 2))
+        # duplicates get summed, just like the += into the dense tensor
+        return scipy.sparse.csr_matrix((np.reshape(values, (-1,)).astype(np.float64), (indices[:, 0], indices[:, 1])), shape=(self.vocab_len, self.vocab_len))
+
+    def sample_negatives(self, num_samples, dtype=np.int64):
+        '''
+        Random values with zero PMI so the model doesn't just predict everything to have (mean) PMI: up to
+        `num_samples` random sorted n-grams that were never counted, as ((m, n) indices, (m,) zero values).
+        '''
+        new_indices = []
+        for _ in range(int(num_samples)):
+            ix = np.random.randint(low=0, high=len(self.model.vocab), size=(self.n,))
+            ix = tuple(sorted(ix))
+            if ix not in self.n_counts:
+                new_indices.append(ix)
+        return np.asarray(new_indices, dtype=dtype).reshape(-1, self.n), np.zeros(len(new_indices))
+
+    def add_negative_samples(self, indices, values, neg_sample_percent, symmetric=False):
+        '''
+        A batch of positive entries (e.g. streamed from a PMIBatchCache) plus fresh negative samples, as many as
+        create_pmi_tensor(neg_sample_percent=...) would add to it. If not symmetric, the batch is already expanded
+        into its permutations, and so are the negatives.
+        '''
+        indices = np.reshape(indices, (-1, self.n))
+        values = np.reshape(values, (-1,))
+        num_entries = len(indices) if symmetric else len(indices) // math.factorial(self.n)
+        new_indices, new_values = self.sample_negatives(neg_sample_percent * num_entries, dtype=indices.dtype)
+        if not symmetric:
+            new_indices, new_values = expand_permutations(new_indices, new_values, dtype=indices.dtype)
+        return np.vstack((indices, new_indices)), np.concatenate((values, new_values.astype(values.dtype)))
+
     def create_pmi_tensor(self, 
         batch=None,
         positive=True,
@@ -298,24 +471,30 @@ class PMIGatherer(object):
         neg_sample_percent: float=0.0,
         pmi=True,
         shift=0.0,
+        expand_chunk_size=None,
     ):
+        '''
+        Returns (indices, values) of the sparse (P)PMI tensor, or a dense array if numpy_dense_tensor.
+        If not symmetric, every entry is expanded into its n! permutations. With expand_chunk_size, that expansion is
+        streamed instead: a generator of (indices, values) chunks of at most expand_chunk_size entries is returned.
+        '''
         if log_info:
             print('Creating Sparse PMI tensor...', end='')
         t = time.time()
-        if batch:
-            indices = self.get_indices(batch, return_set=True)
-            indices = list(self.valid_indices.intersection(indices))
+        if batch is not None and len(batch) > 0:
+            indices = self.get_index_array(batch, return_set=True)
+            indices = self.valid_indices.intersection(indices)
+            counts = self.valid_indices.lookup(indices)
         else:
-            indices = list(self.n_counts.keys())
-
-        values = np.zeros(len(indices), dtype=np.float32) 
-        for i in range(len(indices)):
-            if pmi:
-                values[i] = self.PMI(*indices[i])  # NOTE: if this becomes unbearably slow, you are out of ram. decrease batch size. 
-            else:
-                values[i] += self.n_counts[indices[i]]
+            indices = self.n_counts.indices()
+            counts = self.n_counts.counts
+
+        if pmi:
+            values = self.PMI_array(indices, counts=counts).astype(np.float32)
+        else:
+            values = counts.astype(np.float32)
         shape = (self.vocab_len,) * self.n
-        indices = np.asarray(indices, dtype=np.uint16)
+        indices = np.asarray(indices, dtype=index_dtype(self.vocab_len))
         if limit_large_vals:
             new_indices = []
             new_vals = []
@@ -332,21 +511,7 @@ class PMIGatherer(object):
             indices = np.squeeze(indices[positive_args])  # squeeze to get rid of the 1-dimension columns (resulting from the indices[positive_args])
             values = np.squeeze(values[positive_args])
         if neg_sample_percent > 0.0:
-            '''
-            Add random values with zero PMI so it doesn't just predict everything to have (mean) PMI
-            '''
-            new_indices = []
-            new_values = []
-            for _ in range(int(neg_sample_percent * len(indices))):
-                ix = np.random.randint(low=0, high=len(self.model.vocab), size=(self.n,))
-                ix = tuple(sorted(ix))
-                if ix not in self.n_counts:
-                    if len(ix) < self.n:
-                        continue
-                    new_indices.append(ix)
-                    new_values.append(0.0)
-            new_indices = np.asarray(new_indices, dtype=np.uint16)
-            new_values = np.asarray(new_values)
+            new_indices, new_values = self.sample_negatives(neg_sample_percent * len(indices), dtype=indices.dtype)
             indices = np.vstack((indices, new_indices))
             values = np.concatenate((values, new_values))
         if debug and self.debug:
@@ -360,19 +525,13 @@ class PMIGatherer(object):
             #import pdb; pdb.set_trace()
             pass
         if not symmetric:
-            n_fact = int(scipy.misc.factorial(self.n))
-            indices_extended = np.zeros((n_fact*len(indices), self.n), dtype=np.int16)
-            values_extended = np.zeros((n_fact*len(indices),), dtype=np.float32)
-            for i in range(len(indices)):
-                tup = indices[i]
-                j = 0
-                for perm in itertools.permutations(range(self.n)):
-                    for k, sigma in enumerate(perm):
-                        indices_extended[n_fact*i+j][perm[k]] = tup[k]
-                        values_extended[n_fact*i+j] = values[i]
-                    j += 1
-            indices = indices_extended
-            values = values_extended
+            values = np.asarray(values, dtype=np.float32)
+            if expand_chunk_size and not numpy_dense_tensor:
+                if log_info:
+                    print('streaming {} values in chunks of {}...'.format(len(indices) * math.factorial(self.n), expand_chunk_size), end='')
+                    print('took {} secs'.format(int(time.time() - t)))
+                return iter_expand_permutations(indices, values, expand_chunk_size, dtype=index_dtype(self.vocab_len))
+            indices, values = expand_permutations(indices, values, dtype=index_dtype(self.vocab_len))
         if numpy_dense_tensor:
             ''' Probably not gonna wanna do this if you're bigger than 2 dimensions. '''
             ppmi_tensor = np.zeros(shape)
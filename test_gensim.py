@@ -1,5 +1,7 @@
 #import _pickle as pickle  # python 3's cPickle
+import contextlib
 import datetime
+import functools
 import dill
 import gensim
 import gensim.utils
@@ -12,12 +14,16 @@ import select
 import shutil
 import sys
 import time
-import tensorflow as tf
 
+from batch_cache import cache_dirname, joint_epochs, PMIBatchCache, PMIBatchCacheWriter
+from cooccurrence import index_dtype
+from cp_evaluation import format_errors, ReconstructionEvaluator, sample_heldout
+from cp_numpy import factor_value, NumpyCPDecomp, NumpySymmetricCPDecomp, NumpyJointSymmetricCPDecomp
 from embedding_evaluation import write_embedding_to_file, evaluate, EmbeddingTaskEvaluator
 from gensim_utils import batch_generator, batch_generator2
+from prefetch import Prefetcher
 from tensor_embedding import PMIGatherer, PpmiSvdEmbedding
-from tensor_decomp import CPDecomp, SymmetricCPDecomp, JointSymmetricCPDecomp
+from token_cache import TokenCache
 from nltk.corpus import stopwords
 
 
@@ -27,12 +33,20 @@ stopwords = stopwords.union(grammar_stopwords)
 
 
 class GensimSandbox(object):
-    def __init__(self, method, embedding_dim, num_articles, min_count, gpu=True):
+    def __init__(self, method, embedding_dim, num_articles, min_count, gpu=True, num_epochs=1, cache_batches=False, prefetch_workers=1, backend='tensorflow', token_cache=False, count_processes=0):
         self.method = method
         self.embedding_dim = int(embedding_dim)
         self.min_count = int(min_count)
         self.num_articles = int(num_articles)
         self.gpu = gpu
+        self.num_epochs = int(num_epochs)
+        self.cache_batches = cache_batches  # materialize the PMI minibatches on disk once, then stream every epoch from there
+        self.prefetch_workers = int(prefetch_workers)  # threads building PMI minibatches while the optimizer runs
+        if backend not in ('tensorflow', 'numpy'):
+            raise ValueError('backend must be tensorflow or numpy. Got {}'.format(backend))
+        self.backend = backend  # which implementation of the CP decompositions to train with
+        self.token_cache = token_cache  # read the corpus once into a memmap of vocab indices, then chunk it from there
+        self.count_processes = int(count_processes)  # if > 0, count the n-grams from a tokenized corpus file with that many processes
         if '--buildvocab' in sys.argv:
             self.buildvocab = True
         else:
@@ -48,7 +62,8 @@ class GensimSandbox(object):
         if num_articles is None:
             num_articles = self.num_articles
         gzipped_wiki = '/home/eric/code/enwiki-latest-pages-articles.xml.bz2'
-        wiki = gensim.corpora.wikicorpus.WikiCorpus(gzipped_wiki, dictionary={})
+        # each worker decompresses and parses its own range of bz2 blocks, so this scales with the number of cores
+        wiki = gensim.corpora.wikicorpus.WikiCorpus(gzipped_wiki, dictionary={}, parallel_read=True)
         articles = wiki.get_texts()
         n_tokens = 0
         count = 0
@@ -121,13 +136,71 @@ class GensimSandbox(object):
         self.model = model
         return self.model
 
+    def chunk_batches(self, batch_size):
+        '''
+        batch_generator2 over the first self.num_articles articles. With self.token_cache, the articles are tokenized and
+        looked up in the vocab only once, and every later call chunks the cached indices (as padded arrays).
+        '''
+        if not self.token_cache:
+            return batch_generator2(self.model, self.sentences_generator(num_articles=self.num_articles), batch_size=batch_size)
+        return self.get_token_cache().batches(1 + 2 * self.model.window, batch_size, padded=True)
+
+    def get_token_cache(self):
+        dirname = 'tokens_{}_{}'.format(self.num_articles, self.min_count)
+        return TokenCache.load_or_build(
+            dirname, self.model, lambda: self.sentences_generator(num_articles=self.num_articles),
+            params=dict(num_articles=self.num_articles, min_count=self.min_count),
+        )
+
+    def corpus_file(self):
+        '''
+        The first self.num_articles articles as a tokenized text file (one article per line, in-vocab words only), for
+        PMIGatherer.populate_counts_from_file. Written once; from the token cache if self.token_cache.
+        '''
+        fname = 'corpus_{}_{}.txt'.format(self.num_articles, self.min_count)
+        if os.path.exists(fname):
+            return fname
+        print('Writing tokenized corpus to {}...'.format(fname))
+        if self.token_cache:
+            tokens = self.get_token_cache()
+            words = np.asarray(self.model.index2word, dtype=object)
+            sentences = (words[tokens.sentence(i)] for i in range(len(tokens)))
+        else:
+            sentences = ([w for w in article if w in self.model.vocab] for article in self.sentences_generator(num_articles=self.num_articles))
+        with open(fname + '.tmp', 'w', encoding='utf8') as f:
+            for sentence in sentences:
+                f.write(' '.join(sentence) + '\n')
+        os.rename(fname + '.tmp', fname)
+        return fname
+
+    def get_decomp_backend(self):
+        '''
+        Returns ((CPDecomp, SymmetricCPDecomp, JointSymmetricCPDecomp), session scope) for self.backend.
+        TensorFlow is only imported (and self.sess only created) for the tensorflow backend.
+        '''
+        if self.backend == 'numpy':
+            return (NumpyCPDecomp, NumpySymmetricCPDecomp, NumpyJointSymmetricCPDecomp), contextlib.suppress()  # no-op context
+        import tensorflow as tf
+        from tensor_decomp import CPDecomp, SymmetricCPDecomp, JointSymmetricCPDecomp
+        config = tf.ConfigProto(
+            allow_soft_placement=True,
+        )
+        self.sess = tf.Session(config=config)
+        return (CPDecomp, SymmetricCPDecomp, JointSymmetricCPDecomp), self.sess.as_default()
+
     def list_vars_in_checkpoint(self, dirname):
         ''' Just for tf debugging.  '''
+        import tensorflow as tf
         from tensorflow.contrib.framework.python.framework.checkpoint_utils import list_variables
         abspath = os.path.abspath(dirname)
         return list_variables(abspath)
 
     def create_embedding_visualization(self):
+        try:
+            import tensorflow as tf
+        except ImportError:
+            print('tensorflow is not installed. Skipping the embedding visualization.')
+            return
         config = tf.ConfigProto(
             allow_soft_placement=True,
         )
@@ -175,29 +248,23 @@ class GensimSandbox(object):
         self.embedding = self.model.syn0
 
     def get_pmi_gatherer(self, n):
-        gatherer = None
-        if os.path.exists('gatherer_{}_{}_{}.pkl'.format(self.num_articles, self.min_count, n)):
-            with open('gatherer_{}_{}_{}.pkl'.format(self.num_articles, self.min_count, n), 'rb') as f:
-                t = time.time()
-                import gc; gc.disable()
-                gatherer = dill.load(f)
-                gc.enable()
-                print('Loading gatherer took {} secs'.format(time.time() - t))
+        dirname = 'gatherer_{}_{}_{}'.format(self.num_articles, self.min_count, n)
+        if PMIGatherer.exists(dirname):
+            gatherer = PMIGatherer.load(dirname, self.model)
         else:
-            # batch_size doesn't matter. But higher is probably better (in terms of threading & speed)
-            batches = batch_generator2(self.model, self.sentences_generator(num_articles=self.num_articles), batch_size=1000)
             gatherer = PMIGatherer(self.model, n=n)
-            if self.num_articles <= 1e4:
-                gatherer.populate_counts(batches, huge_vocab=False)
+            if self.count_processes > 0:
+                # same counts as populate_counts below, counted by worker processes over byte ranges of the corpus file
+                min_count = 1 if self.num_articles <= 1e4 else 5
+                gatherer.populate_counts_from_file(self.corpus_file(), processes=self.count_processes, min_count=min_count)
             else:
-                gatherer.populate_counts(batches, huge_vocab=True, min_count=5)
-
-            with open('gatherer_{}_{}_{}.pkl'.format(self.num_articles, self.min_count, n), 'wb') as f:
-                t = time.time()
-                import gc; gc.disable()
-                dill.dump(gatherer, f)
-                gc.enable()
-                print('Dumping gatherer took {} secs'.format(time.time() - t))
+                # batch_size doesn't matter. But higher is probably better (in terms of threading & speed)
+                batches = self.chunk_batches(batch_size=1000)
+                if self.num_articles <= 1e4:
+                    gatherer.populate_counts(batches, huge_vocab=False)
+                else:
+                    gatherer.populate_counts(batches, huge_vocab=True, min_count=5)
+            gatherer.save(dirname)
         return gatherer
 
     def train_joint_online_cp_embedding(self, dimlist: list, dimweights: list, nonneg: bool):
@@ -205,29 +272,49 @@ class GensimSandbox(object):
         exp_shifts = [1., 1.]
         shifts = [-np.log2(s) for s in exp_shifts]
 
-        def sparse_tensor_batches(batch_size=1000):
-            batches = batch_generator2(self.model, self.sentences_generator(num_articles=self.num_articles), batch_size=batch_size)
-            for batch in batches:
-                pairlist = [
-                    gatherer.create_pmi_tensor(
-                        batch=batch,
-                        positive=True,
-                        debug=False,
-                        symmetric=True,
-                        log_info=False,
-                        neg_sample_percent=0.0,
-                        pmi=True,
-                        shift=shift,
-                    )
-                    for (shift, gatherer) in zip(shifts, gatherers)
-                ]
-                yield ([x[0] for x in pairlist], [x[1] for x in pairlist])
+        def batch_to_tensors(batch):
+            pairlist = [
+                gatherer.create_pmi_tensor(
+                    batch=batch,
+                    positive=True,
+                    debug=False,
+                    symmetric=True,
+                    log_info=False,
+                    neg_sample_percent=0.0,
+                    pmi=True,
+                    shift=shift,
+                )
+                for (shift, gatherer) in zip(shifts, gatherers)
+            ]
+            return ([x[0] for x in pairlist], [x[1] for x in pairlist])
+
+        def sparse_tensor_batches(batch_size=1000, num_epochs=1):
+            # one Prefetcher over all the epochs, building the PMI tensors of the next batches in background threads
+            batches = (batch for _ in range(num_epochs) for batch in self.chunk_batches(batch_size=batch_size))
+            return Prefetcher(batches, fn=batch_to_tensors, num_workers=self.prefetch_workers)
+
+        if self.cache_batches:
+            paramlist = [
+                dict(num_articles=self.num_articles, min_count=self.min_count, n=dim, shift=shift, symmetric=True, neg=0.0, batch_size=1000)
+                for (shift, dim) in zip(shifts, dimlist)
+            ]
+            dirnames = [cache_dirname(**params) for params in paramlist]
+            if not all(PMIBatchCache.exists(dirname) for dirname in dirnames):
+                # fill the caches of all dims in a single pass through the corpus
+                print('Caching joint PMI batches to {}...'.format(dirnames))
+                writers = [PMIBatchCacheWriter(dirname, dim, index_dtype=index_dtype(len(self.model.vocab))) for (dirname, dim) in zip(dirnames, dimlist)]
+                for indices_list, values_list in sparse_tensor_batches():
+                    for writer, indices, values in zip(writers, indices_list, values_list):
+                        writer.add(indices, values)
+                for writer, params in zip(writers, paramlist):
+                    writer.close(params=params)
+            caches = [PMIBatchCache(dirname) for dirname in dirnames]
+            tensor_batches = joint_epochs(caches, num_epochs=self.num_epochs, shuffle=True)
+        else:
+            tensor_batches = sparse_tensor_batches(num_epochs=self.num_epochs)
 
-        config = tf.ConfigProto(
-            allow_soft_placement=True,
-        )
-        self.sess = tf.Session(config=config)
-        with self.sess.as_default():
+        (_, _, JointSymmetricCPDecomp), session_scope = self.get_decomp_backend()
+        with session_scope:
             reg_param = 1e-6
             self.to_save['reg_param'] = reg_param
             print('reg_param: {}'.format(reg_param))
@@ -241,10 +328,15 @@ class GensimSandbox(object):
                 nonneg=nonneg,
                 gpu=True,
             )
+        # track generalization of every order on a sample of its full tensor's nonzeros plus as many random zeros
+        heldout = []
+        for shift, gatherer in zip(shifts, gatherers):
+            indices, values = gatherer.create_pmi_tensor(positive=True, debug=False, symmetric=True, log_info=False, shift=shift)
+            heldout.append(sample_heldout(indices, values, int(1e4), int(1e4), shape=(len(self.model.vocab),)*gatherer.n, symmetric=True))
         print('Starting JOINT CP Decomp training')
-        decomp_method.train(sparse_tensor_batches())
+        decomp_method.train(tensor_batches, heldout=heldout)
 
-        U = decomp_method.U.eval(self.sess)
+        U = factor_value(decomp_method.U, self.sess)
         if nonneg:
             sparse_embedding = U.clip(min=0.0)
             self.embedding = sparse_embedding
@@ -258,27 +350,49 @@ class GensimSandbox(object):
         else:
             shift = -np.log2(15.)
 
-        def sparse_tensor_batches(batch_size=1000, symmetric=symmetric):
-            batches = batch_generator2(self.model, self.sentences_generator(), batch_size=batch_size)
-            for batch in batches:
-                sparse_ppmi_tensor_pair = gatherer.create_pmi_tensor(
-                    batch=batch,
-                    positive=True,
-                    debug=False,
-                    symmetric=symmetric,
-                    log_info=False,
-                    neg_sample_percent=0.0 if nonneg else 0.05,
-                    pmi=True,
-                    shift=shift,
+        neg_sample_percent = 0.0 if nonneg else 0.05
+
+        def batch_to_tensor(batch, neg_sample_percent=neg_sample_percent):
+            return gatherer.create_pmi_tensor(
+                batch=batch,
+                positive=True,
+                debug=False,
+                symmetric=symmetric,
+                log_info=False,
+                neg_sample_percent=neg_sample_percent,
+                pmi=True,
+                shift=shift,
+            )
+
+        def sparse_tensor_batches(batch_size=1000, num_epochs=1, neg_sample_percent=neg_sample_percent):
+            # one Prefetcher over all the epochs, building the PMI tensors of the next batches in background threads
+            batches = (batch for _ in range(num_epochs) for batch in self.chunk_batches(batch_size=batch_size))
+            fn = functools.partial(batch_to_tensor, neg_sample_percent=neg_sample_percent)
+            return Prefetcher(batches, fn=fn, num_workers=self.prefetch_workers)
+
+        if self.cache_batches:
+            # the cache only holds the positive entries: the negative samples are drawn again for every batch of every
+            # epoch, as in the uncached path, instead of replaying the same ones
+            params = dict(
+                num_articles=self.num_articles, min_count=self.min_count, n=ndims, shift=shift, symmetric=symmetric,
+                neg=0.0, batch_size=1000,
+            )
+            cache = PMIBatchCache.load_or_build(
+                cache_dirname(**params), lambda: sparse_tensor_batches(neg_sample_percent=0.0), ndims=ndims,
+                index_dtype=index_dtype(len(self.model.vocab)), params=params,
+            )
+            tensor_batches = cache.epochs(num_epochs=self.num_epochs, shuffle=True)
+            if neg_sample_percent > 0.0:
+                tensor_batches = (
+                    gatherer.add_negative_samples(indices, values, neg_sample_percent, symmetric=symmetric)
+                    for (indices, values) in tensor_batches
                 )
-                yield sparse_ppmi_tensor_pair
+        else:
+            tensor_batches = sparse_tensor_batches(num_epochs=self.num_epochs)
 
         (indices, values) = None, None  # to be filled in later
-        config = tf.ConfigProto(
-            allow_soft_placement=True,
-        )
-        self.sess = tf.Session(config=config)
-        with self.sess.as_default():
+        (CPDecomp, SymmetricCPDecomp, _), session_scope = self.get_decomp_backend()
+        with session_scope:
             if symmetric:
                 print('getting full PMI tensor...')
                 (indices, values) = gatherer.create_pmi_tensor(positive=True, debug=False, symmetric=symmetric, shift=shift)
@@ -313,13 +427,17 @@ class GensimSandbox(object):
                     optimizer_type='adam',
                     reg_param=0.0,
                 )
+        train_kwargs = {}
+        if indices is not None:
+            # track generalization on a sample of the full tensor's nonzeros plus as many random zeros
+            train_kwargs['heldout'] = sample_heldout(indices, values, int(1e4), int(1e4), shape=(len(self.model.vocab),)*ndims, symmetric=symmetric)
         print('Starting CP Decomp training')
-        decomp_method.train(sparse_tensor_batches())
+        decomp_method.train(tensor_batches, **train_kwargs)
 
-        U = decomp_method.U.eval(self.sess)
+        U = factor_value(decomp_method.U, self.sess)
         if not symmetric: 
-            V = decomp_method.V.eval(self.sess)
-            W = decomp_method.W.eval(self.sess)
+            V = factor_value(decomp_method.V, self.sess)
+            W = factor_value(decomp_method.W, self.sess)
 
             lambdaU = np.linalg.norm(U, axis=1)
             lambdaV = np.linalg.norm(V, axis=1)
@@ -341,19 +459,10 @@ class GensimSandbox(object):
             else:
                 self.embedding = U.copy()
 
-            def mse(embedding_mat):
-                total_err = 0.0
-                for ix, val in zip(indices, values):
-                    prod = embedding_mat[ix[0]].copy()
-                    for i in range(1, ndims):
-                        prod *= embedding_mat[ix[i]]
-                    pred_val = prod.sum()
-                    total_err += (pred_val - val) ** 2
-                return total_err / len(indices)
-
-            err = mse(self.embedding)
-            print("RMSE: {:.3f}".format(np.sqrt(err)))
-            self.to_save['RMSE'] = np.sqrt(err)
+            errors = ReconstructionEvaluator(self.embedding).evaluate(indices, values)
+            print(format_errors(errors))
+            self.to_save['RMSE'] = errors['rmse']
+            self.to_save['MAE'] = errors['mae']
         #self.embedding /= np.linalg.norm(self.embedding, axis=1)[:, None]  # normalize vectors to unit lengths
         self.to_save['indices'] = indices
         self.to_save['values'] = values
@@ -377,6 +486,7 @@ class GensimSandbox(object):
         sys.exit()
 
     def restore_from_ckpt(self):
+        import tensorflow as tf
         config = tf.ConfigProto(allow_soft_placement=True)
         with tf.Session(config=config) as sess:
             U = tf.Variable(tf.random_uniform(
@@ -408,41 +518,21 @@ class GensimSandbox(object):
         W = d['W']
         lambda_ = np.squeeze(d['lambda'])
         embedding  = np.dot(U, np.diag(lambda_ ** (1. / 3.)))
-        C1 = np.dot(V, np.diag(lambda_ ** (1. / 3.)))
-        C2 = np.dot(W, np.diag(lambda_ ** (1. / 3.)))
-        def pred_xijk(i, j, k):
-            hadamard = embedding[i] * C1[j] * C2[k] 
-            return np.sum(hadamard)
-        def mse(embedding=embedding, C1=C1, C2=C2):
-            err = 0.0
-            cnt = 0.0
-            smallest_se = float('inf')  # se = squared error
-            for val, ix in zip(values, indices):
-                val = val[0]
-                if cnt > 5e6:
-                    return np.sqrt(err / cnt)
-                pred_val = pred_xijk(ix[0], ix[1], ix[2])
-                se = (val - pred_val)**2 
-                #print('|{} - {}|^2 = {}'.format(val, pred_val, se))
-                if se < smallest_se:
-                    smallest_se = se
-                err += se
-                cnt += 1
-            return err / cnt
-        print("MSE: {}".format(mse()))
+        errors = ReconstructionEvaluator([U, V, W], weights=lambda_).evaluate(indices, values)
+        print(format_errors(errors))
         self.embedding = embedding
 
     def train_svd_embedding(self):
         gatherer = self.get_pmi_gatherer(2)
 
-        print('Making PPMI tensor for SVD...')
-        dense_ppmi_tensor = gatherer.create_pmi_tensor(positive=True, numpy_dense_tensor=True, debug=True)
+        print('Making sparse PPMI matrix for SVD...')
+        sparse_ppmi_matrix = gatherer.create_pmi_matrix(positive=True)
         del gatherer
 
         embedding_model = PpmiSvdEmbedding(self.model, embedding_dim=self.embedding_dim)
-        print("calculating SVD on {0}x{0}...".format(len(self.model.vocab)))
+        print("calculating truncated SVD on {0}x{0}...".format(len(self.model.vocab)))
         t = time.time()
-        embedding_model.learn_embedding(dense_ppmi_tensor)
+        embedding_model.learn_embedding(sparse_ppmi_matrix)
         total_svd_time = time.time() - t
         print("SVD on {}x{} took {}s".format(len(self.model.vocab), len(self.model.vocab), total_svd_time))
         self.embedding = embedding_model.get_embedding_matrix()
@@ -558,6 +648,10 @@ def main():
     num_articles = None
     min_count = None
     embedding_dim = None
+    num_epochs = 1
+    prefetch_workers = 1
+    backend = 'tensorflow'
+    count_processes = 0
     for arg in sys.argv:
         if arg.startswith('--method='):
             method = arg.split('--method=')[1]
@@ -567,6 +661,14 @@ def main():
             min_count = float(arg.split('--min_count=')[1])
         if arg.startswith('--embedding_dim='):
             embedding_dim = int(arg.split('--embedding_dim=')[1])
+        if arg.startswith('--num_epochs='):
+            num_epochs = int(arg.split('--num_epochs=')[1])
+        if arg.startswith('--prefetch_workers='):
+            prefetch_workers = int(arg.split('--prefetch_workers=')[1])
+        if arg.startswith('--backend='):
+            backend = arg.split('--backend=')[1]
+        if arg.startswith('--count_processes='):
+            count_processes = int(arg.split('--count_processes=')[1])
     assert all([method, num_articles, min_count, embedding_dim]), 'Please supply all necessary parameters'
 
     def input_with_timeout(prompt, timeout):
@@ -588,6 +690,12 @@ def main():
         num_articles=num_articles,
         embedding_dim=embedding_dim,
         min_count=min_count,
+        num_epochs=num_epochs,
+        prefetch_workers=prefetch_workers,
+        backend=backend,
+        cache_batches='--cache_batches' in sys.argv,
+        token_cache='--token_cache' in sys.argv,
+        count_processes=count_processes,
     )
     sandbox.train(experiment=experiment)
 
@@ -0,0 +1,64 @@
+import unittest
+
+import numpy as np
+
+from analogy_mapping import _loss_and_grads, predict, train, train_adam, train_ridge
+
+
+def analogies(num, dim, seed=0, noise=0.0):
+    ''' (x1s, x2s, x3s, y, Ws) with y = -W1 x1 + W2 x2 + W3 x3 (+ noise) for random W's near the identity '''
+    rng = np.random.RandomState(seed)
+    xs = [rng.randn(num, dim) for _ in range(3)]
+    Ws = [np.identity(dim) + .3 * rng.randn(dim, dim) for _ in range(3)]
+    y = predict(*(Ws + xs)) + noise * rng.randn(num, dim)
+    return xs + [y, Ws]
+
+
+class AnalogyMappingTest(unittest.TestCase):
+    def test_grads_equal_finite_differences(self):
+        x1s, x2s, x3s, y, _ = analogies(7, 4)
+        y = y / np.linalg.norm(y, axis=1, keepdims=True)
+        rng = np.random.RandomState(1)
+        Ws = [np.identity(4) + .1 * rng.randn(4, 4) for _ in range(3)]
+        _, _, grads = _loss_and_grads(Ws, (x1s, x2s, x3s), y, .01)
+        eps = 1e-6
+        for w in range(3):
+            for i, j in [(0, 0), (1, 3), (3, 2)]:
+                plus = [W.copy() for W in Ws]
+                minus = [W.copy() for W in Ws]
+                plus[w][i, j] += eps
+                minus[w][i, j] -= eps
+                diff = sum(_loss_and_grads(plus, (x1s, x2s, x3s), y, .01)[:2]) - sum(_loss_and_grads(minus, (x1s, x2s, x3s), y, .01)[:2])
+                self.assertAlmostEqual(grads[w][i, j], diff / (2 * eps), places=6)
+
+    def test_ridge_recovers_map(self):
+        x1s, x2s, x3s, y, Ws = analogies(200, 5)
+        for W, expected in zip(train_ridge(x1s, x2s, x3s, y, reg_param=1e-9), Ws):
+            np.testing.assert_allclose(W, expected, atol=1e-6)
+        # a huge regularization gives back the vector offset map
+        for W in train_ridge(x1s, x2s, x3s, y, reg_param=1e12):
+            np.testing.assert_allclose(W, np.identity(5), atol=1e-6)
+
+    def test_adam(self):
+        x1s, x2s, x3s, y, _ = analogies(500, 5, noise=.1)
+        y = y / np.linalg.norm(y)  # the loss compares y with the predictions normalized by the whole batch's norm
+        # no steps: the identity init
+        for W in train_adam(x1s, x2s, x3s, y, learning_rate=0.0):
+            np.testing.assert_array_equal(W, np.identity(5))
+        Ws = train_adam(x1s, x2s, x3s, y, batch_size=len(y), n_iters=300, learning_rate=1e-2, reg_param=0.0)
+        before = _loss_and_grads([np.identity(5)] * 3, (x1s, x2s, x3s), y, 0.0)[0]
+        after = _loss_and_grads(Ws, (x1s, x2s, x3s), y, 0.0)[0]
+        self.assertLess(after, .5 * before)
+
+    def test_train(self):
+        x1s, x2s, x3s, y, _ = analogies(50, 3)
+        for expected, W in zip(train_ridge(x1s, x2s, x3s, y, reg_param=2.0), train(x1s, x2s, x3s, y, solver='ridge', reg_param=2.0)):
+            np.testing.assert_array_equal(W, expected)
+        for expected, W in zip(train_adam(x1s, x2s, x3s, y), train(x1s, x2s, x3s, y)):
+            np.testing.assert_array_equal(W, expected)
+        with self.assertRaises(ValueError):
+            train(x1s, x2s, x3s, y, solver='sgd')
+
+
+if __name__ == '__main__':
+    unittest.main()
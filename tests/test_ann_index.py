@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from ann_index import IVFIndex
+
+
+def exact_neighbors(vectors, queries, k, metric):
+    if metric == 'cosine':
+        vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+        scores = np.dot(queries, vectors.T)
+    else:
+        scores = -((queries[:, None, :] - vectors[None, :, :]) ** 2).sum(axis=2)
+    return np.argsort(-scores, axis=1, kind='stable')[:, :k], np.sort(scores, axis=1)[:, ::-1][:, :k]
+
+
+class IVFIndexTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.vectors = (rng.randn(10, 16)[rng.randint(10, size=500)] + .5 * rng.randn(500, 16)).astype(np.float32)
+        self.queries = (self.vectors[rng.choice(500, size=20, replace=False)] + .1 * rng.randn(20, 16)).astype(np.float32)
+        self.labels = ['w{}'.format(i) for i in range(len(self.vectors))]
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_all_lists_is_exact(self):
+        for metric in ['cosine', 'l2']:
+            index = IVFIndex.build(self.vectors, metric=metric, num_lists=8)
+            ids, scores = index.search(self.queries, k=10, nprobe=index.num_lists)
+            expected_ids, expected_scores = exact_neighbors(self.vectors, self.queries, 10, metric)
+            np.testing.assert_array_equal(ids, expected_ids)
+            np.testing.assert_allclose(scores, expected_scores, rtol=1e-4, atol=1e-4)
+
+    def test_save_load(self):
+        index = IVFIndex.build(self.vectors, labels=self.labels, num_lists=8, nprobe=3)
+        dirname = os.path.join(self.dirname, 'index')
+        self.assertFalse(IVFIndex.exists(dirname))
+        index.save(dirname)
+        self.assertTrue(IVFIndex.exists(dirname))
+        loaded = IVFIndex.load(dirname)
+        self.assertIsInstance(loaded.vectors, np.memmap)
+        self.assertEqual(loaded.labels, self.labels)
+        self.assertEqual((loaded.metric, loaded.nprobe), ('cosine', 3))
+        for nprobe in [1, 3, 8]:
+            for expected, result in zip(index.search(self.queries, k=5, nprobe=nprobe), loaded.search(self.queries, k=5, nprobe=nprobe)):
+                np.testing.assert_array_equal(result, expected)
+
+    def test_exclude(self):
+        index = IVFIndex.build(self.vectors, num_lists=8)
+        expected_ids, _ = exact_neighbors(self.vectors, self.queries, 12, 'cosine')
+        exclude = expected_ids[:, :2].copy()
+        exclude[0, 1] = -1  # padding
+        ids, _ = index.search(self.queries, k=10, nprobe=index.num_lists, exclude=exclude)
+        for query_ids, query_exclude, query_expected in zip(ids, exclude, expected_ids):
+            self.assertFalse(np.isin(query_ids, query_exclude[query_exclude >= 0]).any())
+            np.testing.assert_array_equal(query_ids, [i for i in query_expected if i not in query_exclude][:10])
+
+    def test_padding(self):
+        index = IVFIndex.build(self.vectors, num_lists=8)
+        k = len(self.vectors)
+        ids, scores = index.search(self.queries, k=k, nprobe=1)
+        for query_ids, query_scores in zip(ids, scores):
+            found = query_ids >= 0
+            num_found = int(found.sum())
+            self.assertLess(num_found, k)  # one list never has every vector
+            self.assertTrue(found[:num_found].all())  # found ids come first
+            self.assertTrue(np.isneginf(query_scores[num_found:]).all())
+            self.assertTrue(np.isfinite(query_scores[:num_found]).all())
+            self.assertEqual(len(set(query_ids[:num_found])), num_found)
+
+    def test_most_similar(self):
+        index = IVFIndex.build(self.vectors, labels=self.labels, num_lists=8)
+        expected_ids, expected_scores = exact_neighbors(self.vectors, self.queries[:1], 5, 'cosine')
+        result = index.most_similar(self.queries[0], 5)
+        self.assertEqual([label for (label, _) in result], [self.labels[i] for i in expected_ids[0]])
+        np.testing.assert_allclose([score for (_, score) in result], expected_scores[0], rtol=1e-4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from batch_cache import PMIBatchCache, PMIBatchCacheWriter, joint_epochs
+
+
+def synthetic_batches(num_batches, ndims, vocab_len=50, seed=0):
+    ''' (indices, values) batches of different sizes, including a single squeezed entry, like create_pmi_tensor returns '''
+    rng = np.random.RandomState(seed)
+    batches = []
+    for i in range(num_batches):
+        size = 1 if i == 2 else rng.randint(2, 40)
+        indices = np.sort(rng.randint(0, vocab_len, size=(size, ndims)), axis=1)
+        values = rng.randn(size).astype(np.float32)
+        if size == 1:
+            indices, values = indices[0], values[0]
+        batches.append((indices, values))
+    return batches
+
+
+class PMIBatchCacheTest(unittest.TestCase):
+    num_batches = 10
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.batches = {ndims: synthetic_batches(self.num_batches, ndims, seed=ndims) for ndims in [2, 3]}
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def write(self, ndims, index_dtype=np.int64):
+        dirname = os.path.join(self.dirname, 'batches_{}_{}'.format(ndims, np.dtype(index_dtype).name))
+        writer = PMIBatchCacheWriter(dirname, ndims, index_dtype=index_dtype)
+        for indices, values in self.batches[ndims]:
+            writer.add(indices, values)
+        self.assertFalse(PMIBatchCache.exists(dirname))  # nothing is in place until close
+        writer.close(params={'ndims': ndims})
+        self.assertTrue(PMIBatchCache.exists(dirname))
+        return PMIBatchCache(dirname)
+
+    def expected(self, ndims, i, index_dtype=np.int64):
+        indices, values = self.batches[ndims][i]
+        return np.reshape(indices, (-1, ndims)).astype(index_dtype), np.reshape(values, (-1,)).astype(np.float32)
+
+    def test_round_trip(self):
+        for index_dtype in [np.int64, np.int32]:
+            cache = self.write(3, index_dtype=index_dtype)
+            self.assertEqual(len(cache), self.num_batches)
+            self.assertEqual(cache.meta['params'], {'ndims': 3})
+            for i in range(self.num_batches):
+                indices, values = cache[i]
+                expected_indices, expected_values = self.expected(3, i, index_dtype)
+                self.assertEqual(indices.dtype, np.dtype(index_dtype))
+                self.assertEqual(values.dtype, np.float32)
+                self.assertEqual(indices.shape, expected_indices.shape)
+                self.assertEqual(indices.tobytes(), expected_indices.tobytes())
+                self.assertEqual(values.tobytes(), expected_values.tobytes())
+
+    def batch_id(self, ndims, batch):
+        ''' Which of the written batches `batch` is '''
+        indices, values = batch
+        matches = [
+            i for i in range(self.num_batches)
+            if (indices.tobytes(), values.tobytes()) == tuple(x.tobytes() for x in self.expected(ndims, i))
+        ]
+        self.assertEqual(len(matches), 1)
+        return matches[0]
+
+    def test_shuffled_epochs(self):
+        cache = self.write(2)
+        batches = list(cache.epochs(num_epochs=3, shuffle=True, seed=1))
+        self.assertEqual(len(batches), 3 * self.num_batches)
+        orders = [
+            [self.batch_id(2, batch) for batch in batches[epoch * self.num_batches:(epoch + 1) * self.num_batches]]
+            for epoch in range(3)
+        ]
+        for order in orders:
+            self.assertEqual(sorted(order), list(range(self.num_batches)))
+        self.assertNotEqual(orders[0], orders[1])  # a fresh order every epoch
+        unshuffled = [self.batch_id(2, batch) for batch in cache.epochs(num_epochs=1, shuffle=False)]
+        self.assertEqual(unshuffled, list(range(self.num_batches)))
+
+    def test_joint_epochs(self):
+        caches = [self.write(2), self.write(3)]
+        num_yielded = 0
+        for indices, values in joint_epochs(caches, num_epochs=2, shuffle=True, seed=3):
+            self.assertEqual(len(indices), 2)
+            ids = [self.batch_id(ndims, (ix, val)) for ndims, ix, val in zip([2, 3], indices, values)]
+            self.assertEqual(ids[0], ids[1])
+            num_yielded += 1
+        self.assertEqual(num_yielded, 2 * self.num_batches)
+
+        writer = PMIBatchCacheWriter(os.path.join(self.dirname, 'short'), 2)
+        writer.add(*self.batches[2][0])
+        with self.assertRaises(ValueError):
+            list(joint_epochs(caches + [writer.close()]))
+
+
+if __name__ == '__main__':
+    unittest.main()
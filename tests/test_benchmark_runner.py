@@ -0,0 +1,114 @@
+import os
+import shutil
+import sys
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from benchmark_runner import BenchmarkRunner, Job, TASKS
+from embedding_io import write_embedding
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NOUNS = ['n{}'.format(i) for i in range(30)]
+VERBS = ['v{}'.format(i) for i in range(30)]
+WORDS = NOUNS + VERBS
+
+
+def write_lines(fname, lines):
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    with open(fname, 'w') as f:
+        f.write(''.join(line + '\n' for line in lines))
+
+
+def fake_google_analogy():
+    ''' Stands in for the download of the Google analogy dataset '''
+    X, y, categories = [], [], []
+    for i in range(120):
+        a, b, c, d = [WORDS[(7 * i + j) % len(WORDS)] for j in (0, 1, 2, 3)]
+        X.append([a, b, c])
+        y.append(d)
+        categories.append('semantic' if i % 2 else 'syntactic')
+    return {'X': np.array(X), 'y': np.array(y), 'category_high_level': np.array(categories)}
+
+
+class BenchmarkRunnerTest(unittest.TestCase):
+    def setUp(self):
+        # every task reads its data relative to the working directory
+        self.dirname = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.dirname)
+        rng = np.random.RandomState(0)
+        vectors = rng.randn(len(WORDS), 8).astype(np.float32)
+        vectors[len(NOUNS):, 0] += 3  # verbs are separable from nouns
+        write_embedding('vectors.npy', WORDS, vectors)
+        write_lines('evaluation_data/pos.txt', ['{} ptb.n'.format(w) for w in NOUNS] + ['{} ptb.v'.format(w) for w in VERBS])
+        for i in range(10):
+            write_lines('evaluation_data/sentiment/pos/{}.txt'.format(i), [' '.join(rng.choice(NOUNS, 5))])
+            write_lines('evaluation_data/sentiment/neg/{}.txt'.format(i), [' '.join(rng.choice(VERBS, 5))])
+        write_lines('wikisem500/dataset/en/nouns.txt', NOUNS[:6] + [''] + VERBS[:3])
+        write_lines('wikisem500/dataset/en/verbs.txt', VERBS[10:16] + [''] + NOUNS[10:13])
+
+        analogy = types.ModuleType('embedding_benchmarks.scripts.web.datasets.analogy')
+        analogy.fetch_google_analogy = fake_google_analogy
+        modules = {name: types.ModuleType(name) for name in [
+            'embedding_benchmarks', 'embedding_benchmarks.scripts', 'embedding_benchmarks.scripts.web',
+            'embedding_benchmarks.scripts.web.datasets']}
+        modules[analogy.__name__] = analogy
+        # only swap these modules: patch.dict(sys.modules) would also drop the modules the tasks import
+        self.saved_modules = {name: sys.modules.get(name) for name in modules}
+        sys.modules.update(modules)
+
+    def tearDown(self):
+        for name, module in self.saved_modules.items():
+            if module is None:
+                del sys.modules[name]
+            else:
+                sys.modules[name] = module
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dirname)
+
+    def runner(self, processes=1):
+        return BenchmarkRunner([('m', 'vectors.npy')], cache_dir='cache', processes=processes)
+
+    def test_every_task(self):
+        params = {
+            'sentiment': {'train_pct': 1.0},
+            'word_classification': {'train_pct': 1.0},
+            'analogy': {'train_pct': 1.0, 'solver': 'ridge'},
+            'outlier_detection': {'n': 2},
+        }
+        self.assertEqual(set(params), set(TASKS))
+        jobs = [Job('m', task, task_params) for (task, task_params) in sorted(params.items())]
+        results = self.runner().run(jobs)
+        self.assertEqual(set(results), set(jobs))
+        for job in jobs:
+            for value in results[job].values():
+                self.assertTrue(np.isfinite(value))
+        self.assertEqual(set(results[Job('m', 'analogy', params['analogy'])]), {'sem', 'syn'})
+        self.assertEqual(set(results[Job('m', 'outlier_detection', params['outlier_detection'])]), {'opp', 'acc'})
+        self.assertGreater(results[Job('m', 'word_classification', params['word_classification'])]['score'], .9)
+
+    def test_cache(self):
+        jobs = [Job('m', 'word_classification', {'train_pct': pct}, seed) for pct in (.5, 1.0) for seed in (0, 1)]
+        results = self.runner().run(jobs)
+        self.assertEqual(len(os.listdir('cache/results')), len(jobs))
+        with mock.patch('benchmark_runner._run_job', side_effect=AssertionError('cached job was run again')):
+            self.assertEqual(self.runner().run(jobs), results)
+        # a new embedding at the same path gets new results
+        write_embedding('vectors.npy', WORDS, np.random.RandomState(1).randn(len(WORDS), 8).astype(np.float32))
+        self.runner().run(jobs[:1])
+        self.assertEqual(len(os.listdir('cache/results')), len(jobs) + 1)
+
+    def test_processes(self):
+        jobs = [Job('m', 'word_classification', {'train_pct': .5}, seed) for seed in range(3)]
+        parallel = self.runner(processes=2).run(jobs)
+        shutil.rmtree('cache')
+        self.assertEqual(parallel, self.runner(processes=1).run(jobs))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from cooccurrence import ExternalCounts, PackedCounts, extract_cooccurrences, merge_runs, parallel_count
+
+
+def synthetic_batches(num_batches, batch_size, vocab_len, chunk_len=11, seed=0):
+    ''' Batches of zipfian chunks (some short), like the ones from batch_generator2 '''
+    rng = np.random.RandomState(seed)
+    batches = []
+    for _ in range(num_batches):
+        lengths = np.where(rng.rand(batch_size) < .8, chunk_len, rng.randint(1, chunk_len, size=batch_size))
+        batches.append([[int(x) for x in (rng.zipf(1.5, size=length) - 1) % vocab_len] for length in lengths])
+    return batches
+
+
+class ExternalCountsTest(unittest.TestCase):
+    n = 3
+    vocab_len = 200
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.indices = [extract_cooccurrences(batch, self.n)[0] for batch in synthetic_batches(8, 100, self.vocab_len)]
+        self.expected = PackedCounts(self.n, self.vocab_len)
+        for indices in self.indices:
+            self.expected.add(indices)
+        self.expected.flush()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def external_counts(self, min_count=0):
+        # a tiny budget, so (nearly) every batch is spilled as its own run
+        counts = ExternalCounts(self.n, self.vocab_len, memory_budget=3000, dirname=os.path.join(self.dirname, 'external'))
+        for indices in self.indices:
+            counts.add(indices)
+        self.assertGreaterEqual(len(counts.run_dirs), 3)
+        return counts.finalize(min_count=min_count)
+
+    def test_spilled_counts_equal_in_memory(self):
+        result = self.external_counts()
+        np.testing.assert_array_equal(result.keys, self.expected.keys)
+        np.testing.assert_array_equal(result.counts, self.expected.counts)
+        self.assertEqual(result.counts.dtype, self.expected.counts.dtype)
+
+    def test_min_count(self):
+        # a threshold that some entries are exactly at, and some just below
+        min_count = 3
+        self.assertTrue((self.expected.counts == min_count).any())
+        self.assertTrue((self.expected.counts == min_count - 1).any())
+        result = self.external_counts(min_count=min_count)
+        keep = self.expected.counts >= min_count
+        np.testing.assert_array_equal(result.keys, self.expected.keys[keep])
+        np.testing.assert_array_equal(result.counts, self.expected.counts[keep])
+
+    def test_merge_runs_small_blocks(self):
+        run_dirs = []
+        for i, indices in enumerate(self.indices):
+            run = PackedCounts(self.n, self.vocab_len)
+            run.add(indices)
+            run_dirs.append(os.path.join(self.dirname, 'run_{}'.format(i)))
+            run.save(run_dirs[-1])
+        out_dirname = os.path.join(self.dirname, 'merged')
+        total = merge_runs(run_dirs, out_dirname, block_size=7)
+        result = PackedCounts.load(out_dirname, self.n, self.vocab_len)
+        self.assertEqual(total, len(self.expected))
+        np.testing.assert_array_equal(result.keys, self.expected.keys)
+        np.testing.assert_array_equal(result.counts, self.expected.counts)
+
+
+class ParallelCountTest(unittest.TestCase):
+    n = 3
+    vocab_len = 50
+    chunk_len = 5
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dirname, 'corpus.txt')
+        self.word_index = {'w{}'.format(i): i for i in range(self.vocab_len)}
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_equals_in_memory(self):
+        rng = np.random.RandomState(0)
+        sentences = [(rng.zipf(1.5, size=rng.randint(0, 20)) - 1) % (2 * self.vocab_len) for _ in range(300)]  # half OOV
+        with open(self.fname, 'w') as f:
+            f.write(''.join(' '.join('w{}'.format(x) for x in sentence) + '\n' for sentence in sentences))
+        chunks = []
+        for sentence in sentences:
+            words = [int(x) for x in sentence if x < self.vocab_len]
+            chunks.extend(words[i:i + self.chunk_len] for i in range(0, len(words), self.chunk_len))
+        indices, words = extract_cooccurrences(chunks, self.n)
+        expected = PackedCounts(self.n, self.vocab_len)
+        expected.add(indices)
+        expected.flush()
+
+        out_dirname = os.path.join(self.dirname, 'counts')
+        counts, uni_counts, num_samples = parallel_count(
+            self.fname, self.word_index, self.n, self.vocab_len, self.chunk_len, processes=2, dirname=out_dirname, batch_size=7)
+        np.testing.assert_array_equal(counts.keys, expected.keys)
+        np.testing.assert_array_equal(counts.counts, expected.counts)
+        np.testing.assert_array_equal(uni_counts, np.bincount(words, minlength=self.vocab_len))
+        self.assertEqual(num_samples, len(words))
+        self.assertEqual(os.listdir(out_dirname), ['merged'])  # no shard or level dirs left over
+
+    def test_empty_file(self):
+        open(self.fname, 'w').close()
+        counts, uni_counts, num_samples = parallel_count(self.fname, self.word_index, self.n, self.vocab_len, self.chunk_len, processes=2)
+        self.assertEqual(len(counts), 0)
+        np.testing.assert_array_equal(uni_counts, np.zeros(self.vocab_len))
+        self.assertEqual(num_samples, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+
+import numpy as np
+
+from cp_evaluation import format_heldout, ReconstructionEvaluator, sample_heldout
+
+
+class ReconstructionEvaluatorTest(unittest.TestCase):
+    vocab_len = 40
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.U = rng.rand(self.vocab_len, 5)
+        self.tensors = {}
+        for order in [2, 3]:
+            indices = np.unique(np.sort(rng.randint(0, self.vocab_len, size=(300, order)), axis=1), axis=0)
+            self.tensors[order] = (indices, rng.rand(len(indices)).astype(np.float32))
+
+    def test_evaluate_orders(self):
+        evaluator = ReconstructionEvaluator(self.U, chunk_size=64, num_threads=2)
+        results = evaluator.evaluate_orders([self.tensors[2], self.tensors[3]])
+        self.assertEqual(sorted(results), [2, 3])
+        for order, (indices, values) in self.tensors.items():
+            errs = np.prod([self.U[indices[:, m]] for m in range(order)], axis=0).sum(axis=1) - values
+            self.assertEqual(results[order]['num_entries'], len(values))
+            self.assertAlmostEqual(results[order]['rmse'], np.sqrt(np.mean(errs ** 2)))
+            self.assertAlmostEqual(results[order]['max_abs_err'], np.abs(errs).max())
+
+    def test_format_heldout(self):
+        evaluator = ReconstructionEvaluator(self.U)
+        heldout = [sample_heldout(*self.tensors[order], 50, 20, shape=(self.vocab_len,) * order) for order in [2, 3]]
+        joint = format_heldout(evaluator, heldout)
+        self.assertIn('order 2: nonzeros:', joint)
+        self.assertIn('order 3: nonzeros:', joint)
+        self.assertIn('(50 entries); zeros:', joint)
+        self.assertTrue(format_heldout(evaluator, heldout[1]).startswith('nonzeros:'))
+
+
+if __name__ == '__main__':
+    unittest.main()
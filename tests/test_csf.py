@@ -0,0 +1,76 @@
+import itertools
+import unittest
+
+import numpy as np
+
+from cooccurrence import expand_permutations
+from csf import coo_mttkrp, CSFTensor
+
+
+def symmetric_tensor(n, vocab_len, num_entries, seed=0):
+    ''' (indices, values) of a random symmetric tensor: distinct sorted entries, expanded into all their permutations '''
+    rng = np.random.RandomState(seed)
+    sorted_indices = np.unique(np.sort(rng.randint(0, vocab_len, size=(num_entries, n)), axis=1), axis=0)
+    values = rng.randn(len(sorted_indices)).astype(np.float32)
+    indices, values = expand_permutations(sorted_indices, values)
+    # the permutations of entries with repeated indices are duplicates
+    indices, first = np.unique(indices, axis=0, return_index=True)
+    return indices, values[first]
+
+
+class CSFTensorTest(unittest.TestCase):
+    vocab_len = 30
+    rank = 6
+
+    def factors(self, n, seed=1):
+        rng = np.random.RandomState(seed)
+        return [rng.rand(self.vocab_len, self.rank).astype(np.float64) for _ in range(n)]
+
+    def assert_mttkrp_equal(self, indices, values, n, **kwargs):
+        factors = self.factors(n)
+        for mode_order in [None] + list(itertools.permutations(range(n)))[1::5]:
+            tensor = CSFTensor(indices, values, shape=(self.vocab_len,) * n, mode_order=mode_order)
+            for mode in range(n):
+                expected = coo_mttkrp(np.reshape(indices, (-1, n)), np.atleast_1d(values), factors, mode)
+                np.testing.assert_allclose(tensor.mttkrp(factors, mode, **kwargs), expected, rtol=1e-10, atol=1e-12)
+
+    def test_symmetric(self):
+        for n in [3, 4]:
+            indices, values = symmetric_tensor(n, self.vocab_len, 200, seed=n)
+            self.assert_mttkrp_equal(indices, values, n)
+            # many small root slices, processed by several threads
+            self.assert_mttkrp_equal(indices, values, n, num_threads=3, chunk_nnz=17)
+
+    def test_symmetric_mttkrp(self):
+        indices, values = symmetric_tensor(3, self.vocab_len, 100)
+        U = self.factors(1)[0]
+        expected = sum(coo_mttkrp(indices, values, [U] * 3, mode) for mode in range(3))
+        np.testing.assert_allclose(CSFTensor(indices, values).symmetric_mttkrp(U, num_threads=2, chunk_nnz=10), expected, rtol=1e-10)
+
+    def test_empty(self):
+        for n in [3, 4]:
+            tensor = CSFTensor(np.zeros((0, n), dtype=np.int64), np.zeros(0), shape=(self.vocab_len,) * n)
+            self.assertEqual(tensor.nnz, 0)
+            for mode in range(n):
+                result = tensor.mttkrp(self.factors(n), mode)
+                self.assertEqual(result.shape, (self.vocab_len, self.rank))
+                self.assertFalse(result.any())
+
+    def test_single_slice(self):
+        for n in [3, 4]:
+            # every entry under the same root
+            indices, values = symmetric_tensor(n, self.vocab_len, 100, seed=n)
+            indices[:, 0] = 7
+            indices, first = np.unique(indices, axis=0, return_index=True)
+            tensor = CSFTensor(indices, values[first], mode_order=list(range(n)))
+            self.assertEqual(tensor.num_nodes()[0], 1)
+            self.assertEqual(len(tensor.root_slices(chunk_nnz=10)), 1)
+            self.assert_mttkrp_equal(indices, values[first], n, num_threads=2, chunk_nnz=10)
+
+    def test_single_entry(self):
+        # create_pmi_tensor squeezes a single entry to 1 dimension
+        self.assert_mttkrp_equal(np.array([3, 5, 9]), np.float32(2.5), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
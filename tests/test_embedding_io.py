@@ -0,0 +1,123 @@
+import os
+import shutil
+import tempfile
+import types
+import unittest
+
+import numpy as np
+
+from embedding_io import format_rows, read_embedding, vocab_fname, WordVectors, write_embedding, write_model_embedding
+
+
+WORDS = ['the', 'café', 'naïve', '日本語', 'Zürich', 'emoji🙂', 'a-b_c']
+
+
+def random_vectors(num_words, dim, seed=0):
+    rng = np.random.RandomState(seed)
+    vectors = (rng.randn(num_words, dim) * 10.0 ** rng.randint(-3, 4, size=(num_words, 1))).astype(np.float32)
+    vectors[0, :2] = [0.0, -0.0]
+    vectors[1, 0] = -1e-9  # rounds to -0.0000000
+    return vectors
+
+
+class FormatRowsTest(unittest.TestCase):
+    def test_equals_str_format(self):
+        vectors = random_vectors(40, 9)
+        vectors[2, 3] = 123456.5
+        for precision in [0, 3, 7]:
+            expected = [
+                ''.join(' {:.{}f}'.format(x, precision) for x in row).encode('ascii') for row in vectors
+            ]
+            self.assertEqual(format_rows(vectors, precision=precision), expected)
+
+    def test_empty(self):
+        self.assertEqual(format_rows(np.zeros((0, 4), dtype=np.float32)), [])
+
+    def test_not_finite(self):
+        for bad in [np.nan, np.inf, -np.inf]:
+            with self.assertRaises(ValueError):
+                format_rows(np.array([[1.0, bad]], dtype=np.float32))
+
+
+class WriteEmbeddingTest(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.vectors = random_vectors(len(WORDS), 5)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def assert_round_trip(self, fname, words, vectors, fmt=None, **kwargs):
+        write_embedding(fname, words, self.vectors, fmt=fmt, **kwargs)
+        read_words, read_vectors = read_embedding(fname, fmt=fmt)
+        self.assertEqual(read_words, words)
+        self.assertEqual(read_vectors.dtype, np.float32)
+        if (fmt or '') == 'text' or fname.endswith('.txt'):
+            np.testing.assert_allclose(read_vectors, vectors, rtol=1e-6, atol=1e-7)
+        else:
+            np.testing.assert_array_equal(read_vectors, vectors)
+
+    def test_round_trip(self):
+        for name in ['vectors.txt', 'vectors.bin', 'vectors.npy']:
+            self.assert_round_trip(os.path.join(self.dirname, name), WORDS, self.vectors)
+
+    def test_explicit_format(self):
+        for fmt in ['text', 'word2vec_binary', 'npy']:
+            self.assert_round_trip(os.path.join(self.dirname, 'vectors_' + fmt), WORDS, self.vectors, fmt=fmt)
+        with self.assertRaises(ValueError):
+            write_embedding(os.path.join(self.dirname, 'vectors'), WORDS, self.vectors, fmt='hdf5')
+
+    def test_rows(self):
+        rows = np.array([4, 0, 6, 2])
+        words = [WORDS[i] for i in rows]
+        for name in ['vectors.txt', 'vectors.bin', 'vectors.npy']:
+            self.assert_round_trip(os.path.join(self.dirname, name), words, self.vectors[rows], rows=rows)
+
+    def test_text_file(self):
+        fname = os.path.join(self.dirname, 'vectors.txt')
+        write_embedding(fname, WORDS[:2], self.vectors, rows=np.array([1, 0]), precision=3)
+        with open(fname, encoding='utf8') as f:
+            lines = f.read().split('\n')
+        self.assertEqual(lines[0], '2 5')
+        self.assertEqual(lines[1], 'the' + ''.join(' {:.3f}'.format(x) for x in self.vectors[1]))
+        self.assertEqual(lines[2], 'café' + ''.join(' {:.3f}'.format(x) for x in self.vectors[0]))
+        self.assertEqual(lines[3], '')
+
+    def test_npy_vocab_sidecar(self):
+        fname = os.path.join(self.dirname, 'vectors.npy')
+        write_embedding(fname, WORDS, self.vectors)
+        self.assertEqual(vocab_fname(fname), os.path.join(self.dirname, 'vectors.vocab'))
+        with open(vocab_fname(fname), 'rb') as f:
+            self.assertEqual(f.read(), ''.join(word + '\n' for word in WORDS).encode('utf8'))
+        np.testing.assert_array_equal(np.load(fname), self.vectors)
+        words, vectors = read_embedding(fname, mmap_mode='r')
+        self.assertEqual(words, WORDS)
+        self.assertIsInstance(vectors, np.memmap)
+
+    def test_model_embedding(self):
+        # gensim-like vocab with an index per word; rows without a word are skipped
+        vocab = {word: types.SimpleNamespace(index=i) for (i, word) in enumerate(WORDS) if i != 3}
+        vocab[''] = types.SimpleNamespace(index=3)
+        model = types.SimpleNamespace(vocab=vocab)
+        expected_words = [word for (i, word) in enumerate(WORDS) if i != 3]
+        for name in ['vectors.txt', 'vectors.bin', 'vectors.npy']:
+            fname = os.path.join(self.dirname, name)
+            write_model_embedding(self.vectors, model, fname)
+            words, vectors = read_embedding(fname)
+            self.assertEqual(words, expected_words)
+            np.testing.assert_allclose(vectors, np.delete(self.vectors, 3, axis=0), rtol=1e-6, atol=1e-7)
+
+    def test_word_vectors(self):
+        for name in ['vectors.txt', 'vectors.bin', 'vectors.npy']:
+            fname = os.path.join(self.dirname, name)
+            write_embedding(fname, WORDS, self.vectors)
+            word_vectors = WordVectors.load(fname, normalize=True, nonneg=True)
+            self.assertEqual(list(word_vectors), WORDS)
+            self.assertEqual(word_vectors.dim, 5)
+            self.assertIn('日本語', word_vectors)
+            expected = np.maximum(self.vectors[3], 0.0)
+            np.testing.assert_allclose(word_vectors['日本語'], expected / np.linalg.norm(expected), rtol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,286 @@
+'''
+Checks the vectorized counting and PMI path against the tuple-keyed dict implementation it replaced (the old
+PMIGatherer.get_indices, populate_counts, PMI and create_pmi_tensor loops, reproduced below) on a tiny corpus.
+'''
+from collections import defaultdict
+import itertools
+import os
+import shutil
+import tempfile
+import types
+import unittest
+
+import numpy as np
+
+from cooccurrence import expand_permutations, extract_cooccurrences, iter_expand_permutations, key_bits, pack_keys, PackedCounts, pad_batch, unpack_keys
+from tensor_embedding import PMIGatherer
+
+
+def synthetic_batches(num_batches, batch_size, vocab_len, chunk_len=7, seed=0):
+    ''' Chunks of zipfian words, so they have repeated words, and some are shorter than n '''
+    rng = np.random.RandomState(seed)
+    return [
+        [[int(x) for x in (rng.zipf(1.3, size=rng.randint(0, chunk_len + 1)) - 1) % vocab_len] for _ in range(batch_size)]
+        for _ in range(num_batches)
+    ]
+
+
+def dict_get_indices(batch, n):
+    ''' The old get_indices: (n-gram tuples in loop order, {word: unigram count}, num_samples) of one batch '''
+    indices = []
+    uni_counts = defaultdict(int)
+    num_samples = 0
+    for chunk in batch:
+        sent = sorted(set(chunk))
+        if len(sent) < n:
+            continue
+        indices.extend(itertools.combinations(sent, n))
+        for word in sent:
+            uni_counts[word] += 1
+        num_samples += len(sent)
+    return indices, uni_counts, num_samples
+
+
+class DictCounts(object):
+    ''' The old populate_counts, PMI and create_pmi_tensor over tuple-keyed dicts '''
+    def __init__(self, batches, n, min_count=1):
+        self.n = n
+        self.n_counts = defaultdict(int)
+        self.uni_counts = defaultdict(int)
+        self.num_samples = 0
+        for batch in batches:
+            indices, uni_counts, num_samples = dict_get_indices(batch, n)
+            for ix in indices:
+                self.n_counts[ix] += 1
+            for word, count in uni_counts.items():
+                self.uni_counts[word] += count
+            self.num_samples += num_samples
+        self.n_counts = {ix: count for ix, count in self.n_counts.items() if count > min_count}
+        self.valid_indices = {ix for ix in self.n_counts if self.n_counts[ix] > 5}
+
+    def PMI(self, *args):
+        if args not in self.valid_indices:
+            return 0.0
+        log_num = np.log2(self.n_counts[args]) + (self.n - 1) * np.log2(self.num_samples)
+        return log_num - sum(np.log2(self.uni_counts[arg]) for arg in args)
+
+    def pmi_tensor(self, batch=None, positive=True, symmetric=False, shift=0.0):
+        ''' {index tuple: value} of the old create_pmi_tensor '''
+        if batch:
+            indices = list(self.valid_indices.intersection(dict_get_indices(batch, self.n)[0]))
+        else:
+            indices = list(self.n_counts.keys())
+        values = np.array([self.PMI(*ix) for ix in indices], dtype=np.float32) + shift
+        entries = [(ix, value) for ix, value in zip(indices, values) if value > 0.0 or not positive]
+        if not symmetric and entries:
+            indices, values = dict_expand_permutations([ix for ix, _ in entries], [value for _, value in entries])
+            entries = zip(map(tuple, indices.tolist()), values.tolist())
+        return dict(entries)
+
+
+def dict_expand_permutations(indices, values):
+    ''' The old non-symmetric expansion loop of create_pmi_tensor '''
+    n = len(indices[0])
+    n_fact = len(list(itertools.permutations(range(n))))
+    indices_extended = np.zeros((n_fact * len(indices), n), dtype=np.int64)
+    values_extended = np.zeros((n_fact * len(indices),), dtype=np.float32)
+    for i in range(len(indices)):
+        tup = indices[i]
+        j = 0
+        for perm in itertools.permutations(range(n)):
+            for k, sigma in enumerate(perm):
+                indices_extended[n_fact * i + j][perm[k]] = tup[k]
+                values_extended[n_fact * i + j] = values[i]
+            j += 1
+    return indices_extended, values_extended
+
+
+def vocab_model(vocab_len):
+    return types.SimpleNamespace(vocab={'w{}'.format(i): i for i in range(vocab_len)})
+
+
+class ExtractCooccurrencesTest(unittest.TestCase):
+    vocab_len = 25
+
+    def test_equals_dict_indices(self):
+        for n in [2, 3, 4]:
+            for batch in synthetic_batches(3, 40, self.vocab_len, seed=n):
+                expected, expected_uni_counts, expected_num_samples = dict_get_indices(batch, n)
+                for as_array in [False, True]:  # TokenCache batches are padded arrays
+                    indices, words = extract_cooccurrences(pad_batch(batch) if as_array else batch, n)
+                    self.assertEqual([tuple(ix) for ix in indices.tolist()], expected)
+                    self.assertEqual(len(words), expected_num_samples)
+                    uni_counts = np.bincount(words, minlength=self.vocab_len)
+                    self.assertEqual({w: c for w, c in enumerate(uni_counts) if c}, dict(expected_uni_counts))
+
+    def test_short_chunks(self):
+        # chunks with fewer than n distinct words don't count, not even for the unigrams
+        indices, words = extract_cooccurrences([[3, 3, 3], [1, 2], [], [4, 1, 4, 2]], 3)
+        self.assertEqual(indices.tolist(), [[1, 2, 4]])
+        self.assertEqual(sorted(words.tolist()), [1, 2, 4])
+        indices, words = extract_cooccurrences([], 2)
+        self.assertEqual(indices.shape, (0, 2))
+        self.assertEqual(len(words), 0)
+
+
+class PackedCountsTest(unittest.TestCase):
+    vocab_len = 25
+
+    def test_equals_dict_counts(self):
+        for n in [2, 3]:
+            expected = defaultdict(int)
+            counts = PackedCounts(n, self.vocab_len, buffer_size=50)  # flushes every few batches
+            for batch in synthetic_batches(10, 30, self.vocab_len, seed=n):
+                indices = dict_get_indices(batch, n)[0]
+                for ix in indices:
+                    expected[ix] += 1
+                counts.add(extract_cooccurrences(batch, n)[0])
+            self.assertEqual(len(counts), len(expected))
+            self.assertEqual(dict(zip(map(tuple, counts.indices().tolist()), counts.counts.tolist())), dict(expected))
+            for ix, count in expected.items():
+                self.assertEqual(counts[ix], count)
+                self.assertIn(ix, counts)
+
+    def test_key_round_trip_at_bit_boundary(self):
+        self.assertEqual(key_bits(2 ** 16), 16)  # indices up to 2^16 - 1
+        self.assertEqual(key_bits(2 ** 16 + 1), 17)
+        # the largest vocabs whose n-grams still fit in 64 bits, and a few small ones
+        for vocab_len, n in [(2 ** 16, 4), (2 ** 21, 3), (2 ** 32, 2), (2 ** 16 + 1, 3), (2, 5), (1, 2)]:
+            bits = key_bits(vocab_len)
+            top = vocab_len - 1
+            indices = np.array([[top] * n, [0] * n, [0] * (n - 1) + [top], [top // 2] * (n - 1) + [top], [0] * n])
+            keys = pack_keys(indices, bits)
+            np.testing.assert_array_equal(unpack_keys(keys, n, bits), indices)
+            counts = PackedCounts(n, vocab_len)
+            counts.add(indices)
+            # sorted keys are the rows in lexicographic order
+            unique, unique_counts = np.unique(indices, axis=0, return_counts=True)
+            np.testing.assert_array_equal(counts.indices(), unique)
+            np.testing.assert_array_equal(counts.counts, unique_counts)
+        with self.assertRaises(ValueError):
+            PackedCounts(4, 2 ** 16 + 1)  # 17 bits * 4 > 64
+
+    def test_missing_keys_and_subset(self):
+        counts = PackedCounts(3, self.vocab_len)
+        counts.add(np.array([[1, 2, 3], [1, 2, 3], [0, 5, 24], [4, 4, 9], [1, 2, 3]]))
+        self.assertEqual(counts[(1, 2, 3)], 3)
+        self.assertEqual(counts[(1, 2, 4)], 0)
+        self.assertNotIn((3, 2, 1), counts)  # only the sorted tuple is stored
+        self.assertNotIn((24, 24, 24), counts)  # after the last key
+        self.assertNotIn((0, 0, 0), counts)  # before the first key
+        queries = np.array([[1, 2, 3], [0, 0, 0], [4, 4, 9], [24, 24, 24], [0, 5, 24]])
+        np.testing.assert_array_equal(counts.lookup(queries), [3, 0, 1, 0, 1])
+        np.testing.assert_array_equal(counts.contains(queries), [True, False, True, False, True])
+        np.testing.assert_array_equal(counts.intersection(queries), [[1, 2, 3], [4, 4, 9], [0, 5, 24]])
+
+        frequent = counts.subset(counts.counts > 1)
+        self.assertEqual(len(frequent), 1)
+        self.assertEqual(frequent[(1, 2, 3)], 3)
+        self.assertEqual(frequent[(4, 4, 9)], 0)
+        np.testing.assert_array_equal(frequent.lookup(queries), [3, 0, 0, 0, 0])
+        empty = counts.subset(np.zeros(len(counts), dtype=bool))
+        self.assertEqual(len(empty), 0)
+        np.testing.assert_array_equal(empty.lookup(queries), np.zeros(len(queries)))
+        self.assertNotIn((1, 2, 3), empty)
+
+        other = PackedCounts(3, self.vocab_len)
+        other.add(np.array([[1, 2, 3], [7, 8, 9]]))
+        counts.update(other)
+        np.testing.assert_array_equal(counts.lookup(np.array([[1, 2, 3], [7, 8, 9], [0, 5, 24]])), [4, 1, 1])
+
+
+class PMITest(unittest.TestCase):
+    vocab_len = 25
+    min_count = 1
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.batches = {n: synthetic_batches(10, 60, self.vocab_len, seed=n) for n in [2, 3]}
+        self.expected = {n: DictCounts(batches, n, min_count=self.min_count) for n, batches in self.batches.items()}
+        self.gatherers = {}
+        for n, batches in self.batches.items():
+            gatherer = PMIGatherer(vocab_model(self.vocab_len), n=n)
+            gatherer.populate_counts(iter(batches), huge_vocab=True, min_count=self.min_count, memory_budget=3000,
+                                    count_dir=os.path.join(self.dirname, str(n)))
+            self.gatherers[n] = gatherer
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def assert_entries_equal(self, indices, values, expected):
+        indices = np.reshape(indices, (-1, len(next(iter(expected)))))
+        values = np.reshape(values, (-1,))
+        self.assertEqual(len(indices), len(expected))
+        result = dict(zip(map(tuple, indices.tolist()), values.tolist()))
+        self.assertEqual(set(result), set(expected))
+        for ix, value in expected.items():
+            self.assertAlmostEqual(result[ix], value, places=5)
+
+    def test_counts(self):
+        for n, gatherer in self.gatherers.items():
+            expected = self.expected[n]
+            self.assertTrue(len(expected.valid_indices) > 10)  # the corpus has enough n-grams with a nonzero PMI
+            self.assertEqual(dict(zip(map(tuple, gatherer.n_counts.indices().tolist()), gatherer.n_counts.counts.tolist())), expected.n_counts)
+            self.assertEqual({w: c for w, c in enumerate(gatherer.uni_counts) if c}, dict(expected.uni_counts))
+            self.assertEqual(gatherer.num_samples, expected.num_samples)
+
+    def test_pmi_array(self):
+        for n, gatherer in self.gatherers.items():
+            expected = self.expected[n]
+            # every stored n-gram (valid or not) plus some that were never counted
+            indices = np.vstack([gatherer.n_counts.indices(), np.sort(np.random.RandomState(n).randint(0, self.vocab_len, size=(50, n)), axis=1)])
+            values = gatherer.PMI_array(indices)
+            np.testing.assert_allclose(values, [expected.PMI(*ix) for ix in map(tuple, indices.tolist())], rtol=1e-12)
+            for ix in map(tuple, indices[:20].tolist()):
+                self.assertAlmostEqual(gatherer.PMI(*ix), expected.PMI(*ix))
+
+    def test_pmi_tensor(self):
+        for n, gatherer in self.gatherers.items():
+            for shift in [0.0, -1.5, 2.0]:
+                for positive in [True, False]:
+                    indices, values = gatherer.create_pmi_tensor(positive=positive, symmetric=True, log_info=False, shift=shift)
+                    self.assert_entries_equal(indices, values, self.expected[n].pmi_tensor(positive=positive, symmetric=True, shift=shift))
+                for batch in self.batches[n][:3]:
+                    indices, values = gatherer.create_pmi_tensor(batch=batch, symmetric=True, log_info=False, shift=shift)
+                    self.assert_entries_equal(indices, values, self.expected[n].pmi_tensor(batch=batch, symmetric=True, shift=shift))
+
+
+    def test_pmi_tensor_expanded(self):
+        for n, gatherer in self.gatherers.items():
+            for shift in [0.0, -1.5]:
+                expected = self.expected[n].pmi_tensor(symmetric=False, shift=shift)
+                self.assertEqual(len(expected), len(self.expected[n].pmi_tensor(symmetric=True, shift=shift)) * (2 if n == 2 else 6))
+                indices, values = gatherer.create_pmi_tensor(symmetric=False, log_info=False, shift=shift)
+                self.assert_entries_equal(indices, values, expected)
+                chunks = list(gatherer.create_pmi_tensor(symmetric=False, log_info=False, shift=shift, expand_chunk_size=50))
+                self.assertTrue(len(chunks) > 1)
+                self.assertTrue(all(len(chunk_indices) <= 50 for chunk_indices, _ in chunks))
+                np.testing.assert_array_equal(np.vstack([chunk_indices for chunk_indices, _ in chunks]), indices)
+                np.testing.assert_array_equal(np.concatenate([chunk_values for _, chunk_values in chunks]), values)
+
+
+class ExpandPermutationsTest(unittest.TestCase):
+    def test_equals_loop(self):
+        rng = np.random.RandomState(0)
+        for n in [2, 3, 4]:
+            indices = np.sort(rng.choice(1000, size=(17, n)), axis=1)
+            values = rng.randn(17).astype(np.float32)
+            expected_indices, expected_values = dict_expand_permutations(indices, values)
+            result_indices, result_values = expand_permutations(indices, values, dtype=np.uint16)
+            self.assertEqual(result_indices.dtype, np.uint16)
+            np.testing.assert_array_equal(result_indices, expected_indices)
+            np.testing.assert_array_equal(result_values, expected_values)
+            for chunk_size in [1, 7, len(expected_values), 10 ** 6]:
+                chunks = list(iter_expand_permutations(indices, values, chunk_size))
+                np.testing.assert_array_equal(np.vstack([chunk_indices for chunk_indices, _ in chunks]), expected_indices)
+                np.testing.assert_array_equal(np.concatenate([chunk_values for _, chunk_values in chunks]), expected_values)
+
+    def test_empty(self):
+        indices, values = expand_permutations(np.zeros((0, 3), dtype=np.int64), np.zeros(0, dtype=np.float32))
+        self.assertEqual(indices.shape, (0, 3))
+        self.assertEqual(values.shape, (0,))
+        self.assertEqual(list(iter_expand_permutations(np.zeros((0, 3)), np.zeros(0), 10)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
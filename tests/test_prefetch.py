@@ -0,0 +1,39 @@
+import threading
+import unittest
+
+from prefetch import Prefetcher
+
+
+def failing_source():
+    yield 1
+    raise RuntimeError('bad batch')
+
+
+class PrefetcherTest(unittest.TestCase):
+    def exhausted_twice(self, p):
+        ''' list(p) a second time from a thread, so a hang fails the test instead of blocking it '''
+        second = []
+        thread = threading.Thread(target=lambda: second.append(list(p)), daemon=True)
+        thread.start()
+        thread.join(timeout=5)
+        self.assertFalse(thread.is_alive(), 'iterating an exhausted Prefetcher blocked')
+        return second[0]
+
+    def test_exhausted(self):
+        for kwargs in [{}, {'fn': lambda x: x * x}, {'fn': lambda x: x * x, 'num_workers': 3}]:
+            p = Prefetcher(iter(range(10)), queue_depth=2, **kwargs)
+            expected = [x * x for x in range(10)] if kwargs else list(range(10))
+            self.assertEqual(list(p), expected)
+            self.assertEqual(p.num_items, 10)
+            self.assertEqual(self.exhausted_twice(p), [])
+
+    def test_error(self):
+        p = Prefetcher(failing_source())
+        self.assertEqual(next(p), 1)
+        with self.assertRaises(RuntimeError):
+            next(p)
+        self.assertEqual(self.exhausted_twice(p), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
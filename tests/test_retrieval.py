@@ -0,0 +1,82 @@
+import unittest
+
+import numpy as np
+
+from retrieval import top_k
+
+
+def brute_force_top_k(matrix, queries, k, exclude=None):
+    ''' Full argsort of queries @ matrix.T by (score descending, id ascending), excluded rows scoring -inf '''
+    scores = np.dot(queries, matrix.T)
+    if exclude is not None:
+        for i, row in enumerate(exclude):
+            scores[i, row[row >= 0]] = -np.inf
+    ids = np.array([np.lexsort((np.arange(len(matrix)), -row))[:k] for row in scores])
+    return ids, np.take_along_axis(scores, ids, axis=1)
+
+
+class TopKTest(unittest.TestCase):
+    # 1 byte gives 1 x 1 blocks, 200 bytes several rows per block and one query per block, the default one block
+    memory_limits = [1, 200, 2 ** 28]
+
+    def assert_top_k_equal(self, matrix, queries, k, exclude=None):
+        expected_ids, expected_scores = brute_force_top_k(matrix, queries, min(k, len(matrix)), exclude=exclude)
+        for memory_limit in self.memory_limits:
+            ids, scores = top_k(matrix, queries, k=k, exclude=exclude, memory_limit=memory_limit)
+            np.testing.assert_array_equal(ids, expected_ids)
+            np.testing.assert_allclose(scores, expected_scores, rtol=1e-6)  # blocked matmuls round differently
+
+    def test_random(self):
+        rng = np.random.RandomState(0)
+        matrix = rng.randn(57, 8)
+        queries = rng.randn(13, 8)
+        for k in [1, 2, 5, 57]:
+            self.assert_top_k_equal(matrix, queries, k)
+        ids, _ = top_k(matrix, queries, k=1)
+        np.testing.assert_array_equal(ids[:, 0], np.argmax(np.dot(queries, matrix.T), axis=1))
+
+    def test_ties(self):
+        # small integer vectors, so lots of rows have exactly the same score
+        rng = np.random.RandomState(1)
+        for _ in range(50):
+            matrix = rng.randint(-2, 3, size=(rng.randint(1, 40), 3)).astype(np.float32)
+            queries = rng.randint(-2, 3, size=(6, 3)).astype(np.float32)
+            for k in [1, 3, 10]:
+                self.assert_top_k_equal(matrix, queries, k)
+
+    def test_exclude(self):
+        rng = np.random.RandomState(2)
+        matrix = rng.randint(-2, 3, size=(30, 4)).astype(np.float64)
+        queries = rng.randint(-2, 3, size=(9, 4)).astype(np.float64)
+        exclude = rng.randint(-1, 30, size=(9, 3))  # -1 is padding
+        for k in [1, 4, 27]:
+            self.assert_top_k_equal(matrix, queries, k, exclude=exclude)
+        ids, _ = top_k(matrix, queries, k=5, exclude=exclude)
+        for row_ids, row_exclude in zip(ids, exclude):
+            self.assertFalse(set(row_ids) & set(row_exclude))
+
+    def test_k_larger_than_rows(self):
+        rng = np.random.RandomState(3)
+        matrix = rng.randn(6, 4)
+        queries = rng.randn(4, 4)
+        ids, scores = top_k(matrix, queries, k=10)
+        self.assertEqual(ids.shape, (4, 6))
+        self.assert_top_k_equal(matrix, queries, 10)
+        # fewer rows left than k: the rest are the excluded ones, scoring -inf
+        exclude = np.array([[0, 1, 2, 3, 4], [5, -1, -1, -1, -1], [-1] * 5, [0, 0, 0, 0, 0]])
+        ids, scores = top_k(matrix, queries, k=3, exclude=exclude)
+        self.assertEqual(ids[0, 0], 5)
+        self.assertTrue(np.isneginf(scores[0, 1:]).all())
+        self.assert_top_k_equal(matrix, queries, 10, exclude=exclude)
+
+    def test_single_query(self):
+        rng = np.random.RandomState(4)
+        matrix = rng.randn(20, 5)
+        query = rng.randn(5)
+        ids, scores = top_k(matrix, query, k=3)
+        self.assertEqual(ids.shape, (1, 3))
+        self.assert_top_k_equal(matrix, query[None, :], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import os
+import shutil
+import tempfile
+import types
+import unittest
+
+import numpy as np
+
+from cooccurrence import PAD
+from token_cache import TokenCache
+
+try:
+    from gensim_utils import batch_generator2
+except ImportError:  # needs gensim and nltk
+    batch_generator2 = None
+
+
+def vocab_model(words, window):
+    ''' The parts of a gensim Word2Vec model that TokenCache and batch_generator2 use '''
+    return types.SimpleNamespace(
+        vocab={word: types.SimpleNamespace(index=i) for i, word in enumerate(words)},
+        index2word=list(words),
+        window=window,
+    )
+
+
+class TokenCacheTest(unittest.TestCase):
+    window = 2
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.model = vocab_model(['w{}'.format(i) for i in range(40)], self.window)
+        # sentences of every length around the chunk length, half the words out of the vocab, and some empty ones
+        self.sentences = [['w{}'.format(x) for x in rng.randint(0, 80, size=rng.randint(0, 20))] for _ in range(60)]
+        self.sentences[5] = []
+        self.cache_dirname = os.path.join(self.dirname, 'tokens')
+        self.cache = TokenCache.build(self.cache_dirname, self.model, iter(self.sentences), params={'num_articles': 60})
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def cached_batches(self, cache, batch_size, padded=False):
+        return list(cache.batches(1 + 2 * self.window, batch_size, padded=padded))
+
+    def expected_sentences(self):
+        return [[self.model.vocab[w].index for w in sentence if w in self.model.vocab] for sentence in self.sentences]
+
+    def test_sentences(self):
+        self.assertEqual(len(self.cache), len(self.sentences))
+        for i, expected in enumerate(self.expected_sentences()):
+            self.assertEqual(self.cache.sentence(i).tolist(), expected)
+
+    @unittest.skipIf(batch_generator2 is None, 'gensim_utils needs gensim and nltk')
+    def test_batches_equal_batch_generator2(self):
+        num_chunks = sum(len(cache_batch) for cache_batch in self.cached_batches(self.cache, 1))
+        for batch_size in [1, 3, 7, num_chunks, num_chunks + 5]:
+            expected = list(batch_generator2(self.model, iter(self.sentences), batch_size))
+            self.assertEqual(self.cached_batches(self.cache, batch_size), expected)
+
+    def test_padded(self):
+        for batch_size in [1, 4, 10]:
+            for chunks, padded in zip(self.cached_batches(self.cache, batch_size), self.cached_batches(self.cache, batch_size, padded=True)):
+                self.assertEqual(padded.shape, (len(chunks), 1 + 2 * self.window))
+                self.assertEqual([[x for x in row if x != PAD] for row in padded.tolist()], chunks)
+
+    def test_chunks_cover_corpus(self):
+        for batch_size in [3, 8]:
+            batches = self.cached_batches(self.cache, batch_size)
+            self.assertTrue(all(len(batch) > 0 for batch in batches))
+            self.assertTrue(all(len(batch) >= batch_size for batch in batches[:-1]))
+            words = [w for batch in batches for chunk in batch for w in chunk]
+            self.assertEqual(words, [w for sentence in self.expected_sentences() for w in sentence])
+
+    def test_reopen(self):
+        self.assertTrue(TokenCache.exists(self.cache_dirname))
+        # an existing cache is opened, not rebuilt from the sentences
+        reopened = TokenCache.load_or_build(self.cache_dirname, self.model, lambda: self.fail('rebuilt the cache'))
+        self.assertEqual(reopened.meta, self.cache.meta)
+        self.assertEqual(reopened.meta['params'], {'num_articles': 60})
+        for batch_size in [2, 9]:
+            self.assertEqual(self.cached_batches(reopened, batch_size), self.cached_batches(self.cache, batch_size))
+        with self.assertRaises(ValueError):
+            TokenCache(self.cache_dirname, model=vocab_model(['w{}'.format(i) for i in range(41)], self.window))
+
+
+if __name__ == '__main__':
+    unittest.main()
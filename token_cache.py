@@ -0,0 +1,145 @@
+'''
+The tokenized corpus as vocab indices, for a given vocab, so training and counting runs don't have to re-parse the
+wiki dump and look every word up in model.vocab again.
+
+Layout of a cache directory:
+    tokens.bin   the in-vocab words of every sentence, concatenated. Raw uint32 vocab indices
+    offsets.npy  (num_sentences + 1,) int64 -- sentence i is tokens[offsets[i]:offsets[i+1]]
+    meta.json    num_sentences, num_tokens, vocab_len and a digest of model.index2word, plus the params the corpus was read with
+
+`TokenCache.batches` yields the same batches as gensim_utils.batch_generator2 on the same sentences.
+'''
+import hashlib
+import json
+import numpy as np
+import os
+import shutil
+import time
+
+from cooccurrence import PAD
+
+
+def vocab_digest(model):
+    ''' Fingerprint of the word -> index mapping, so a cache is never read with a different vocab '''
+    h = hashlib.sha1()
+    for word in model.index2word:
+        h.update(word.encode('utf8'))
+        h.update(b'\n')
+    return h.hexdigest()
+
+
+class TokenCache(object):
+    def __init__(self, dirname, model=None):
+        '''
+        Opens the cache in `dirname` (tokens memory mapped). If `model` is given, checks that it has the vocab the cache
+        was built with.
+        '''
+        self.dirname = dirname
+        with open(os.path.join(dirname, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if model is not None and self.meta['vocab_digest'] != vocab_digest(model):
+            raise ValueError('The token cache in {} was built with a different vocab ({} words, model has {})'.format(
+                dirname, self.meta['vocab_len'], len(model.vocab)))
+        self.offsets = np.load(os.path.join(dirname, 'offsets.npy'))
+        if self.meta['num_tokens'] == 0:  # can't memmap an empty file
+            self.tokens = np.zeros((0,), dtype=np.uint32)
+        else:
+            self.tokens = np.memmap(os.path.join(dirname, 'tokens.bin'), dtype=np.uint32, mode='r', shape=(self.meta['num_tokens'],))
+
+    @staticmethod
+    def exists(dirname):
+        # meta.json is written last, so a build that died halfway doesn't count
+        return os.path.exists(os.path.join(dirname, 'meta.json'))
+
+    @staticmethod
+    def build(dirname, model, sentences, params=None, buffer_size=int(1e7)):
+        '''
+        Maps the words of every sentence from the `sentences` generator to their vocab indices (dropping words that
+        aren't in model.vocab, like batch_generator2) and writes them to a new cache in `dirname`.
+        '''
+        print('Caching tokenized corpus to {}...'.format(dirname))
+        t = time.time()
+        tmp_dirname = dirname + '.tmp'
+        if os.path.exists(tmp_dirname):
+            shutil.rmtree(tmp_dirname)
+        os.makedirs(tmp_dirname)
+        vocab = model.vocab
+        offsets = [0]
+        buf = []
+        with open(os.path.join(tmp_dirname, 'tokens.bin'), 'wb') as f:
+            for sentence in sentences:
+                words = [vocab[w].index for w in sentence if w in vocab]
+                buf.extend(words)
+                offsets.append(offsets[-1] + len(words))
+                if len(buf) >= buffer_size:
+                    f.write(np.array(buf, dtype=np.uint32).tobytes())
+                    buf = []
+            f.write(np.array(buf, dtype=np.uint32).tobytes())
+        np.save(os.path.join(tmp_dirname, 'offsets.npy'), np.array(offsets, dtype=np.int64))
+        meta = {
+            'num_sentences': len(offsets) - 1,
+            'num_tokens': int(offsets[-1]),
+            'vocab_len': len(vocab),
+            'vocab_digest': vocab_digest(model),
+            'params': params or {},
+        }
+        with open(os.path.join(tmp_dirname, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+        if os.path.exists(dirname):
+            shutil.rmtree(dirname)
+        os.rename(tmp_dirname, dirname)
+        print('Cached {} sentences ({} tokens) in {} secs'.format(meta['num_sentences'], meta['num_tokens'], int(time.time() - t)))
+        return TokenCache(dirname, model=model)
+
+    @staticmethod
+    def load_or_build(dirname, model, sentences_fn, params=None):
+        ''' Opens the cache in `dirname`, building it from the generator `sentences_fn()` first if it doesn't exist yet '''
+        if TokenCache.exists(dirname):
+            print('Loading tokenized corpus from {}'.format(dirname))
+            return TokenCache(dirname, model=model)
+        return TokenCache.build(dirname, model, sentences_fn(), params=params)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def sentence(self, i):
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+    def batches(self, chunk_len, batch_size, num_sentences=None, padded=False):
+        '''
+        Same batches as batch_generator2(model, sentences, batch_size) with model.window = (chunk_len - 1) / 2: every
+        sentence is cut into chunks of `chunk_len` words, and a batch is yielded as soon as it has `batch_size` chunks
+        (so batches end on sentence boundaries). Only the first `num_sentences` sentences are used if given.
+
+        Batches are lists of lists of ints, or if `padded`, (num_chunks, chunk_len) int32 arrays with short chunks
+        filled up with cooccurrence.PAD, which PMIGatherer takes as they are.
+        '''
+        num_sentences = len(self) if num_sentences is None else min(len(self), int(num_sentences))
+        offsets = self.offsets[:num_sentences + 1]
+        num_chunks = -(-np.diff(offsets) // chunk_len)  # ceil
+        cum_chunks = np.cumsum(num_chunks)
+        first = 0
+        while first < num_sentences:
+            # the batch takes sentences until it has at least batch_size chunks
+            done = cum_chunks[first - 1] if first > 0 else 0
+            last = min(int(np.searchsorted(cum_chunks, done + batch_size)), num_sentences - 1)
+            if cum_chunks[last] > done:  # batch_generator2 never yields an empty batch
+                yield self._chunk(offsets[first:last + 2], num_chunks[first:last + 1], chunk_len, padded)
+            first = last + 1
+
+    def _chunk(self, offsets, num_chunks, chunk_len, padded):
+        ''' The chunks of the consecutive sentences with the given offsets (and chunk counts) '''
+        block = np.asarray(self.tokens[offsets[0]:offsets[-1]]).astype(np.int32)
+        total = int(num_chunks.sum())
+        sentence_of_chunk = np.repeat(np.arange(len(num_chunks)), num_chunks)
+        chunk_in_sentence = np.arange(total) - np.repeat(np.cumsum(num_chunks) - num_chunks, num_chunks)
+        starts = offsets[:-1][sentence_of_chunk] - offsets[0] + chunk_in_sentence * chunk_len
+        ends = np.minimum(starts + chunk_len, offsets[1:][sentence_of_chunk] - offsets[0])
+        if padded:
+            positions = starts[:, None] + np.arange(chunk_len)
+            in_chunk = positions < ends[:, None]
+            out = np.full((total, chunk_len), PAD, dtype=np.int32)
+            out[in_chunk] = block[positions[in_chunk]]
+            return out
+        words = block.tolist()
+        return [words[start:end] for start, end in zip(starts.tolist(), ends.tolist())]
@@ -50,6 +50,7 @@ if __name__ == "__main__":
     group.add_argument('-w2v', '--word2vec', type=str, help="Specify word2vec embedding file")
     group.add_argument('-gv', '--glove', type=str, help="Specify GloVe embedding file")
     group.add_argument('-gs', '--gensim', type=str, help="Specify Gensim embedding file")
+    group.add_argument('-npy', '--npy', type=str, help="Specify .npy embedding matrix (words in the .vocab file next to it)")
     parser.add_argument('-d', '--dataset', type=str, help="Path to outlier dataset", required=True)
 
     parser.add_argument('-b', '--binary', action="store_true", help="Indicates that the embedding file is binary (ignored for GloVe files)")
@@ -69,6 +70,8 @@ if __name__ == "__main__":
         embedding = WrappedEmbedding.from_word2vec(args.word2vec, binary=args.binary, **kwargs)
     elif args.glove:
         embedding = WrappedEmbedding.from_glove(args.glove, **kwargs)
+    elif args.npy:
+        embedding = WrappedEmbedding.from_npy(args.npy, **kwargs)
     else:
         embedding = WrappedEmbedding.from_gensim(args.gensim, **kwargs)
 
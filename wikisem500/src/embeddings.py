@@ -143,6 +143,10 @@ class WrappedEmbedding(Embedding, polyglot_mapping.Embedding):
         binary = kwargs['binary'] if 'binary' in kwargs else False
         return WrappedEmbedding.__wrap(super(WrappedEmbedding, WrappedEmbedding).from_word2vec(*args, fvocab=fvocab, binary=binary), **kwargs)
 
+    @staticmethod
+    def from_npy(fname, fvocab=None, mmap_mode=None, **kwargs):
+        return WrappedEmbedding.__wrap(super(WrappedEmbedding, WrappedEmbedding).from_npy(fname, fvocab=fvocab, mmap_mode=mmap_mode), **kwargs)
+
     @staticmethod
     def from_glove(*args, **kwargs):
         return WrappedEmbedding.__wrap(super(WrappedEmbedding, WrappedEmbedding).from_glove(*args), **kwargs)
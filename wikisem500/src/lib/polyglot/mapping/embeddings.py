@@ -100,12 +100,15 @@ class Embedding(object):
       return self
     return Embedding(vectors=vectors.T, vocabulary=self.vocabulary)
 
-  def nearest_neighbors(self, word, top_k=10):
+  def nearest_neighbors(self, word, top_k=10, indexer=None):
     """Return the nearest k words to the given `word`.
 
     Args:
       word (string): single word.
       top_k (integer): decides how many neighbors to report.
+      indexer: optional approximate nearest neighbor index over self.vectors
+        (same row order), e.g. an ann_index.IVFIndex built with metric='l2'.
+        Its search(queries, k, exclude=ids) replaces the exact scan.
 
     Returns:
       A list of words sorted by the distances. The closest is the first.
@@ -113,8 +116,12 @@ class Embedding(object):
     Note:
       L2 metric is used to calculate distances.
     """
-    #TODO(rmyeid): Use scikit ball tree, if scikit is available
     point = self[word]
+    if indexer is not None:
+      word_id = self.vocabulary.word_id[word]
+      ids, _ = indexer.search(point.reshape(1, -1), top_k, exclude=np.array([[word_id]]))
+      return [self.vocabulary.id_word[i] for i in ids[0] if i >= 0]
+    #TODO(rmyeid): Use scikit ball tree, if scikit is available
     diff = self.vectors - point
     distances = np.linalg.norm(diff, axis=1)
     top_ids = distances.argsort()[1:top_k+1]
@@ -172,19 +179,17 @@ class Embedding(object):
       vocab_size, layer1_size = list(map(int, header.split())) # throws for invalid file format
       vectors = np.zeros((vocab_size, layer1_size), dtype=float32)
       binary_len = np.dtype(float32).itemsize * layer1_size
+      # read everything at once and slice it, instead of reading the words byte by byte
+      data = fin.read()
+      pos = 0
       for line_no in xrange(vocab_size):
-        # mixed text and binary: read text first, then binary
-        word = []
-        while True:
-          ch = fin.read(1)
-          if ch == b' ':
-            break
-          if ch != b'\n': # ignore newlines in front of words (some binary files have newline, some don't)
-            word.append(ch)
-        word = _decode(b''.join(word))
-        index = line_no
+        # mixed text and binary: the word up to a space, then the vector
+        end = data.index(b' ', pos)
+        # ignore newlines in front of words (some binary files have newline, some don't)
+        word = _decode(data[pos:end].lstrip(b'\n'))
         words.append(word)
-        vectors[index, :] = np.fromstring(fin.read(binary_len), dtype=float32)
+        vectors[line_no, :] = np.frombuffer(data, dtype=float32, count=layer1_size, offset=end + 1)
+        pos = end + 1 + binary_len
       return words, vectors
 
   @staticmethod
@@ -248,6 +253,20 @@ class Embedding(object):
 
     return Embedding(vocabulary=vocabulary, vectors=vectors)
 
+  @staticmethod
+  def from_npy(fname, fvocab=None, mmap_mode=None):
+    """
+    Load a float32 matrix saved with np.save. The words (one per line, in the order of the rows) are read
+    from `fvocab`, by default `fname` with its extension replaced by .vocab. With `mmap_mode`, the matrix
+    is memory mapped instead of read into RAM.
+    """
+    if fvocab is None:
+      fvocab = path.splitext(fname)[0] + '.vocab'
+    with _open(fvocab, 'rb') as fin:
+      words = _decode(fin.read()).split(u'\n')[:-1]
+    vectors = np.load(fname, mmap_mode=mmap_mode)
+    return Embedding(vocabulary=OrderedVocabulary(words=words), vectors=vectors)
+
   @staticmethod
   def _from_glove(fname):
     with _open(fname, 'rb') as fin:
@@ -3,10 +3,15 @@
 
 """Test basic embedding utilities."""
 
+import os
+import shutil
+import struct
+import tempfile
 import unittest
 from ..embeddings import Embedding
 
-from io import StringIO
+import numpy as np
+from io import BytesIO, StringIO
 
 __all__ = ["suite"]
 
@@ -62,6 +67,26 @@ class EmbeddingTest(unittest.TestCase):
     norms = (model.vectors ** 2).sum(axis=1)
     _ = [self.assertAlmostEqual(x,y, places=6) for x,y in zip(norms, [1.]*model.shape[0])]
     
+  def test_word2vec_binary(self):
+    dump = b"9 5\n" + b"".join(
+      w.encode("utf-8") + b" " + struct.pack("<5f", *self.model[w]) + b"\n" for w in self.words)
+    model = Embedding.from_word2vec(BytesIO(dump), binary=1, fvocab=None)
+    self.assertEqual(model.words, self.words)
+    self.assertTrue(np.array_equal(model.vectors, self.model.vectors))
+
+  def test_npy(self):
+    tmpdir = tempfile.mkdtemp()
+    try:
+      fname = os.path.join(tmpdir, "vectors.npy")
+      np.save(fname, self.model.vectors)
+      with open(os.path.join(tmpdir, "vectors.vocab"), "w") as f:
+        f.write(u"".join(w + u"\n" for w in self.words))
+      model = Embedding.from_npy(fname, mmap_mode="r")
+      self.assertEqual(model.words, self.words)
+      self.assertTrue(np.array_equal(model.vectors, self.model.vectors))
+    finally:
+      shutil.rmtree(tmpdir)
+
 
 suite = unittest.TestLoader().loadTestsFromTestCase(EmbeddingTest)
 
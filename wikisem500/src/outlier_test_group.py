@@ -13,9 +13,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import itertools
 import os.path
 from collections import defaultdict
-from .utils import decode, similarity, similarity3
+
+import numpy as np
+
+from .utils import decode, similarity3_rows, similarity_matrix
 
 class TestGroup(object):
     def __init__(self, name, cluster, outliers):
@@ -73,60 +77,57 @@ class ResolvedTestGroup(TestGroup):
         """Yields tuples of the following form:
         ([(cluster-item-name, cluster-item-vec, cluster-item-compactness) ...],
           (outlier-item-name, outlier-item-vec, outlier-item-compactness))"""
-        for o in self.outliers:
-            if self.n == 2:
-                with_similarities = []
-
-                l = len(self.cluster)
-                for i in range(l):
-                   e1 = self.cluster[i]
-                   compactness = 0.0
-                   for j in range(l):
-                       if i == j: continue
-                       e2 = self.cluster[j]
-                       #outlier_compactness += similarity(e1[1], e2[1])
-                       compactness += similarity(e2[1], o[1])
-                       for k in range(j+1, l):
-                           if k == i:
-                               continue
-                           e3 = self.cluster[k]
-                           compactness += similarity(e2[1], e3[1])
-                   with_similarities.append((e1[0], e1[1], compactness)) # try replaceing one of the cluster words with the outlier, see if the predicted word remains the same
-
-                words_seen = set()
-                outlier_compactness = 0.0
-                for i, e1 in enumerate(self.cluster):
-                   for j in range(i+1, l):
-                       e2 = self.cluster[j]
-                       outlier_compactness += similarity(e1[1], e2[1])
-                yield (with_similarities, (o[0], o[1], outlier_compactness))
-            elif self.n == 3:
-                with_similarities = []
-                l = len(self.cluster)
-                for i in range(l):
-                   e1 = self.cluster[i]
-                   compactness = 0.0
-                   for j in range(l):
-                       if i == j: continue
-                       e2 = self.cluster[j]
-                       for k in range(j+1, l):
-                           if k == i:
-                               continue
-                           e3 = self.cluster[k]
-                           compactness += similarity3(e2[1], e3[1], o[1])
-                           for m in range(k+1, l):
-                               if m == i:
-                                   continue
-                               e4 = self.cluster[m]
-                               compactness += similarity3(e2[1], e3[1], e4[1])
-                   with_similarities.append((e1[0], e1[1], compactness)) # try replaceing one of the cluster words with the outlier, see if the predicted word remains the same
-
-                outlier_compactness = 0.0
-                for i, e1 in enumerate(self.cluster):
-                   for j in range(i+1, l):
-                       e2 = self.cluster[j]
-                       for k in range(j+1, l):
-                           e3 = self.cluster[k]
-                           outlier_compactness += similarity3(e1[1], e2[1], e3[1])
-                yield (with_similarities, (o[0], o[1], outlier_compactness))
+        cluster_compactness, outlier_compactness = self.compactness_scores()
+        for o, compactness in zip(self.outliers, cluster_compactness):
+            # try replacing one of the cluster words with the outlier, see if the predicted word remains the same
+            with_similarities = [(e[0], e[1], c) for (e, c) in zip(self.cluster, compactness.tolist())]
+            yield (with_similarities, (o[0], o[1], outlier_compactness))
+
+    def compactness_scores(self):
+        """
+        Returns (cluster_compactness, outlier_compactness). cluster_compactness[o, i] is the compactness of the
+        cluster with item i replaced by outlier o: the sum of the similarities of all n-sets of the remaining
+        cluster items plus o. outlier_compactness is the compactness of the whole cluster, i.e. the sum over all its
+        n-sets.
+
+        The similarity of every n-set is computed only once per group (for n=2 from the Gram matrix), and the sums
+        for each replaced item come from the totals by subtracting the n-sets that contain it.
+        """
+        l = len(self.cluster)
+        if l == 0 or len(self.outliers) == 0:
+            return np.zeros((len(self.outliers), l)), 0.0
+        C = np.array([e[1] for e in self.cluster], dtype=np.float64)
+        O = np.array([o[1] for o in self.outliers], dtype=np.float64)
+        pairs = np.array(list(itertools.combinations(range(l), 2)), dtype=np.intp).reshape(-1, 2)
+        if self.n == 2:
+            # all cluster pairs, and (cluster item, outlier) pairs
+            cluster_sims = similarity_matrix(C)[pairs[:, 0], pairs[:, 1]]
+            with_outlier = similarity_matrix(np.vstack([C, O]))[l:, :l]  # (num outliers, l)
+            cluster_sets = pairs
+            outlier_sets = np.arange(l).reshape(-1, 1)
+        elif self.n == 3:
+            # all cluster triples, and (cluster pair, outlier) triples
+            cluster_sets = np.array(list(itertools.combinations(range(l), 3)), dtype=np.intp).reshape(-1, 3)
+            cluster_sims = similarity3_rows(C[cluster_sets[:, 0]], C[cluster_sets[:, 1]], C[cluster_sets[:, 2]])
+            with_outlier = similarity3_rows(
+                np.tile(C[pairs[:, 0]], (len(O), 1)), np.tile(C[pairs[:, 1]], (len(O), 1)), np.repeat(O, len(pairs), axis=0)
+            ).reshape(len(O), len(pairs))
+            outlier_sets = pairs
+        else:
+            raise ValueError("Compactness is only defined for n=2 and n=3. Got n={}".format(self.n))
+
+        outlier_compactness = float(cluster_sims.sum())
+        cluster_part = outlier_compactness - _sum_over_sets_containing(cluster_sims[None, :], cluster_sets, l)[0]
+        outlier_part = with_outlier.sum(axis=1)[:, None] - _sum_over_sets_containing(with_outlier, outlier_sets, l)
+        return outlier_part + cluster_part[None, :], outlier_compactness
+
 
+def _sum_over_sets_containing(sims, sets, l):
+    """
+    For every row of the (rows, num sets) `sims`, the sums of the similarities of the sets (rows of `sets`, indices
+    into 0..l-1) that contain item i, for each i. Returns a (rows, l) array.
+    """
+    num_rows = sims.shape[0]
+    flat_items = (np.arange(num_rows)[:, None, None] * l + sets[None, :, :]).ravel()
+    weights = np.repeat(sims, sets.shape[1], axis=1).ravel()
+    return np.bincount(flat_items, weights=weights, minlength=num_rows * l).reshape(num_rows, l)
@@ -13,9 +13,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import itertools
 import unittest
 
+import numpy as np
+
 from ..outlier_test_group import TestGroup, ResolvedTestGroup
+from ..utils import similarity, similarity3
 
 
 from .utils_tests import EmbeddingTestCase
@@ -37,6 +41,23 @@ class TestGroupTest(EmbeddingTestCase):
     def test_iter(self):
         self.assertEqual(len([x for x in self.resolved]), 2)
         self.assertEqual([o[0] for c,o in self.resolved], ["cat_dog", "obama"])
+    def test_compactness(self):
+        """compactness_scores agrees with summing `similarity`/`similarity3` over every n-set"""
+        rng = np.random.RandomState(0)
+        cluster = [("c%d" % i, rng.randn(5).astype(np.float32)) for i in range(7)]
+        outliers = [("o%d" % i, rng.randn(5).astype(np.float32)) for i in range(3)]
+        cluster[3] = ("dup", cluster[2][1])  # duplicate vectors make similarity3 hit its zero distance case
+        for n, sim in [(2, similarity), (3, similarity3)]:
+            resolved = ResolvedTestGroup(None, "random", cluster, outliers, n=n)
+            vecs = [v for _, v in cluster]
+            whole = sum(sim(*s) for s in itertools.combinations(vecs, n))
+            for (with_similarities, o) in resolved:
+                self.assertAlmostEqual(o[2] / whole, 1.0, places=5)
+                for i, (name, _, compactness) in enumerate(with_similarities):
+                    replaced = vecs[:i] + vecs[i + 1:] + [o[1]]
+                    expected = sum(sim(*s) for s in itertools.combinations(replaced, n))
+                    self.assertAlmostEqual(compactness / expected, 1.0, places=5)
+
 
 suite = unittest.TestLoader().loadTestsFromTestCase(TestGroupTest)
 
@@ -62,3 +62,23 @@ def similarity3(v1, v2, v3, centroid_dist_method=True):
         return np.dot(v1 * v2, v3) / (np.linalg.norm(v1, ord=3) * np.linalg.norm(v2, ord=3) * np.linalg.norm(v3, ord=3))
 
 
+
+
+def similarity_matrix(vectors):
+    """Returns the matrix of cosine similarities between all rows of `vectors` (like `similarity` on every pair)"""
+    vectors = np.asarray(vectors, dtype=np.float64)
+    norms = np.linalg.norm(vectors, axis=1)
+    return np.dot(vectors, vectors.T) / np.outer(norms, norms)
+
+
+def similarity3_rows(v1, v2, v3, centroid_dist_method=True):
+    """Returns `similarity3` of every row triple (v1[i], v2[i], v3[i]) of the 2d arrays v1, v2 and v3"""
+    v1, v2, v3 = (np.asarray(v, dtype=np.float64) for v in (v1, v2, v3))
+    if centroid_dist_method:
+        centroid = (v1 + v2 + v3) / 3
+        mean_dist = (np.linalg.norm(centroid - v1, axis=1) + np.linalg.norm(centroid - v2, axis=1) + np.linalg.norm(centroid - v3, axis=1)) / 3
+        with np.errstate(divide='ignore'):
+            return np.where(mean_dist == 0.0, 1 / .00001, 1 / mean_dist)
+    else:
+        norms = [np.linalg.norm(v, ord=3, axis=1) for v in (v1, v2, v3)]
+        return (v1 * v2 * v3).sum(axis=1) / (norms[0] * norms[1] * norms[2])